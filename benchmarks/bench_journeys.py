@@ -0,0 +1,97 @@
+"""
+Benchmark the most common journey calculation used by station_stats().
+
+Compares the original row-wise df.apply() implementation against the
+vectorized bikeshare.top_journeys() on a synthetic dataframe, e.g.
+
+    python benchmarks/bench_journeys.py --rows 1000000 --stations 600
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+import bikeshare  # noqa: E402
+
+
+def synthetic_stations_df(rows, stations, seed=0):
+    """
+    Build a dataframe of random Start/End Station pairs.
+
+    Arguments:
+        rows -- number of trips (int)\n
+        stations -- number of distinct stations (int)\n
+        seed -- random seed (int)
+
+    Returns:
+        dataframe with 'Start Station' and 'End Station' columns
+    """
+    rng = np.random.default_rng(seed)
+    names = np.array(['Station %d' % i for i in range(stations)],
+                     dtype=object)
+    # Skew the popularity of stations a bit, like real data.
+    weights = rng.pareto(1.5, stations) + 1
+    weights /= weights.sum()
+    return pd.DataFrame({
+        'Start Station': names[rng.choice(stations, rows, p=weights)],
+        'End Station': names[rng.choice(stations, rows, p=weights)]})
+
+
+def apply_top_journey(df):
+    """Most common journey via the original per-row string building."""
+    journeys = df.apply(lambda x: '%s to %s' % (x['Start Station'],
+                                                x['End Station']), axis=1)
+    counts = journeys.value_counts()
+    return counts.idxmax(), counts.max()
+
+
+def vectorized_top_journey(df):
+    """Most common journey via bikeshare.top_journeys()."""
+    journeys = bikeshare.top_journeys(df, 1)
+    start, end = journeys.index[0]
+    return '%s to %s' % (start, end), journeys.iloc[0]
+
+
+def best_time(func, df, repeat):
+    """Run func(df) repeat times, return (best seconds, last result)."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(df)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    """Run the benchmark and print the timings and speedup."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rows', type=int, default=300000)
+    parser.add_argument('--stations', type=int, default=600)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    df = synthetic_stations_df(args.rows, args.stations)
+    old_secs, (_, old_count) = best_time(apply_top_journey, df, 1)
+    new_secs, (_, new_count) = best_time(vectorized_top_journey, df,
+                                         args.repeat)
+    cat_df = df.astype('category')
+    cat_secs, (_, cat_count) = best_time(vectorized_top_journey, cat_df,
+                                         args.repeat)
+    assert old_count == new_count == cat_count
+
+    print('rows={rows} stations={stations}'.format(**vars(args)))
+    print('df.apply + value_counts   {secs:8.3f}s'.format(secs=old_secs))
+    print('top_journeys (object)     {secs:8.3f}s  {x:6.1f}x'.
+          format(secs=new_secs, x=old_secs / new_secs))
+    print('top_journeys (category)   {secs:8.3f}s  {x:6.1f}x'.
+          format(secs=cat_secs, x=old_secs / cat_secs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""
+Benchmark the start up of bikeshare.py: import time, time to first prompt
+and time to first result of the interactive app.
+
+Every run is a fresh Python process. The import of bikeshare alone is
+compared against importing numpy and pandas with it, as before they were
+imported lazily. The interactive app runs on synthetic city CSVs (see
+synthetic.py) with their cache pre-built, answering the prompts after
+--think seconds, with and without the background warm-up, e.g.
+
+    python benchmarks/bench_startup.py --rows 1000000 --think 2
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+import synthetic  # noqa: E402
+
+BIKESHARE = os.path.join(REPO_DIR, 'bikeshare.py')
+CITY_PROMPT = b'Which city'
+FILTER_PROMPT = b'filter city data'
+RESULT_END = b'(end of Summary Statistics)'
+
+
+def import_seconds(statement, repeat):
+    """
+    Time a Python statement in fresh processes.
+
+    Arguments:
+        statement -- Python code to run (str)\n
+        repeat -- number of runs (int)
+
+    Returns:
+        median seconds (float) of the runs
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', statement], cwd=REPO_DIR,
+                       check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def read_until(process, marker, output):
+    """
+    Read a process's output until marker shows up.
+
+    Arguments:
+        process -- subprocess.Popen with a stdout pipe\n
+        marker -- bytes to wait for\n
+        output -- bytearray of the output read so far, extended in place
+    """
+    while marker not in output:
+        data = os.read(process.stdout.fileno(), 65536)
+        if not data:
+            raise RuntimeError('bikeshare.py exited before printing {m!r}'.
+                               format(m=marker))
+        output.extend(data)
+
+
+def interactive_seconds(data_dir, think, warm_up):
+    """
+    Time the interactive app's first prompt and first query result, for
+    the Chicago city with no filter.
+
+    Arguments:
+        data_dir -- directory of the city CSVs (str)\n
+        think -- seconds to wait before answering each prompt (float)\n
+        warm_up -- run with the background warm-up (bool)
+
+    Returns:
+        (seconds to first prompt, seconds from the last answer to the
+        result) tuple
+    """
+    args = [sys.executable, BIKESHARE] + ([] if warm_up else ['--no-warm-up'])
+    start = time.perf_counter()
+    process = subprocess.Popen(args, cwd=data_dir, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE,
+                               env=dict(os.environ, PYTHONUNBUFFERED='1'))
+    try:
+        output = bytearray()
+        read_until(process, CITY_PROMPT, output)
+        first_prompt = time.perf_counter() - start
+        time.sleep(think)
+        process.stdin.write(b'c\n')
+        process.stdin.flush()
+        read_until(process, FILTER_PROMPT, output)
+        time.sleep(think)
+        answered = time.perf_counter()
+        process.stdin.write(b'n\n')
+        process.stdin.flush()
+        read_until(process, RESULT_END, output)
+        first_result = time.perf_counter() - answered
+    finally:
+        process.kill()
+        process.wait()
+    return first_prompt, first_result
+
+
+def main():
+    """Run the benchmark and print the timings."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rows', type=int, default=100000,
+                        help='trips per synthetic city (default: %(default)s)')
+    parser.add_argument('--think', type=float, default=1.0,
+                        help='seconds the user takes per prompt '
+                             '(default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--data-dir',
+                        default=os.path.join(REPO_DIR, 'benchmarks', 'data'),
+                        help='where generated CSVs are kept')
+    args = parser.parse_args()
+
+    lazy = import_seconds('import bikeshare', args.repeat)
+    eager = import_seconds('import numpy, pandas, bikeshare', args.repeat)
+    print('import bikeshare                  {secs:8.3f}s'.format(secs=lazy))
+    print('import numpy, pandas, bikeshare   {secs:8.3f}s'.format(secs=eager))
+
+    data_dir = os.path.join(args.data_dir,
+                            'rows-{rows}'.format(rows=args.rows))
+    if not os.path.exists(os.path.join(data_dir, 'chicago.csv')):
+        synthetic.write_city_csvs(data_dir, args.rows)
+    subprocess.run([sys.executable, BIKESHARE, 'build-cache', 'chicago'],
+                   cwd=data_dir, check=True, stdout=subprocess.DEVNULL)
+    print('rows={rows} think={think}s'.format(**vars(args)))
+    for warm_up in [False, True]:
+        runs = [interactive_seconds(data_dir, args.think, warm_up)
+                for _ in range(args.repeat)]
+        print('{mode:<10} first prompt {prompt:8.3f}s  first result '
+              '{result:8.3f}s'.format(
+                  mode='warm-up' if warm_up else 'no warm-up',
+                  prompt=statistics.median(run[0] for run in runs),
+                  result=statistics.median(run[1] for run in runs)))
+
+
+if __name__ == '__main__':
+    main()
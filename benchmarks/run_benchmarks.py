@@ -0,0 +1,214 @@
+"""
+Time each stage of the bikeshare query pipeline on synthetic city data.
+
+Synthetic CSVs (see synthetic.py) are generated once per row count into
+--data-dir and reused. Every city × row count runs in a fresh process, so
+the peak RSS reported after each stage (the process's high-water mark so
+far) isn't inflated by earlier runs. Results are saved as JSON, and a
+previous result file can be compared against, e.g.
+
+    python benchmarks/run_benchmarks.py --rows 10000 1000000 -o new.json
+    python benchmarks/run_benchmarks.py --rows 10000 --compare old.json
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+import bikeshare  # noqa: E402
+import synthetic  # noqa: E402
+
+CITY_FILES = {'Chicago': 'chicago.csv',
+              'New York city': 'new_york_city.csv',
+              'Washington DC': 'washington.csv'}
+
+
+def peak_rss_mb():
+    """Get this process's peak resident set size so far, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS but KB on Linux.
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def ensure_city_csv(data_dir, rows, city):
+    """
+    Get the path of a city's synthetic CSV, generating it if needed.
+
+    Arguments:
+        data_dir -- base directory for generated data (str)\n
+        rows -- trips per city (int)\n
+        city -- key of CITY_FILES (str)
+
+    Returns:
+        CSV file path (str)
+    """
+    name = CITY_FILES[city]
+    out_dir = os.path.join(data_dir, 'rows-{rows}'.format(rows=rows))
+    path = os.path.join(out_dir, name)
+    if not os.path.exists(path):
+        os.makedirs(out_dir, exist_ok=True)
+        synthetic.write_city_csv(path, rows, synthetic.CITY_SCHEMAS[name],
+                                 seed=list(CITY_FILES).index(city))
+    return path
+
+
+def benchmark_city(city, csv_path, rows):
+    """
+    Time every pipeline stage for one city CSV.
+
+    Meant to run in a fresh process, see run_benchmarks().
+
+    Arguments:
+        city -- key of bikeshare.CITY_DATA (str)\n
+        csv_path -- path of the city's synthetic CSV (str)\n
+        rows -- number of trips in the CSV (int)
+
+    Returns:
+        list of stage result dicts
+    """
+    bikeshare.CITY_DATA[city] = csv_path
+    shutil.rmtree(bikeshare.city_cache_dir(city), ignore_errors=True)
+    results = []
+
+    def stage(name, func, *args):
+        # Render functions print, keep that out of the benchmark output.
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            value = func(*args)
+            seconds = time.perf_counter() - start
+        results.append({'city': city, 'rows': rows, 'stage': name,
+                        'seconds': seconds,
+                        'rows_per_sec': rows / seconds if seconds else None,
+                        'peak_rss_mb': peak_rss_mb()})
+        return value
+
+    raw = stage('read_csv', lambda: pd.read_csv(csv_path, index_col=0))
+    df = stage('prepare_df_columns', bikeshare.prepare_df_columns, raw)
+    del raw
+    df = stage('compact_df_dtypes', bikeshare.compact_df_dtypes, df)
+    stage('filter_df month', bikeshare.filter_df, 'Mar', 'all', df)
+    stage('filter_df day', bikeshare.filter_df, 'all', 'Mon', df)
+    aggs = stage('aggregate_trips', bikeshare.aggregate_trips, df)
+    summary = stage('summarize_aggregates', bikeshare.summarize_aggregates,
+                    aggs, 'all', 'all')
+    for render in [bikeshare.time_stats, bikeshare.station_stats,
+                   bikeshare.trip_duration_stats, bikeshare.user_stats]:
+        stage(render.__name__, render, summary)
+    if stage('write_city_cache', bikeshare.write_city_cache, city, df):
+        stage('read_city_cache', bikeshare.read_city_cache, city)
+    cube = stage('build_city_cube', bikeshare.build_city_cube, df)
+    stage('cube_aggregates', bikeshare.cube_aggregates, cube, 'Mar', 'Mon')
+    bikeshare.city_cache_clear()
+    stage('load_data cold', bikeshare.load_data, city, 'Mar', 'all')
+    stage('load_data warm', bikeshare.load_data, city, 'all', 'Mon')
+    stage('stream_city_aggregates', bikeshare.stream_city_aggregates, city,
+          [('all', 'all')])
+    return results
+
+
+def run_benchmarks(row_counts, cities, data_dir):
+    """
+    Benchmark every city × row count, each in a fresh process.
+
+    Arguments:
+        row_counts -- list of trips per city (ints)\n
+        cities -- list of CITY_FILES keys\n
+        data_dir -- base directory for generated data (str)
+
+    Returns:
+        list of stage result dicts
+    """
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for rows in row_counts:
+        for city in cities:
+            csv_path = ensure_city_csv(data_dir, rows, city)
+            with context.Pool(1) as pool:
+                results += pool.apply(benchmark_city, (city, csv_path, rows))
+    return results
+
+
+def run_metadata():
+    """Describe the code and environment the benchmarks ran with."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR,
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {'commit': commit or None,
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'platform': platform.platform()}
+
+
+def print_results(results, baseline=None):
+    """
+    Print a table of stage timings, compared to a baseline if given.
+
+    Arguments:
+        results -- list of stage result dicts\n
+        baseline -- list of stage result dicts from an earlier run, or None
+    """
+    base = {(r['city'], r['rows'], r['stage']): r for r in baseline or []}
+    print('{:<14} {:>10} {:<24} {:>9} {:>13} {:>9}{}'.format(
+        'city', 'rows', 'stage', 'seconds', 'rows/sec', 'rss MB',
+        '  vs base' if baseline else ''))
+    for r in results:
+        line = '{:<14} {:>10} {:<24} {:>9.4f} {:>13,.0f} {:>9.1f}'.format(
+            r['city'], r['rows'], r['stage'], r['seconds'],
+            r['rows_per_sec'] or 0, r['peak_rss_mb'])
+        old = base.get((r['city'], r['rows'], r['stage']))
+        if old and r['seconds']:
+            line += '  {:>6.2f}x'.format(old['seconds'] / r['seconds'])
+        print(line)
+
+
+def main():
+    """Run the benchmarks selected on the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000],
+                        help='trips per city, e.g. 10000 50000000 '
+                             '(default: %(default)s)')
+    parser.add_argument('--cities', nargs='+', choices=list(CITY_FILES),
+                        default=list(CITY_FILES))
+    parser.add_argument('--data-dir',
+                        default=os.path.join(REPO_DIR, 'benchmarks', 'data'),
+                        help='where generated CSVs are kept')
+    parser.add_argument('-o', '--output',
+                        help='save results to this JSON file')
+    parser.add_argument('--compare',
+                        help='JSON results file of an earlier run to '
+                             'compare against (x = speedup)')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.rows, args.cities, args.data_dir)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'meta': run_metadata(), 'results': results}, f,
+                      indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+Write synthetic bikeshare CSVs matching the city files' schemas.
+
+Chicago and New York city files have Gender and Birth Year columns,
+Washington has neither and has fractional Trip Durations, e.g.
+
+    python benchmarks/synthetic.py --rows 1000000 --out-dir /tmp/bikeshare
+"""
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+# City CSV file name -> whether it has the Gender and Birth Year columns.
+CITY_SCHEMAS = {'chicago.csv': True,
+                'new_york_city.csv': True,
+                'washington.csv': False}
+STATION_COUNT = 600
+# Relative trip counts per start hour, peaking at the commutes.
+HOUR_WEIGHTS = np.array([2, 1, 1, 1, 1, 2, 4, 8, 12, 8, 6, 6,
+                         7, 7, 7, 8, 11, 15, 12, 8, 6, 4, 3, 2], dtype=float)
+
+
+def synthetic_trips(rows, rider_columns, rng):
+    """
+    Generate a dataframe of random trips, Jan to Jun 2017.
+
+    Arguments:
+        rows -- number of trips (int)\n
+        rider_columns -- add Gender and Birth Year columns (bool)\n
+        rng -- numpy random Generator
+
+    Returns:
+        dataframe laid out like a city CSV, with the CSV's unnamed
+        id column as index
+    """
+    stations = np.array(['Station %d' % i for i in range(STATION_COUNT)],
+                        dtype=object)
+    # Skew station popularity, like real data.
+    station_weights = rng.pareto(1.5, STATION_COUNT) + 1
+    station_weights /= station_weights.sum()
+    days = rng.integers(0, 181, rows)
+    hours = rng.choice(24, rows, p=HOUR_WEIGHTS / HOUR_WEIGHTS.sum())
+    seconds = days*86400 + hours*3600 + rng.integers(0, 3600, rows)
+    start = (np.datetime64('2017-01-01T00:00:00') +
+             seconds.astype('timedelta64[s]'))
+    duration = np.clip(rng.lognormal(6.5, 0.8, rows), 60, 86400)
+    if rider_columns:
+        duration = duration.round()
+    else:
+        duration = duration.round(3)
+    end = start + duration.round().astype('timedelta64[s]')
+    df = pd.DataFrame({
+        'Start Time': pd.Series(start).dt.strftime('%Y-%m-%d %H:%M:%S'),
+        'End Time': pd.Series(end).dt.strftime('%Y-%m-%d %H:%M:%S'),
+        'Trip Duration': duration if not rider_columns
+        else duration.astype(np.int64),
+        'Start Station': stations[rng.choice(STATION_COUNT, rows,
+                                             p=station_weights)],
+        'End Station': stations[rng.choice(STATION_COUNT, rows,
+                                           p=station_weights)],
+        'User Type': rng.choice(np.array(['Subscriber', 'Customer'],
+                                         dtype=object),
+                                rows, p=[0.8, 0.2])})
+    if rider_columns:
+        gender = rng.choice(np.array(['Male', 'Female'], dtype=object),
+                            rows, p=[0.75, 0.25])
+        # Customers mostly don't have gender or birth year data.
+        no_rider_data = ((df['User Type'] == 'Customer').to_numpy() &
+                         (rng.random(rows) < 0.9))
+        gender[no_rider_data] = None
+        birth_year = rng.normal(1981, 11, rows).clip(1900, 2001).round()
+        birth_year[no_rider_data] = np.nan
+        df['Gender'] = gender
+        df['Birth Year'] = birth_year
+    df.index = rng.permutation(rows * 4)[:rows]
+    return df
+
+
+def write_city_csv(path, rows, rider_columns, seed=0, chunk_rows=1000000):
+    """
+    Write a synthetic city CSV, chunk by chunk so any size fits in memory.
+
+    Arguments:
+        path -- CSV file path (str)\n
+        rows -- number of trips (int)\n
+        rider_columns -- add Gender and Birth Year columns (bool)\n
+        seed -- random seed (int)\n
+        chunk_rows -- trips generated per chunk (int)
+    """
+    rng = np.random.default_rng(seed)
+    # Always write at least one (maybe empty) chunk, for the header.
+    for start in range(0, max(rows, 1), chunk_rows):
+        chunk = synthetic_trips(min(chunk_rows, rows - start),
+                                rider_columns, rng)
+        # Ids of a chunk are unique within [start*4, (start+chunk)*4).
+        chunk.index += start * 4
+        chunk.to_csv(path, mode='w' if start == 0 else 'a',
+                     header=start == 0)
+
+
+def write_city_csvs(out_dir, rows, seed=0, files=None):
+    """
+    Write synthetic CSVs for the cities.
+
+    Arguments:
+        out_dir -- directory to write to (str)\n
+        rows -- number of trips per city (int)\n
+        seed -- random seed (int)\n
+        files -- CSV file names to write, defaults to all of CITY_SCHEMAS
+
+    Returns:
+        dict of CSV file name to path written
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    paths = {}
+    for i, name in enumerate(files or CITY_SCHEMAS):
+        paths[name] = os.path.join(out_dir, name)
+        write_city_csv(paths[name], rows, CITY_SCHEMAS[name], seed=seed+i)
+    return paths
+
+
+def main():
+    """Write the synthetic CSVs requested on the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rows', type=int, default=100000,
+                        help='trips per city (default: %(default)s)')
+    parser.add_argument('--out-dir', default='.',
+                        help='directory to write to (default: current)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--files', nargs='+', choices=list(CITY_SCHEMAS),
+                        help='CSV files to write (default: all)')
+    args = parser.parse_args()
+    for name, path in write_city_csvs(args.out_dir, args.rows, args.seed,
+                                      args.files).items():
+        print('wrote {rows} rows to {path}'.format(rows=args.rows, path=path))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,202 @@
 """Import python modules required for all functions below."""
 
+import argparse
+import contextlib
+import cProfile
 import datetime
-import pandas as pd
+import functools
+import hashlib
+import importlib
+import json
+import os
+import queue
+import re
+import sys
+import threading
+import time
+import urllib.parse
 import calendar
-from math import floor
-# Note: imports below commented out because they were not used or required
-# import time
-# import numpy as np
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from math import floor, prod
+
+
+class LazyModule:
+    """
+    Stand-in for a module that is imported when first used.
+
+    Importing numpy and pandas takes most of the app's start up time, yet
+    nothing needs them before the first query. The first attribute lookup
+    imports the module and replaces the stand-in in this module's globals,
+    so later lookups cost nothing extra.
+    """
+
+    def __init__(self, name, alias):
+        self.name = name
+        self.alias = alias
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.name)
+        globals()[self.alias] = module
+        return getattr(module, attr)
+
+
+np = LazyModule('numpy', 'np')
+pd = LazyModule('pandas', 'pd')
+
+
+def env_int(name, default):
+    """
+    Get a whole number setting from an environment variable.
+
+    A value that isn't a number is left for parse_args() to report, see
+    env_default(), so importing the module never fails on it.
+
+    Arguments:
+        name -- environment variable (str)\n
+        default -- value if it's unset or not a number (int)
+
+    Returns:
+        the setting (int)
+    """
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
 
 
 CITY_DATA = {'Chicago': 'chicago.csv',
              'New York city': 'new_york_city.csv',
              'Washington DC': 'washington.csv'}
-CITY__OPT_INPUTS = ['c', 'n', 'w']
-FILTER_OPT_INPUTS = ['m', 'd', 'n', 'b']
+CITY__OPT_INPUTS = ['c', 'n', 'w', 'a']
+# Month and weekday lookups by 3 char abbr, e.g. 'Jan' -> 1, 'Mon' -> 0.
+MONTH_NUMBERS = {abbr: number
+                 for number, abbr in enumerate(calendar.month_abbr) if abbr}
+MONTH_NAMES = {abbr: calendar.month_name[number]
+               for abbr, number in MONTH_NUMBERS.items()}
+WEEKDAY_NUMBERS = {abbr: number
+                   for number, abbr in enumerate(calendar.day_abbr)}
+WEEKDAY_NAMES = dict(zip(calendar.day_abbr, calendar.day_name))
+# Pseudo city of input_city() and column of compare_cities() for all cities.
+ALL_CITIES = 'All cities'
+FILTER_OPT_INPUTS = ['m', 'd', 'n', 'b', 't']
 PAGER_VIEW_INPUTS = ['b', 'q', '']
 PAGER_PROMPT_INPUTS = ['', 'y', 's']
-DF_OUTPUT_PAGE_SIZE = 5
+DF_OUTPUT_PAGE_SIZE = env_int('BIKESHARE_PAGE_SIZE', 5)
+# On-disk columnar cache of parsed city data, kept next to each city CSV.
+CACHE_DIR_NAME = '.bikeshare_cache'
+CACHE_FORMAT_VERSION = 5
+CACHE_MANIFEST_NAME = 'manifest.json'
+# In-process cache of parsed city data, least recently used city evicted
+# first once the memory budget (MB) is exceeded.
+CITY_CACHE_BUDGET_MB = env_int('BIKESHARE_CACHE_MB', 2048)
+city_df_cache = OrderedDict()
+# Guard the in-process caches when queries run in threads (serve and
+# compare commands), see city_load_lock().
+city_cache_lock = threading.RLock()
+city_load_locks = {}
+city_cache_counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+# Filter month/day while streaming the CSV in chunks of READ_CHUNK_SIZE rows
+# when the city isn't cached yet, instead of parsing the whole file first.
+PUSHDOWN_FILTERS = os.environ.get('BIKESHARE_PUSHDOWN', '') == '1'
+READ_CHUNK_SIZE = 250000
+# Compute summary stats by streaming the CSV in chunks instead of loading
+# it, for city files larger than memory.
+OUT_OF_CORE = os.environ.get('BIKESHARE_OUT_OF_CORE', '') == '1'
+# Number of most common journeys listed in the station statistics.
+TOP_JOURNEYS_COUNT = 5
+# Per-stage timing/memory profile of each query, off by default. With
+# PROFILE_DIR set, a JSON trace and a cProfile dump per query go there too.
+PROFILE_STAGES = os.environ.get('BIKESHARE_PROFILE', '') == '1'
+PROFILE_DIR = os.environ.get('BIKESHARE_PROFILE_DIR') or None
+DISABLED_SPAN = contextlib.nullcontext()
+# Spans and open stage names of the query traced on each thread, see
+# query_trace() and traced_call().
+trace_state = threading.local()
+trace_query_count = 0
+trace_count_lock = threading.Lock()
+# Columns stored as pandas categoricals to save memory and speed up counts.
+CATEGORY_COLUMNS = ['Start Station', 'End Station', 'User Type', 'Gender']
+# Aggregate cube per city: trips per month × weekday × start hour cell,
+# plus counts per cell of the values of these columns.
+CUBE_WEEK_CELLS = 7*24
+CUBE_COUNT_TABLES = {'user_type': ['User Type'],
+                     'gender': ['Gender'],
+                     'start_station': ['Start Station'],
+                     'end_station': ['End Station'],
+                     'journey': ['Start Station', 'End Station'],
+                     'birth_year': ['Birth Year'],
+                     'duration_bucket': ['Duration Bucket']}
+city_cube_cache = {}
+# Start Time index per city: row positions sorted by start time, and sorted
+# again by weekday × start hour bucket, so time window filters resolve to
+# row slices by binary search.
+city_time_index_cache = {}
+# Station index per city: row positions of the trips starting and ending at
+# each station, for per-station drill-down queries.
+city_station_index_cache = {}
+TOP_STATIONS_COUNT = 5
+# Responses of the serve command's JSON API, least recently used evicted
+# first beyond RESPONSE_CACHE_SIZE entries.
+RESPONSE_CACHE_SIZE = 256
+SERVE_MAX_PAGE_SIZE = 1000
+response_cache = OrderedDict()
+response_cache_lock = threading.Lock()
+# Summary statistics of recent queries, keyed by query and CSV fingerprint,
+# least recently used evicted first beyond RESULT_CACHE_SIZE entries (0 to
+# disable). With PERSIST_RESULTS on they are stored on disk as well, in each
+# city's cache directory, so they survive restarts.
+RESULT_CACHE_SIZE = env_int('BIKESHARE_RESULT_CACHE', 512)
+PERSIST_RESULTS = os.environ.get('BIKESHARE_PERSIST_RESULTS', '') == '1'
+result_cache = OrderedDict()
+result_cache_counters = {'hits': 0, 'disk_hits': 0, 'misses': 0,
+                         'evictions': 0}
+result_cache_lock = threading.Lock()
+city_fingerprints = {}
+# Derived tables build-cache persists next to each city's cached data.
+CACHE_ARTIFACTS = ['cube', 'time_index', 'station_index', 'rollups']
+# Hourly time series of trips, duration and trips per user type per city,
+# resampled to days on demand and drawn as sparklines in the interactive
+# summary, see build_rollups().
+city_rollups_cache = {}
+ROLLUP_FREQS = {'hourly': 'h', 'daily': 'D'}
+SPARKLINE_CHARS = '▁▂▃▄▅▆▇█'
+SPARKLINE_WIDTH = 60
+# Trip duration percentiles are estimated from a histogram of log-sized
+# buckets, bucket i holding the durations in (base**(i-1), base**i], so
+# every estimate is within DURATION_RELATIVE_ERROR of the exact value (for
+# durations of a second or more). Histograms of chunks or cities add up.
+DURATION_RELATIVE_ERROR = 0.01
+DURATION_BUCKET_BASE = ((1+DURATION_RELATIVE_ERROR) /
+                        (1-DURATION_RELATIVE_ERROR))
+DURATION_BUCKETS = 1000
+DURATION_PERCENTILES = {'median': 0.5, 'p90': 0.9, 'p99': 0.99}
+# Approximate mode: station and journey counts computed from rows (e.g.
+# out-of-core streaming) are kept as Misra-Gries summaries of at most
+# SKETCH_SIZE values per chunk, so memory stays bounded however many
+# distinct journeys there are. Count key -> key of its largest undercount.
+APPROXIMATE = os.environ.get('BIKESHARE_APPROXIMATE', '') == '1'
+SKETCH_SIZE = env_int('BIKESHARE_SKETCH_SIZE', 1000)
+SKETCH_COUNTS = {'start_station_counts': 'start_station_undercount',
+                 'end_station_counts': 'end_station_undercount',
+                 'journey_counts': 'journey_undercount'}
+# Interactive app: import numpy/pandas and read the cities' cached cubes in
+# a background thread while the user answers the first prompts.
+WARM_UP = os.environ.get('BIKESHARE_WARM_UP', '1') != '0'
+# Interactive app: load the chosen city in a background thread while the
+# user picks the filters, see prefetch_cities(). City -> Future of its load.
+PREFETCH = os.environ.get('BIKESHARE_PREFETCH', '1') != '0'
+city_prefetches = {}
+prefetch_queue = queue.Queue()
+prefetch_lock = threading.Lock()
+prefetch_worker_thread = None
+# Export file formats by file extension, see export_query().
+EXPORT_FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.parquet': 'parquet',
+                  '.arrow': 'arrow', '.feather': 'arrow'}
+# Time window filter spellings, see parse_weekdays() and parse_window_span().
+WEEKDAY_SETS = {'weekdays': range(0, 5), 'weekends': range(5, 7)}
+WINDOW_SPAN_UNITS = {'h': 'hours', 'd': 'days', 'w': 'weeks'}
 APP_INIT_BANNER = ''' _   _ ____    ____  _ _          ____  _                                      _           _     _             ____ _____ ____ 
 | | | / ___|  | __ )(_) | _____  / ___|| |__   __ _ _ __ ___   _ __  _ __ ___ (_) ___  ___| |_  | |__  _   _  | __ )_   _/ ___|
 | | | \___ \  |  _ \| | |/ / _ \ \___ \| '_ \ / _` | '__/ _ \ | '_ \| '__/ _ \| |/ _ \/ __| __| | '_ \| | | | |  _ \ | || |    
@@ -27,15 +207,15 @@ APP_INIT_BANNER = ''' _   _ ____    ____  _ _          ____  _
 
 def weekday_num2str(day):
     """
-    Convert weekday number (0:6) to its full name.
+    Convert 3 char abbr of a weekday to its full name.
 
     Arguments:
-        day -- number (0:6)
+        day -- e.g. "Sun" (str)
 
     Returns:
         full name (str) e.g. "Sunday"
     """
-    return calendar.day_name[calendar.day_abbr[0:7].index(day)]
+    return WEEKDAY_NAMES[day]
 
 
 def month_abbr2name(month_abbr):
@@ -48,8 +228,7 @@ def month_abbr2name(month_abbr):
     Returns:
         full name (str) e.g. "January"
     """
-    return
-    calendar.month_name[calendar.month_abbr[1:13].index(month_abbr.title())+1]
+    return MONTH_NAMES[month_abbr.title()]
 
 
 def month_num2name(month_number):
@@ -62,7 +241,7 @@ def month_num2name(month_number):
     Returns:
         full name of month, e.g. 'January'
     """
-    return calendar.month_name[month_number-1]
+    return calendar.month_name[month_number]
 
 
 def dictionary_prettyprint(d):
@@ -79,54 +258,287 @@ def dictionary_prettyprint(d):
                      theval=v))
 
 
-def df_column_items_dist_print(df, col_str):
+def counts_dist_print(counts, col_str):
     r"""
-    Print distribution counts of the different values in a given dataframe
-    column with column check.
+    Print distribution counts of the different values of a column, as
+    collected in the summary statistics.
 
-    Note if the column doesn't exist in the dataframe, this will alert the
-    user and not throw an error.
+    Note if the city has no data for the column (counts is None), this will
+    alert the user and not throw an error.
 
     Arguments:
-        df -- the dataframe\n
-        col_str -- the column string of the dataframe to query
+        counts -- dict of counts per value, highest first, or None\n
+        col_str -- the column string the counts are about
     """
-    if col_str in df.columns:
-        genders = df[col_str].value_counts()
-        print(genders.to_string()+'\n')
+    if counts is not None:
+        counts = pd.Series(counts, dtype='int64').rename_axis(col_str)
+        print(counts.to_string()+'\n')
     else:
         print('\nSorry, no data available about ' +
               '{this_col} for the selected city'.
               format(this_col=col_str))
 
 
-def print_bikeshare_df_page(df, index):
+def traced_stage(func):
+    """
+    Decorate a pipeline stage function so it's timed by stage_span().
+
+    When PROFILE_STAGES is off this only adds a flag check per call.
+
+    Arguments:
+        func -- the stage function
+
+    Returns:
+        the wrapped function
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not PROFILE_STAGES:
+            return func(*args, **kwargs)
+        with stage_span(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def stage_span(name):
+    """
+    Time a stage of the query pipeline, if PROFILE_STAGES is on.
+
+    Use as "with stage_span('name'):". Spans nest, and are collected for
+    the query traced on this thread by query_trace(), if any.
+
+    Arguments:
+        name -- stage name (str)
+
+    Returns:
+        context manager
+    """
+    if not PROFILE_STAGES:
+        return DISABLED_SPAN
+    return recorded_stage_span(name)
+
+
+@contextlib.contextmanager
+def recorded_stage_span(name):
+    """
+    Record a stage's start, duration, path of enclosing stages and memory
+    in the spans of the query traced on this thread.
+
+    Arguments:
+        name -- stage name (str)
+    """
+    spans = getattr(trace_state, 'spans', None)
+    if spans is None:
+        yield
+        return
+    stack = trace_state.stack
+    stack.append(name)
+    span = {'name': name, 'path': tuple(stack),
+            'thread': threading.get_ident(), 'start': time.perf_counter()}
+    try:
+        yield
+    finally:
+        stack.pop()
+        span['seconds'] = time.perf_counter() - span['start']
+        span['rss_mb'] = current_rss_mb()
+        spans.append(span)
+
+
+def traced_call(trace, func, *args):
+    """
+    Call func(*args) on this thread as part of another thread's traced
+    query, so its stages are recorded under the stage that was open there.
+
+    Arguments:
+        trace -- (spans, stage names) tuple of the query's thread, from
+                 current_trace(), or None to just call func\n
+        func -- function to call\n
+        args -- its arguments
+
+    Returns:
+        func's result
+    """
+    if trace is None:
+        return func(*args)
+    trace_state.spans, trace_state.stack = trace[0], list(trace[1])
+    try:
+        return func(*args)
+    finally:
+        trace_state.spans = None
+
+
+def current_trace():
+    """
+    Get the query traced on this thread, to pass to traced_call().
+
+    Returns:
+        (spans, stage names) tuple, or None if no query is traced
+    """
+    spans = getattr(trace_state, 'spans', None)
+    return None if spans is None else (spans, tuple(trace_state.stack))
+
+
+def current_rss_mb():
+    """
+    Get this process's resident memory.
+
+    Returns:
+        resident set size in MB (float), or None if not available
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Peak rather than current RSS, in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+@contextlib.contextmanager
+def query_trace(label):
+    """
+    Trace one query: collect its stage spans, then print a per-stage
+    breakdown and, with PROFILE_DIR set, write a JSON trace (Chrome trace
+    event format) and a cProfile dump for it.
+
+    Does nothing when PROFILE_STAGES is off.
+
+    Arguments:
+        label -- description of the query, e.g. 'Chicago Jan all' (str)
+    """
+    global trace_query_count
+    if not PROFILE_STAGES:
+        yield
+        return
+    spans = trace_state.spans = []
+    trace_state.stack = []
+    with trace_count_lock:
+        trace_query_count += 1
+        number = trace_query_count
+    profiler = None
+    if PROFILE_DIR:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with stage_span('query'):
+            yield
+    finally:
+        trace_state.spans = None
+        if profiler is not None:
+            profiler.disable()
+        print_trace_breakdown(label, spans)
+        if PROFILE_DIR:
+            write_query_trace(label, spans, profiler, number)
+
+
+def print_trace_breakdown(label, spans):
+    """
+    Print the time and memory of each stage of a traced query.
+
+    Stages called repeatedly (e.g. per chunk) are summed per parent stage.
+
+    Arguments:
+        label -- description of the query (str)\n
+        spans -- the query's spans, see recorded_stage_span()
+    """
+    query_seconds = max(spans[-1]['seconds'], 1e-9)
+    # Spans finish child first, so list them in start order.
+    rows = {}
+    for span in sorted(spans, key=lambda s: s['start']):
+        row = rows.setdefault(span['path'], {'calls': 0, 'seconds': 0.0})
+        row['calls'] += 1
+        row['seconds'] += span['seconds']
+        row['rss_mb'] = span['rss_mb']
+    print('\n[Profile of query {label}]'.format(label=label))
+    print('{:<44}{:>7}{:>11}{:>7}{:>10}'.format(
+        'stage', 'calls', 'ms', '%', 'RSS MB'))
+    for stage_path, row in rows.items():
+        print('{:<44}{:>7}{:>11.1f}{:>6.1f}%{:>10}'.format(
+            '  ' * (len(stage_path)-1) + stage_path[-1], row['calls'],
+            row['seconds'] * 1000, 100 * row['seconds'] / query_seconds,
+            '-' if row['rss_mb'] is None else
+            '{:.1f}'.format(row['rss_mb'])))
+
+
+def write_query_trace(label, spans, profiler, number):
+    """
+    Write a traced query's JSON trace and cProfile dump to PROFILE_DIR, as
+    query-<n>.trace.json and query-<n>.prof.
+
+    The JSON trace opens in chrome://tracing or https://ui.perfetto.dev,
+    with a track per thread that ran stages of the query.
+
+    Arguments:
+        label -- description of the query (str)\n
+        spans -- the query's spans, see recorded_stage_span()\n
+        profiler -- cProfile.Profile of the query's own thread\n
+        number -- the query's number, n (int)
+    """
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    base = os.path.join(PROFILE_DIR, 'query-{n:04d}'.format(n=number))
+    t0 = min(span['start'] for span in spans)
+    tids = {}
+    events = [{'name': span['name'], 'ph': 'X', 'pid': os.getpid(),
+               'tid': tids.setdefault(span['thread'], len(tids)),
+               'ts': (span['start'] - t0) * 1e6,
+               'dur': span['seconds'] * 1e6,
+               'args': {'rss_mb': span['rss_mb']}}
+              for span in sorted(spans, key=lambda s: s['start'])]
+    with open(base + '.trace.json', 'w') as f:
+        json.dump({'traceEvents': events,
+                   'otherData': {'query': label}}, f)
+    profiler.dump_stats(base + '.prof')
+    print('[Wrote {base}.trace.json and {base}.prof]'.format(base=base))
+
+
+def print_bikeshare_df_page(df, index, positions=None, page_size=None):
     """
-    Print rows of df param dataframe, using index param and
-    DF_OUTPUT_PAGE_SIZE to print specific rows via df.iloc().
+    Page through rows of df param dataframe, starting at row index.
 
-    This calls get_pager_input() to set newindex which controls scrolling
-    forward or back, or exit.
-    If newindex is valid, recursively calls itself using newindex.
-    Also check the current index to prevant scrolling outside of dataframe
+    Pages are sliced straight from df on demand: with positions (the row
+    positions matching the active filter, see filter_positions()) df can
+    be the cached unfiltered city data, so no filtered copy is made and
+    memory stays the same however far the user scrolls.
+    This loops calling get_pager_input() to get the next index which
+    controls scrolling forward or back, jumping to a page, or exit.
+    Also check the current index to prevent scrolling outside of dataframe
     start or end this method doesn't return anything.
 
     Arguments:
         df -- the dataframe
         index -- int to point to specific range of rows in the dataframe
+        positions -- row positions in df to page through (default: all)
+        page_size -- rows per page (default: DF_OUTPUT_PAGE_SIZE)
     """
-    if index < 0:
-        index = 0  # Prevent backscrolling past first line of the df.
-    if (index < (len(df)-DF_OUTPUT_PAGE_SIZE)):
-        print(df.iloc[index:index+DF_OUTPUT_PAGE_SIZE])
-        newindex = get_pager_input(index)
-        if newindex is not None:
-            print_bikeshare_df_page(df, newindex)
-    else:
-        print('\nEnd of dataframe.\n')
+    page_size = page_size or DF_OUTPUT_PAGE_SIZE
+    row_count = len(df) if positions is None else len(positions)
+    page_count = -(-row_count // page_size)
+    while index is not None:
+        if index < 0:
+            index = 0  # Prevent backscrolling past first line of the df.
+        if index >= row_count:
+            print('\nEnd of dataframe.\n')
+            return
+        with stage_span('pager page'):
+            end = min(index+page_size, row_count)
+            if positions is None:
+                page = df.iloc[index:end]
+            else:
+                page = df.iloc[positions[index:end]]
+            print(page)
+            print('[Page {page} of {pages}, rows {first}-{last} of {rows}]'.
+                  format(page=index//page_size+1, pages=page_count,
+                         first=index+1, last=end, rows=row_count))
+        index = get_pager_input(index, page_size, row_count)
 
 
-def get_pager_input(index):
+def get_pager_input(index, page_size=None, row_count=None):
     """
     Get user input while user is viewing pages of the filtered dataframe.
 
@@ -136,26 +548,34 @@ def get_pager_input(index):
     Arguments:
         index -- the current index value pointing to the first row of the
         dataframe page being viewed
+        page_size -- rows per page (default: DF_OUTPUT_PAGE_SIZE)
+        row_count -- number of rows, so page jumps stop at the last page
 
     Returns:
-        new index value: None aborts viewing, or index +/- by
-        DF_OUTPUT_PAGE_SIZE for view of next or prev df page
+        new index value: None aborts viewing, index +/- by page_size for
+        view of next or prev df page, or the first row of a page number
     """
+    page_size = page_size or DF_OUTPUT_PAGE_SIZE
     more_prompt = input('\nPress [Enter] key to view next page,' +
                         ' [b] to view previous page, ' +
-                        'or enter [q] to exit ...\n')
-    if more_prompt[0:1] in PAGER_VIEW_INPUTS:
+                        'a page number to jump to it, ' +
+                        'or enter [q] to exit ...\n').strip()
+    if more_prompt.isdigit() and int(more_prompt) > 0:
+        newindex = (int(more_prompt)-1)*page_size
+        if row_count is not None and newindex >= row_count:
+            newindex = max(row_count-1, 0) // page_size * page_size
+    elif more_prompt[0:1] in PAGER_VIEW_INPUTS:
         match more_prompt[0:1]:
             case '':
-                newindex = index+DF_OUTPUT_PAGE_SIZE
+                newindex = index+page_size
             case 'b':
-                newindex = index-DF_OUTPUT_PAGE_SIZE
+                newindex = index-page_size
             case 'q':
                 newindex = None
                 print('\n[Exiting query results view]')
     else:
         print('Invalid input, please try again')
-        newindex = get_pager_input(index)
+        newindex = get_pager_input(index, page_size, row_count)
     return newindex
 
 
@@ -168,10 +588,11 @@ def input_city():
     recursively until getting a valid input.
 
     Returns:
-       'Chicago' | 'Washington DC' | 'New York city' (str)
+       'Chicago' | 'Washington DC' | 'New York city' | ALL_CITIES (str)
     """
-    city_prompt = input('\nWhich city Chicago [C], New York [N], or ' +
-                        'Washington [W] would you like to select? ')
+    city_prompt = input('\nWhich city Chicago [C], New York [N], ' +
+                        'Washington [W], or all of them to compare [A] ' +
+                        'would you like to select? ')
     city_char = city_prompt[0:1].lower()
     if city_char in CITY__OPT_INPUTS:
         match city_char:
@@ -181,6 +602,8 @@ def input_city():
                 city = 'Washington DC'
             case 'n':
                 city = 'New York city'
+            case 'a':
+                city = ALL_CITIES
         result = city
     else:
         print('Invalid input, please try again')
@@ -193,7 +616,7 @@ def input_month():
     Get month filter option from user.
 
     Options match 3 char abbr's for months: ['Jan'], ['Feb'], .. ['Dec']
-    (calendar.month_abbr[1:13]).
+    (keys of MONTH_NUMBERS).
     If invalid input received, this method just will keep calling itself
     recursively until getting a valid input.
 
@@ -204,7 +627,7 @@ def input_month():
                          '(enter the first 3 letters: ' +
                          '[Jan], [Feb], .. [Dec]): ')
     month_entered = month_prompt[0:3].title()
-    if month_entered in calendar.month_abbr[1:13]:
+    if month_entered in MONTH_NUMBERS:
         result = month_entered
     else:
         print('Invalid input, please try again')
@@ -216,17 +639,17 @@ def input_filter_opt():
     """
     Get data filter option from user.
 
-    Options are to filter by month [M], day [D], both month and day [B], or
-    not at all/all rows [N].
+    Options are to filter by month [M], day [D], both month and day [B],
+    time window [T], or not at all/all rows [N].
     If invalid input received, this method just will keep calling itself
     recursively until getting a valid input.
 
     Returns:
-        'm'|'d'|'b'|'n' (1 char string)
+        'm'|'d'|'b'|'t'|'n' (1 char string)
     """
     filter_prompt = input('\nWould you like to filter city data ' +
                           'by month [M], day [D], both month & day [B], ' +
-                          'or not at all [N]? ')
+                          'time window [T], or not at all [N]? ')
     filter_entered = filter_prompt[0:1].lower()
     if filter_entered in FILTER_OPT_INPUTS:
         result = filter_entered
@@ -249,7 +672,7 @@ def input_day_of_week():
     dow_prompt = input('\nPlease specify the day of week ' +
                        '(first 3 letters: [Mon], [Tue], .. [Sun]): ')
     dow_entered = dow_prompt[0:3].title()
-    if dow_entered in calendar.day_abbr[0:7]:
+    if dow_entered in WEEKDAY_NUMBERS:
         result = dow_entered
     else:
         print('Invalid input, please try again')
@@ -257,6 +680,47 @@ def input_day_of_week():
     return result
 
 
+def input_time_window():
+    """
+    Get a time window filter from the user: a date range or the last
+    days/weeks of data, a start hour range and a set of weekdays, each of
+    which can be left empty.
+
+    If invalid input received, this method just will keep calling itself
+    recursively until getting a valid input.
+
+    Returns:
+        time window (dict), see time_window()
+    """
+    dates_prompt = input('\nPlease specify the dates, e.g. 2017-03-01 to ' +
+                         '2017-03-31, 2017-03-05, last 14d or last 2w ' +
+                         '(or Enter for any date): ').strip()
+    hours_prompt = input('Please specify the start hours, e.g. 7-9 for ' +
+                         '7:00 to 8:59 (or Enter for any hour): ').strip()
+    days_prompt = input('Please specify the days, e.g. weekdays, ' +
+                        'weekends, mon-fri or sat,sun ' +
+                        '(or Enter for any day): ').strip()
+    try:
+        start = end = last = None
+        if dates_prompt.lower().startswith('last'):
+            last = parse_window_span(dates_prompt[4:])
+        elif dates_prompt:
+            dates = dates_prompt.lower().split(' to ')
+            start = parse_window_date(dates[0])
+            end = parse_window_date(dates[-1])
+        window = time_window(
+            start, end, last,
+            parse_hours(hours_prompt) if hours_prompt else None,
+            parse_weekdays(days_prompt) if days_prompt else None)
+    except argparse.ArgumentTypeError as err:
+        print('Invalid input ({err}), please try again'.format(err=err))
+        return input_time_window()
+    if window is None:
+        print('Invalid input, please enter at least one of them')
+        window = input_time_window()
+    return window
+
+
 def confirm_df_view():
     """
     Ask user if they want to view the dataframe resulting from the query.
@@ -292,10 +756,18 @@ def get_filters():
         day
             name of the day of week to filter by,
             or "all" to apply no day filter (str)
+        window
+            time window (dict) from input_time_window(), or None
     """
     day = 'all'
     month = 'all'
+    window = None
     city = input_city()
+    # Start loading while the user picks the filters.
+    if city == ALL_CITIES:
+        prefetch_cities(list(CITY_DATA), rows=False)
+    else:
+        prefetch_cities([city])
 
     match input_filter_opt():
         case 'd':
@@ -318,16 +790,27 @@ def get_filters():
             print('\n------- Rental Summary Statistics & Dataset Rows for ' +
                   '{cname} in {monthstr} on {daystr}s -------\n'.
                   format(cname=city, monthstr=month_name, daystr=weekday_name))
+        case 't':
+            window = input_time_window()
+            print('\n------- Rental Summary Statistics & Dataset Rows for ' +
+                  '{cname}, {wstr} -------\n'.
+                  format(cname=city, wstr=window_label(window)))
         case 'n': print('\n------- All rentals for city {cname} -------\n'.
                         format(cname=city))
-    return city, month, day
+    return city, month, day, window
 
 
-def load_data(city, month, day):
+@traced_stage
+def load_data(city, month, day, pushdown=None):
     """
     Load data for the specified city and filters by month and/or
     day if applicable.
 
+    The parsed, unfiltered city data comes from load_city_df(), which uses
+    the in-process and on-disk caches. With pushdown, a filtered query for
+    a city that isn't cached yet streams the CSV through
+    read_city_csv_filtered() instead, so only matching rows are kept.
+
     Arguments:
         city
             name of the city to analyze, i.e. which CSV file to read (str)
@@ -337,18 +820,130 @@ def load_data(city, month, day):
         day
             name of the day of week to filter by, or "all" to apply no day
             filter (str)
+        pushdown
+            True/False to override PUSHDOWN_FILTERS (bool)
 
     Returns:
         df
             dataframe containing city data filtered by month and day
     """
-    city_csv = CITY_DATA[city]
-    df = pd.read_csv(city_csv, delimiter=',', index_col=0)
-    # Call update_df_columns below to make needed changes on the dataframe.
-    df = update_df_columns(month, day, df)
+    if pushdown is None:
+        pushdown = PUSHDOWN_FILTERS
+    if (pushdown and (month != 'all' or day != 'all') and
+            city not in city_df_cache and read_cache_manifest(city) is None):
+        return read_city_csv_filtered(city, month, day)
+    df = load_city_df(city)
+    if month == 'all' and day == 'all':
+        # Shallow copy, so columns added later don't leak into the cache.
+        return df.copy(deep=False)
+    df = filter_df(month, day, df)
+    return df
+
+
+@traced_stage
+def read_city_csv(city, compact=True, path=None):
+    """
+    Read a city CSV file and parse/derive the columns the app needs.
+
+    Arguments:
+        city -- key of CITY_DATA (str)\n
+        compact -- convert to compact dtypes via compact_df_dtypes() (bool)\n
+        path -- CSV file to read instead of the city's, e.g. new rows to
+                ingest (str)
+
+    Returns:
+        unfiltered dataframe with parsed datetime and derived columns
+    """
+    city_csv = path or CITY_DATA[city]
+    with stage_span('pd.read_csv'):
+        df = pd.read_csv(city_csv, delimiter=',', index_col=0)
+    df = prepare_df_columns(df)
+    if compact:
+        df = compact_df_dtypes(df)
     return df
 
 
+@traced_stage
+def read_city_csv_filtered(city, month, day, chunksize=None):
+    """
+    Read a city CSV in chunks, applying the month/day filter to each chunk.
+
+    Only Start Time is parsed for every row; End Time and the derived
+    columns are only built for rows that pass the filter, so memory use
+    follows the size of the result rather than the size of the file.
+
+    Arguments:
+        city
+            key of CITY_DATA (str)
+        month
+            month (3 char str, e.g. 'Jan') or 'all'
+        day
+            day (3 char str, e.g. 'Mon') or 'all'
+        chunksize
+            rows per chunk, defaults to READ_CHUNK_SIZE (int)
+
+    Returns:
+        filtered dataframe, same as filter_df() on the whole file
+    """
+    chunks = list(read_city_csv_chunks(city, month, day, chunksize))
+    # Compact after concatenating, so all chunks share the same categories.
+    return compact_df_dtypes(pd.concat(chunks))
+
+
+def read_city_csv_chunks(city, month, day, chunksize=None):
+    """
+    Read a city CSV in chunks and yield the rows of each chunk that pass
+    the month/day filter, prepared by prepare_df_columns().
+
+    Arguments:
+        city
+            key of CITY_DATA (str)
+        month
+            month (3 char str, e.g. 'Jan') or 'all'
+        day
+            day (3 char str, e.g. 'Mon') or 'all'
+        chunksize
+            rows per chunk, defaults to READ_CHUNK_SIZE (int)
+
+    Returns:
+        iterator of prepared dataframes, one per chunk
+    """
+    reader = pd.read_csv(CITY_DATA[city], delimiter=',', index_col=0,
+                         chunksize=chunksize or READ_CHUNK_SIZE)
+    for chunk in reader:
+        start_times = pd.to_datetime(chunk['Start Time'],
+                                     format='%Y-%m-%d %H:%M:%S')
+        mask = month_day_mask(month, day, start_times)
+        chunk = chunk[mask]
+        chunk['Start Time'] = start_times[mask]
+        yield prepare_df_columns(chunk)
+
+
+def month_day_mask(month, day, start_times):
+    """
+    Get the boolean mask of start times matching the month/day filter.
+
+    Arguments:
+        month
+            month (3 char str, e.g. 'Jan') or 'all'
+        day
+            day (3 char str, e.g. 'Mon') or 'all'
+        start_times
+            datetime Series of trip start times
+
+    Returns:
+        boolean Series aligned with start_times
+    """
+    mask = pd.Series(True, index=start_times.index)
+    if month != 'all':
+        monthnum = MONTH_NUMBERS[month.title()]
+        mask &= start_times.dt.month == monthnum
+    if day != 'all':
+        mask &= start_times.dt.dayofweek == WEEKDAY_NUMBERS[day]
+    return mask
+
+
+@traced_stage
 def update_df_columns(month, day, df):
     """
     Modify & add new df columns for filters and summary stat calc
@@ -368,7 +963,22 @@ def update_df_columns(month, day, df):
     Returns:
        modified dataframe (df)
     """
-    # Convert Start and End Time columns to datetime.
+    df = prepare_df_columns(df)
+    return filter_df(month, day, df)
+
+
+@traced_stage
+def prepare_df_columns(df):
+    """
+    Convert Start and End Time columns to datetime and add the derived
+    Month Number and Weekday Name columns.
+
+    Arguments:
+        df -- dataframe as read from a city CSV
+
+    Returns:
+        the updated dataframe (df)
+    """
     df['Start Time'] = pd.to_datetime(df['Start Time'],
                                       format='%Y-%m-%d %H:%M:%S')
     df['End Time'] = pd.to_datetime(df['End Time'], format='%Y-%m-%d %H:%M:%S')
@@ -376,243 +986,4050 @@ def update_df_columns(month, day, df):
     # Now we can create new derived columns for filter options below.
     df['Month Number'] = (df['Start Time']).dt.month
     df['Weekday Name'] = (df['Start Time']).dt.day_name()
-
-    if month != 'all':
-        # Use the index of the months list to get the corresponding int.
-        monthnum = calendar.month_abbr[1:13].index(month.title())+1
-        # filter by month within the dataframe
-        df = df[df['Month Number'] == monthnum]
-
-    if day != 'all':
-        # Filter by weekday within the dataframe.
-        weekday_str = weekday_num2str(day)
-        df = df[df['Weekday Name'] == weekday_str]
+    df['Start Hour'] = (df['Start Time']).dt.hour
     return df
 
 
-def time_stats(df, month, day):
+@traced_stage
+def compact_df_dtypes(df):
     """
-    Display statistics on the most frequent times of travel.
+    Convert a prepared dataframe's columns to compact dtypes.
 
-    Uses local dictionary var time_stats_dict to collect the stats,
-    then pretty-prints that.
+    Station, user type, gender and weekday names become categoricals,
+    month and hour become int8, Trip Duration becomes int32 (or stays
+    float64 if it has fractions, so sums match the ones streamed from the
+    CSV) and Birth Year becomes float32.
 
     Arguments:
-        df
-            the source dataframe
-        month
-            month filter
-        day
-            day filter
-    """
-    print('*** Most Frequent Times of Travel ***\n')
-
-    time_stats_dict = {}
-
-    # Don't bother with Busiest Month if the user has
-    # filtered the df to a specific month already.
-    if month == 'all':
-        top_month_number = df['Month Number'].value_counts().idxmax()
-        top_month = month_num2name(top_month_number)
-        time_stats_dict['Busiest month'] = top_month
-
-    # Don't bother with Busiest Weekday if the user has
-    # filtered the df to a specific day already.
-    if day == 'all':
-        top_weekday = df['Weekday Name'].value_counts().idxmax()
-        time_stats_dict['Busiest day of the week'] = top_weekday
+        df -- dataframe prepared by prepare_df_columns()
 
-    # Display the most common start hour.
-    df['Start Hour'] = df['Start Time'].dt.hour
-    top_start_hr = df['Start Hour'].value_counts().idxmax()
-    # Convert this to something more human readable.
-    if top_start_hr < 12:
-        am_pm_str = ' am'
+    Returns:
+        the converted dataframe (df)
+    """
+    for col in CATEGORY_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    df['Weekday Name'] = pd.Categorical(df['Weekday Name'],
+                                        categories=list(calendar.day_name))
+    df['Month Number'] = df['Month Number'].astype('int8')
+    df['Start Hour'] = df['Start Hour'].astype('int8')
+    duration = df['Trip Duration']
+    if (duration.notna().all() and
+            (duration % 1 == 0).all() and
+            duration.between(0, np.iinfo('int32').max).all()):
+        df['Trip Duration'] = duration.astype('int32')
     else:
-        am_pm_str = ' pm'
-        if top_start_hr > 12:
-            top_start_hr = top_start_hr-12
-    time_stats_dict['Busiest Start Hour'] = str(top_start_hr)+am_pm_str
-
-    dictionary_prettyprint(time_stats_dict)
+        df['Trip Duration'] = duration.astype('float64')
+    if 'Birth Year' in df.columns:
+        df['Birth Year'] = df['Birth Year'].astype('float32')
+    return df
 
 
-def station_stats(df):
+def df_memory_mb(df):
     """
-    Display statistics on the most popular stations and trip.
-
-    Uses local dictionary var station_stats_dict to collect the stats,
-    then pretty-prints that.
+    Get the memory used by a dataframe, including its strings.
 
     Arguments:
-        df: the source dataframe
-    """
-    print('\n*** Station Statistics ***\n')
+        df -- the dataframe
 
-    station_stats_dict = {}
+    Returns:
+        size in MB (float)
+    """
+    return df.memory_usage(index=True, deep=True).sum() / 2**20
 
-    # Display most commonly used start station.
-    top_start_station = df['Start Station'].value_counts().idxmax()
-    station_stats_dict['Most frequented Start Station'] = top_start_station
 
-    # Display most commonly used end station.
-    top_end_station = df['End Station'].value_counts().idxmax()
-    station_stats_dict['Most frequented End Station'] = top_end_station
+@traced_stage
+def filter_positions(month, day, df):
+    """
+    Get the row positions of a prepared dataframe matching the month/day
+    filter, to view or slice rows without copying the filtered dataframe.
 
-    # Display most frequent combination of start station and end station trip.
-    df['Start+End Stations'] = df.apply(lambda x: '%s to %s' %
-                                        (x['Start Station'],
-                                         x['End Station']), axis=1)
-    top_journey = df['Start+End Stations'].value_counts().idxmax()
-    station_stats_dict['Most common journey (Start+End)'] = top_journey
+    Arguments:
+        month
+            month (3 char str, e.g. 'Jan') or 'all'
+        day
+            day (3 char str, e.g. 'Mon') or 'all'
+        df
+            dataframe prepared by prepare_df_columns()
 
-    dictionary_prettyprint(station_stats_dict)
+    Returns:
+        sorted numpy array of row positions (int32 where it fits)
+    """
+    dtype = np.int32 if len(df) < 2**31 else np.int64
+    mask = np.ones(len(df), dtype=bool)
+    if month != 'all':
+        monthnum = MONTH_NUMBERS[month.title()]
+        mask &= df['Month Number'].to_numpy() == monthnum
+    if day != 'all':
+        mask &= weekday_codes(df) == WEEKDAY_NUMBERS[day]
+    return np.flatnonzero(mask).astype(dtype)
 
 
-def trip_duration_stats(df):
+def filter_subset_positions(month, day, df, positions):
     """
-    Display statistics on the total and average trip duration.
-
-    Uses local dictionary var trip_duration_dict to collect the stats,
-    then pretty-prints that.
+    Keep the row positions matching the month/day filter, looking only at
+    those rows.
 
     Arguments:
-        df -- the dataframe
-    """
-    print('\n*** Trip Duration Statistics ***\n')
-    trip_duration_dict = {}
-    # Using datetime.timedelta for more user-friendly output
-    # rather than just XXXXXXX seconds.
-    total_duration_trips = str(datetime.timedelta(
-        seconds=df['Trip Duration'].sum().round().astype(float)))
-    trip_duration_dict['Total duration of trips'] = total_duration_trips
-    mean_duration_trips = str(datetime.timedelta(
-        seconds=df['Trip Duration'].mean().round().astype(float)))
-    trip_duration_dict['Mean duration of trips'] = mean_duration_trips
+        month
+            month (3 char str, e.g. 'Jan') or 'all'
+        day
+            day (3 char str, e.g. 'Mon') or 'all'
+        df
+            dataframe prepared by prepare_df_columns()
+        positions
+            numpy array of row positions
 
-    dictionary_prettyprint(trip_duration_dict)
+    Returns:
+        numpy array of the matching positions, in the same order
+    """
+    if month != 'all':
+        monthnum = MONTH_NUMBERS[month.title()]
+        positions = positions[
+            df['Month Number'].to_numpy()[positions] == monthnum]
+    if day != 'all':
+        daynum = WEEKDAY_NUMBERS[day]
+        positions = positions[weekday_codes(df)[positions] == daynum]
+    return positions
 
 
-def user_stats(df, day):
+@traced_stage
+def query_rows(city, month, day, window=None):
     """
-    Display statistics on bikeshare users (riders).
-
-    Uses both df_column_items_dist_print() and dictionary_prettyprint() methods
-    depending on the kind of data being summarized from the dataframe column.
+    Get the rows of a query to page through or export without copying.
 
     Arguments:
-        df
-            the dataframe
+        city
+            key of CITY_DATA (str)
+        month
+            month (3 char str, e.g. 'Jan') or 'all'
         day
-            day filter ('all' or specific day)
-    """
-    print('\n*** Rider Statistics ***\n')
-    user_stats_dict = {}
-    # Display counts of user types
-    df_column_items_dist_print(df, 'User Type')
-    # Display counts of gender
-    df_column_items_dist_print(df, 'Gender')
-
-    if day == 'all':
-        print('\n* Total ridership over all weekdays (highest to lowest) *')
-        df_column_items_dist_print(df, 'Weekday Name')
-    else:
-        print('\n* Total ridership on selected day *')
-        df_column_items_dist_print(df, 'Weekday Name')
+            day (3 char str, e.g. 'Mon') or 'all'
+        window
+            time window (dict) from time_window(), or None
 
-    if 'Birth Year' in df.columns:
-        least_recent_birthyear = df['Birth Year'].min()
-        user_stats_dict['Birth year of oldest rider'] = (
-                        floor(least_recent_birthyear))
-        most_recent_birthyear = df['Birth Year'].max()
-        user_stats_dict['Birth year of youngest rider'] = (
-                        floor(most_recent_birthyear))
-        most_common_birthyear = df['Birth Year'].value_counts().idxmax()
-        user_stats_dict['Most common birth year'] = (
-                        floor(most_common_birthyear))
-        dictionary_prettyprint(user_stats_dict)
-    else:
-        print('\nSorry, no rider age data available for this city')
+    Returns:
+        (df, positions): the cached unfiltered city dataframe and the row
+        positions matching the filter, or the filtered dataframe and None
+        when the rows were read with predicate pushdown
+    """
+    # Drops the city's in-process caches if its CSV changed.
+    city_source_fingerprint(city)
+    if window is not None:
+        df = load_city_df(city)
+        return df, window_positions(month, day, window, df,
+                                    load_time_index(city, df))
+    if ((PUSHDOWN_FILTERS or OUT_OF_CORE) and
+            (month != 'all' or day != 'all') and
+            city not in city_df_cache and read_cache_manifest(city) is None):
+        return read_city_csv_filtered(city, month, day), None
+    df = load_city_df(city)
+    return df, filter_positions(month, day, df)
 
 
-def print_summary_stats(df, month, day):
+@traced_stage
+def filter_df(month, day, df):
     """
-    Print all Summary Statistics.
-
-    Top level method calling all other methods for printing Summary Statistics.
+    Apply the month and/or day filter to an already prepared dataframe.
+
+    Arguments:
+        month
+            month (3 char str, e.g. 'Jan') or 'all'
+        day
+            day (3 char str, e.g. 'Mon') or 'all'
+        df
+            dataframe prepared by prepare_df_columns()
+
+    Returns:
+       filtered dataframe (df)
+    """
+    if month != 'all':
+        # Use the index of the months list to get the corresponding int.
+        monthnum = MONTH_NUMBERS[month.title()]
+        # filter by month within the dataframe
+        df = df[df['Month Number'] == monthnum]
+
+    if day != 'all':
+        # Filter by weekday within the dataframe.
+        weekday_str = weekday_num2str(day)
+        df = df[df['Weekday Name'] == weekday_str]
+    return df
+
+
+def source_fingerprint(csv_path):
+    """
+    Get the fingerprint used to tell whether a cache of a CSV is stale.
+
+    Arguments:
+        csv_path -- path of the source CSV file (str)
+
+    Returns:
+        dict with the file's 'mtime_ns' and 'size'
+    """
+    st = os.stat(csv_path)
+    return {'mtime_ns': st.st_mtime_ns, 'size': st.st_size}
+
+
+def city_cache_dir(city):
+    """
+    Get the cache directory for a city, next to the city's CSV file.
+
+    Arguments:
+        city -- key of CITY_DATA (str)
+
+    Returns:
+        directory path (str), e.g. '.bikeshare_cache/chicago'
+    """
+    city_csv = CITY_DATA[city]
+    csv_dir, csv_name = os.path.split(city_csv)
+    return os.path.join(csv_dir, CACHE_DIR_NAME,
+                        os.path.splitext(csv_name)[0])
+
+
+def read_cache_manifest(city):
+    """
+    Read a city's cache manifest if it exists and matches its source CSV.
+
+    Arguments:
+        city -- key of CITY_DATA (str)
+
+    Returns:
+        manifest (dict), or None if the cache is missing or stale
+    """
+    manifest_path = os.path.join(city_cache_dir(city), CACHE_MANIFEST_NAME)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        fingerprint = source_fingerprint(CITY_DATA[city])
+    except (OSError, ValueError):
+        return None
+    if (manifest.get('format_version') != CACHE_FORMAT_VERSION or
+            manifest.get('source') != fingerprint):
+        return None
+    return manifest
+
+
+def write_json_atomic(path, obj):
+    """
+    Write obj as JSON to path, replacing any existing file atomically.
+
+    Arguments:
+        path -- destination file path (str)\n
+        obj -- JSON serializable object
+    """
+    tmp_path = temp_path(path)
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def temp_path(path):
+    """
+    Get a temporary file name to write path's new content to.
+
+    The name is unique per process, so parallel workers writing the same
+    cache file don't clobber each other's partial writes.
+
+    Arguments:
+        path -- destination file path (str)
+
+    Returns:
+        temporary file path (str) in the same directory
+    """
+    return '{path}.{pid}.tmp'.format(path=path, pid=os.getpid())
+
+
+def write_feather_atomic(table, path):
+    """
+    Write an Arrow table to an uncompressed Arrow IPC file atomically.
+
+    Arguments:
+        table -- pyarrow Table\n
+        path -- destination file path (str)
+    """
+    import pyarrow.feather as feather
+    tmp_path = temp_path(path)
+    feather.write_feather(table, tmp_path, compression='uncompressed')
+    os.replace(tmp_path, path)
+
+
+@traced_stage
+def write_city_cache(city, df):
+    """
+    Write a prepared city dataframe to the on-disk columnar cache.
+
+    The data is stored as an Arrow IPC (Feather v2) file so later loads
+    can memory-map it, and the manifest records the source CSV's mtime and
+    size. Does nothing if pyarrow is not installed.
+
+    Arguments:
+        city -- key of CITY_DATA (str)\n
+        df -- dataframe prepared by prepare_df_columns()
+
+    Returns:
+        the manifest (dict), or None if no cache was written
+    """
+    try:
+        import pyarrow as pa
+    except ImportError:
+        return None
+    # Fingerprint before writing, so a CSV changed meanwhile is caught.
+    fingerprint = source_fingerprint(CITY_DATA[city])
+    cache_dir = city_cache_dir(city)
+    os.makedirs(cache_dir, exist_ok=True)
+    part_name = 'part-00000.feather'
+    part_path = os.path.join(cache_dir, part_name)
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    write_feather_atomic(table, part_path)
+    manifest = {'format_version': CACHE_FORMAT_VERSION,
+                'source': fingerprint,
+                'rows': len(df),
+                'parts': [part_name]}
+    write_json_atomic(os.path.join(cache_dir, CACHE_MANIFEST_NAME), manifest)
+    return manifest
+
+
+@traced_stage
+def read_city_cache(city):
+    """
+    Load a city's prepared dataframe from the on-disk columnar cache.
+
+    Arguments:
+        city -- key of CITY_DATA (str)
+
+    Returns:
+        dataframe, or None if the cache is missing, stale or unreadable
+    """
+    manifest = read_cache_manifest(city)
+    if manifest is None:
+        return None
+    try:
+        import pyarrow as pa
+        import pyarrow.feather as feather
+        cache_dir = city_cache_dir(city)
+        tables = [feather.read_table(os.path.join(cache_dir, part),
+                                     memory_map=True)
+                  for part in manifest['parts']]
+    except (ImportError, OSError):
+        return None
+    if len(tables) > 1:
+        # Parts appended by ingest_city_csv() have their own dictionaries.
+        schema = widen_dictionary_indices(tables[0].schema)
+        tables = [table.cast(schema) for table in tables]
+    return pa.concat_tables(tables).to_pandas()
+
+
+def widen_dictionary_indices(schema):
+    """
+    Get an Arrow schema with int32 indices for all dictionary (categorical)
+    columns, so parts with different numbers of categories can be combined.
+
+    Arguments:
+        schema -- pyarrow Schema
+
+    Returns:
+        pyarrow Schema, with schema's metadata
+    """
+    import pyarrow as pa
+    fields = [field.with_type(pa.dictionary(pa.int32(),
+                                            field.type.value_type))
+              if pa.types.is_dictionary(field.type) else field
+              for field in schema]
+    return pa.schema(fields, metadata=schema.metadata)
+
+
+@traced_stage
+def write_cache_artifact(city, name, tables):
+    """
+    Persist derived tables (aggregates, indexes) in a city's on-disk cache.
+
+    The tables are written as Arrow IPC files in a subdirectory of the
+    city cache and listed in its manifest, so they go stale together with
+    the cached data. Does nothing if the city cache is missing or stale.
+
+    Arguments:
+        city -- key of CITY_DATA (str)\n
+        name -- artifact name, e.g. 'cube' (str)\n
+        tables -- dict of table name to dataframe
+
+    Returns:
+        True if the artifact was written
+    """
+    manifest = read_cache_manifest(city)
+    if manifest is None:
+        return False
+    import pyarrow as pa
+    artifact_dir = os.path.join(city_cache_dir(city), name)
+    os.makedirs(artifact_dir, exist_ok=True)
+    for table_name, df in tables.items():
+        path = os.path.join(artifact_dir, table_name + '.feather')
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        write_feather_atomic(table, path)
+    manifest.setdefault('artifacts', {})[name] = sorted(tables)
+    write_json_atomic(os.path.join(city_cache_dir(city), CACHE_MANIFEST_NAME),
+                      manifest)
+    return True
+
+
+@traced_stage
+def read_cache_artifact(city, name):
+    """
+    Load derived tables written by write_cache_artifact().
+
+    Arguments:
+        city -- key of CITY_DATA (str)\n
+        name -- artifact name, e.g. 'cube' (str)
+
+    Returns:
+        dict of table name to dataframe, or None if missing or stale
+    """
+    manifest = read_cache_manifest(city)
+    if manifest is None or name not in manifest.get('artifacts', {}):
+        return None
+    try:
+        import pyarrow.feather as feather
+        artifact_dir = os.path.join(city_cache_dir(city), name)
+        return {table_name: feather.read_table(
+                    os.path.join(artifact_dir, table_name + '.feather'),
+                    memory_map=True).to_pandas()
+                for table_name in manifest['artifacts'][name]}
+    except (ImportError, OSError):
+        return None
+
+
+@traced_stage
+def load_city_df(city):
+    """
+    Get the prepared, unfiltered dataframe for a city.
+
+    Checks the in-process city cache first, then the on-disk columnar cache
+    if it is up to date, otherwise parses the CSV and (re)builds the on-disk
+    cache. The result is kept in the in-process cache, so treat it as read
+    only.
+
+    Arguments:
+        city -- key of CITY_DATA (str)
+
+    Returns:
+        unfiltered dataframe with parsed datetime and derived columns
+    """
+    with city_load_lock(city):
+        with city_cache_lock:
+            if city in city_df_cache:
+                city_cache_counters['hits'] += 1
+                city_df_cache.move_to_end(city)
+                return city_df_cache[city][0]
+            city_cache_counters['misses'] += 1
+        df = read_city_cache(city)
+        if df is None:
+            df = read_city_csv(city)
+            write_city_cache(city, df)
+        with city_cache_lock:
+            city_cache_put(city, df)
+        return df
+
+
+def city_load_lock(city):
+    """
+    Get the lock that one city's data, cube and indexes are loaded and
+    built under, so threads don't load the same city twice while other
+    cities load concurrently.
+
+    Arguments:
+        city -- key of CITY_DATA (str)
+
+    Returns:
+        threading.RLock
+    """
+    with city_cache_lock:
+        return city_load_locks.setdefault(city, threading.RLock())
+
+
+def city_cache_put(city, df):
+    """
+    Add a city dataframe to the in-process cache.
+
+    Least recently used cities are evicted until the cache fits within
+    CITY_CACHE_BUDGET_MB. A dataframe bigger than the whole budget is not
+    cached at all.
+
+    Arguments:
+        city -- key of CITY_DATA (str)\n
+        df -- prepared, unfiltered city dataframe
+    """
+    budget = CITY_CACHE_BUDGET_MB * 2**20
+    nbytes = int(df.memory_usage(index=True, deep=True).sum())
+    city_df_cache.pop(city, None)
+    if nbytes > budget:
+        return
+    while (city_df_cache and
+           sum(n for _, n in city_df_cache.values()) + nbytes > budget):
+        city_df_cache.popitem(last=False)
+        city_cache_counters['evictions'] += 1
+    city_df_cache[city] = (df, nbytes)
+
+
+def city_cache_stats():
+    """
+    Get the in-process city cache counters and current contents.
+
+    Returns:
+        dict with 'hits', 'misses', 'evictions', 'cities' (least to most
+        recently used), 'bytes' and 'budget_bytes'
+    """
+    stats = dict(city_cache_counters)
+    stats['cities'] = list(city_df_cache)
+    stats['bytes'] = sum(n for _, n in city_df_cache.values())
+    stats['budget_bytes'] = CITY_CACHE_BUDGET_MB * 2**20
+    return stats
+
+
+def city_cache_clear():
+    """Empty the in-process city cache and reset its counters."""
+    city_df_cache.clear()
+    for counter in city_cache_counters:
+        city_cache_counters[counter] = 0
+
+
+def build_city_caches(cities):
+    """
+    Pre-build the on-disk columnar cache and the derived tables listed in
+    CACHE_ARTIFACTS (aggregate cube, Start Time and station indexes and
+    time series rollups) for the given cities.
+
+    Arguments:
+        cities -- list of CITY_DATA keys
+    """
+    for city in cities:
+        manifest = read_cache_manifest(city)
+        if manifest is None:
+            df = read_city_csv(city, compact=False)
+            before_mb = df_memory_mb(df)
+            df = compact_df_dtypes(df)
+            manifest = write_city_cache(city, df)
+            if manifest is None:
+                print('Sorry, the columnar cache needs the pyarrow package')
+                return
+            print('{cname}: cached {rows} rows in {cdir}, in memory '
+                  '{before:.1f} MB -> {after:.1f} MB with compact dtypes'.
+                  format(cname=city, rows=len(df), cdir=city_cache_dir(city),
+                         before=before_mb, after=df_memory_mb(df)))
+        else:
+            df = None
+        missing = [name for name in CACHE_ARTIFACTS
+                   if name not in manifest.get('artifacts', {})]
+        if not missing:
+            print('{cname}: cache is up to date'.format(cname=city))
+            continue
+        if df is None:
+            df = load_city_df(city)
+        for name in missing:
+            write_cache_artifact(city, name, build_cache_artifact(name, df))
+        print('{cname}: built {names}'.format(cname=city,
+                                              names=', '.join(missing)))
+
+
+def build_cache_artifact(name, df):
+    """
+    Build one of the derived tables listed in CACHE_ARTIFACTS.
+
+    Arguments:
+        name -- 'cube', 'time_index', 'station_index' or 'rollups' (str)\n
+        df -- prepared, unfiltered city dataframe
+
+    Returns:
+        dict of table name to dataframe, for write_cache_artifact()
+    """
+    match name:
+        case 'cube':
+            return build_city_cube(df)
+        case 'time_index':
+            return build_time_index(df)
+        case 'station_index':
+            return build_station_index(df)
+        case 'rollups':
+            return build_rollups(df)
+
+
+def merge_cache_artifact(name, tables, delta_tables, offset):
+    """
+    Combine one of the derived tables listed in CACHE_ARTIFACTS with the
+    same tables built from rows appended to the city's data.
+
+    Arguments:
+        name -- 'cube', 'time_index', 'station_index' or 'rollups' (str)\n
+        tables -- dict of table name to dataframe, of the existing rows\n
+        delta_tables -- dict of table name to dataframe, of the new rows\n
+        offset -- number of existing rows, i.e. the position of the first
+                  new row (int)
+
+    Returns:
+        dict of table name to dataframe, same as building them from all
+        the rows
+    """
+    match name:
+        case 'cube':
+            return merge_city_cube(tables, delta_tables)
+        case 'time_index':
+            return merge_time_index(tables, delta_tables, offset)
+        case 'station_index':
+            return merge_station_index(tables, delta_tables, offset)
+        case 'rollups':
+            return merge_rollups(tables, delta_tables)
+
+
+def merge_city_cube(cube, other):
+    """
+    Add up two aggregate cubes, e.g. of a city's rows and of new rows.
+
+    Arguments:
+        cube -- cube (dict) from build_city_cube()\n
+        other -- cube (dict) to add
+
+    Returns:
+        the combined cube (dict)
+    """
+    merged = {}
+    for table_name in cube.keys() | other.keys():
+        if table_name not in cube or table_name not in other:
+            merged[table_name] = (cube.get(table_name) if table_name in cube
+                                  else other[table_name])
+            continue
+        merged[table_name] = merge_count_tables(
+            cube[table_name], other[table_name],
+            ['cell'] + CUBE_COUNT_TABLES.get(table_name, [])).sort_values(
+                'cell', kind='stable', ignore_index=True)
+    return merged
+
+
+def merge_count_tables(table, other, keys):
+    """
+    Add up two tables of counts (or sums) per unique key.
+
+    Rows of other with a key already in table are added to that row, the
+    rest are appended. The keys are turned into one int64 code per row,
+    so matching them is a hash lookup of ints.
+
+    Arguments:
+        table -- dataframe with unique keys\n
+        other -- dataframe with the same columns and unique keys\n
+        keys -- key column names, the other columns are added up
+
+    Returns:
+        the combined dataframe
+    """
+    table, other = table.copy(), other.copy()
+    codes = np.zeros(len(table), dtype=np.int64)
+    other_codes = np.zeros(len(other), dtype=np.int64)
+    for col in keys:
+        if isinstance(table[col].dtype, pd.CategoricalDtype):
+            categories = pd.api.types.union_categoricals(
+                [table[col], other[col]], ignore_order=True).categories
+            table[col] = table[col].cat.set_categories(categories)
+            other[col] = other[col].cat.set_categories(categories)
+            col_codes = table[col].cat.codes.to_numpy()
+            other_col_codes = other[col].cat.codes.to_numpy()
+        else:
+            both, uniques = pd.factorize(
+                np.concatenate([table[col].to_numpy(),
+                                other[col].to_numpy()]))
+            categories = uniques
+            col_codes, other_col_codes = both[:len(table)], both[len(table):]
+        codes = codes*len(categories) + col_codes
+        other_codes = other_codes*len(categories) + other_col_codes
+    # Look the table's keys up in the (usually much smaller) other table.
+    found = pd.Index(other_codes).get_indexer(codes)
+    matched = found >= 0
+    for col in table.columns.difference(keys, sort=False):
+        values = table[col].to_numpy().copy()
+        values[matched] += other[col].to_numpy()[found[matched]]
+        table[col] = values
+    added = np.ones(len(other), dtype=bool)
+    added[found[matched]] = False
+    return pd.concat([table, other[added]], ignore_index=True)
+
+
+def merge_sorted_positions(keys, positions, other_keys, other_positions,
+                           offset):
+    """
+    Merge two runs of row positions each sorted by key, positions of the
+    second run being offset.
+
+    On ties the first run's positions come first, as they would from
+    sorting all the rows at once. Sorting two sorted runs with numpy's
+    stable sort (timsort) takes linear time.
+
+    Arguments:
+        keys, positions -- first run: numpy arrays sorted by keys\n
+        other_keys, other_positions -- second run: numpy arrays\n
+        offset -- added to other_positions (int)
+
+    Returns:
+        (keys, positions) numpy arrays of the merged run
+    """
+    keys = np.concatenate([keys, other_keys])
+    dtype = np.int32 if len(keys) < 2**31 else np.int64
+    positions = np.concatenate([positions.astype(dtype),
+                                other_positions.astype(dtype) + offset])
+    order = np.argsort(keys, kind='stable')
+    return keys[order], positions[order]
+
+
+def merge_time_index(index, other, offset):
+    """
+    Merge the Start Time index of a city's rows with that of new rows.
+
+    Arguments:
+        index -- index (dict) from build_time_index()\n
+        other -- index (dict) of the new rows\n
+        offset -- number of rows index covers (int)
+
+    Returns:
+        index (dict) of all the rows
+    """
+    def merged(table_name, begin=0, end=None, other_begin=0, other_end=None):
+        table, other_table = index[table_name], other[table_name]
+        starts, positions = merge_sorted_positions(
+            table['start'].to_numpy()[begin:end],
+            table['position'].to_numpy()[begin:end],
+            other_table['start'].to_numpy()[other_begin:other_end],
+            other_table['position'].to_numpy()[other_begin:other_end],
+            offset)
+        return pd.DataFrame({'position': positions, 'start': starts})
+
+    offsets = index['bucket_offsets']['offset'].to_numpy()
+    other_offsets = other['bucket_offsets']['offset'].to_numpy()
+    bucket_slices = [merged('bucket_order', offsets[bucket],
+                            offsets[bucket+1], other_offsets[bucket],
+                            other_offsets[bucket+1])
+                     for bucket in range(CUBE_WEEK_CELLS)]
+    return {'time_order': merged('time_order'),
+            'bucket_order': pd.concat(bucket_slices, ignore_index=True),
+            'bucket_offsets': pd.DataFrame({'offset': offsets +
+                                            other_offsets})}
+
+
+def merge_station_index(index, other, offset):
+    """
+    Merge the station index of a city's rows with that of new rows.
+
+    Arguments:
+        index -- index (dict) from build_station_index()\n
+        other -- index (dict) of the new rows\n
+        offset -- number of rows index covers (int)
+
+    Returns:
+        index (dict) of all the rows
+    """
+    old_stations = index['stations']['station'].to_numpy().astype(str)
+    new_stations = other['stations']['station'].to_numpy().astype(str)
+    stations = np.union1d(old_stations, new_stations)
+    merged = {}
+    counts = {}
+    for table_name in ['departures', 'arrivals']:
+        # Key each position by its station's number in the merged list.
+        keys = np.repeat(np.searchsorted(stations, old_stations),
+                         index['stations'][table_name].to_numpy())
+        other_keys = np.repeat(np.searchsorted(stations, new_stations),
+                               other['stations'][table_name].to_numpy())
+        keys, positions = merge_sorted_positions(
+            keys, index[table_name]['position'].to_numpy(),
+            other_keys, other[table_name]['position'].to_numpy(), offset)
+        counts[table_name] = np.bincount(keys, minlength=len(stations))
+        merged[table_name] = pd.DataFrame({'position': positions})
+    merged['stations'] = pd.DataFrame({'station': stations,
+                                       'departures': counts['departures'],
+                                       'arrivals': counts['arrivals']})
+    return merged
+
+
+def append_csv_rows(csv_path, path):
+    """
+    Append the rows of a CSV file to another CSV with the same header.
+
+    Arguments:
+        csv_path -- CSV file to append to (str)\n
+        path -- CSV file with the new rows (str)
+
+    Returns:
+        number of bytes appended (int)
+    """
+    with open(path, 'rb') as src, open(csv_path, 'rb+') as dst:
+        # Skip the header.
+        src.readline()
+        appended = 0
+        dst.seek(-1, os.SEEK_END)
+        if dst.read(1) != b'\n':
+            appended += dst.write(b'\n')
+        for block in iter(lambda: src.read(2**20), b''):
+            appended += dst.write(block)
+    return appended
+
+
+@traced_stage
+def ingest_city_csv(city, path):
+    """
+    Append the rows of a CSV file to a city's data, updating its caches.
+
+    Only the new rows are parsed: they are added to the on-disk cache as
+    a new part, and the cached cube and indexes are merged with ones built
+    from the new rows, so the result is the same as rebuilding from the
+    whole CSV. A city without an up to date cache just gets the rows
+    appended, as does a city whose cached column types can't hold the new
+    rows (e.g. fractional trip durations), which is then rebuilt.
+
+    Arguments:
+        city -- key of CITY_DATA (str)\n
+        path -- CSV file with new rows and the city CSV's header (str)
+
+    Returns:
+        number of rows ingested (int)
+    """
+    city_csv = CITY_DATA[city]
+    with open(path, 'rb') as src, open(city_csv, 'rb') as dst:
+        if src.readline().strip() != dst.readline().strip():
+            raise ValueError('{path} has different columns than {csv}'.
+                             format(path=path, csv=city_csv))
+    manifest = read_cache_manifest(city)
+    delta = read_city_csv(city, path=path)
+    city_caches_forget(city)
+    if manifest is None:
+        append_csv_rows(city_csv, path)
+        return len(delta)
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    cache_dir = city_cache_dir(city)
+    base_schema = feather.read_table(os.path.join(cache_dir,
+                                                  manifest['parts'][0]),
+                                     memory_map=True).schema
+    try:
+        table = pa.Table.from_pandas(delta, preserve_index=True).cast(
+            widen_dictionary_indices(base_schema))
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError, ValueError):
+        append_csv_rows(city_csv, path)
+        build_city_caches([city])
+        return len(delta)
+    artifacts = {name: merge_cache_artifact(
+                     name, read_cache_artifact(city, name),
+                     build_cache_artifact(name, delta), manifest['rows'])
+                 for name in manifest.get('artifacts', {})}
+    # Drop the artifacts from the manifest until they're rewritten, so an
+    # interrupted ingest leaves them missing rather than out of date.
+    manifest.pop('artifacts', None)
+    manifest_path = os.path.join(cache_dir, CACHE_MANIFEST_NAME)
+    write_json_atomic(manifest_path, manifest)
+    part_name = 'part-{n:05d}.feather'.format(n=len(manifest['parts']))
+    write_feather_atomic(table, os.path.join(cache_dir, part_name))
+    append_csv_rows(city_csv, path)
+    manifest['source'] = source_fingerprint(city_csv)
+    manifest['rows'] += len(delta)
+    manifest['parts'].append(part_name)
+    write_json_atomic(manifest_path, manifest)
+    for name, tables in artifacts.items():
+        write_cache_artifact(city, name, tables)
+    return len(delta)
+
+
+def city_caches_forget(city):
+    """
+    Drop a city's data, cube, indexes and rollups from the in-process
+    caches.
+
+    Arguments:
+        city -- key of CITY_DATA (str)
+    """
+    city_df_cache.pop(city, None)
+    for cache in [city_cube_cache, city_time_index_cache,
+                  city_station_index_cache, city_rollups_cache]:
+        cache.pop(city, None)
+
+
+@traced_stage
+def aggregate_trips(df):
+    """
+    Compute the mergeable aggregates behind all the summary statistics.
+
+    Month, weekday, start hour, user type and gender are combined into one
+    integer cell code per row and counted with a single np.bincount, so one
+    pass over the rows yields the counts for all five columns. Stations,
+    journeys and birth years are counted once each. Every count is a
+    Series, so aggregates of separate chunks of trips can be added up.
+    With APPROXIMATE on, the station and journey counts are shrunk with
+    sketch_aggregates().
+
+    Arguments:
+        df -- dataframe prepared by prepare_df_columns(), possibly filtered
+
+    Returns:
+        aggregates (dict) with 'trip_count', 'duration_sum' and
+        'duration_count', plus count Series 'month_counts',
+        'weekday_counts', 'hour_counts', 'user_type_counts',
+        'gender_counts', 'start_station_counts', 'end_station_counts',
+        'journey_counts' and 'birth_year_counts' (gender and birth year
+        are None when the city has no such column), the trip counts per
+        duration bucket 'duration_buckets' (array), the undercounts of
+        SKETCH_COUNTS (0 unless approximate) and whether the counts were
+        'sketched'
+    """
+    has_gender = 'Gender' in df.columns
+    user_codes, user_types = pd.factorize(df['User Type'])
+    if has_gender:
+        gender_codes, genders = pd.factorize(df['Gender'])
+    else:
+        gender_codes, genders = np.full(len(df), -1), []
+    # Missing values get code -1, shift by one so they have a cell too.
+    dims = (13, 7, 24, len(user_types)+1, len(genders)+1)
+    cell_codes = np.ravel_multi_index(
+        (df['Month Number'].to_numpy(dtype=np.intp),
+         weekday_codes(df),
+         df['Start Hour'].to_numpy(dtype=np.intp),
+         user_codes+1, gender_codes+1), dims)
+    cells = np.bincount(cell_codes, minlength=np.prod(dims)).reshape(dims)
+
+    def cell_totals(axis, labels):
+        other_axes = tuple(a for a in range(len(dims)) if a != axis)
+        totals = cells.sum(axis=other_axes)
+        if axis >= 3:
+            totals = totals[1:]  # Leave out the missing value cell.
+        series = pd.Series(totals, index=pd.Index(list(labels), dtype=object))
+        return series[series > 0]
+
+    duration = df['Trip Duration'].astype('float64')
+    aggs = {
+        'trip_count': len(df),
+        'duration_sum': float(duration.sum()),
+        'duration_count': int(duration.count()),
+        'month_counts': cell_totals(0, range(13)),
+        'weekday_counts': cell_totals(1, calendar.day_name),
+        'hour_counts': cell_totals(2, range(24)),
+        'user_type_counts': cell_totals(3, list(user_types)),
+        'gender_counts': cell_totals(4, list(genders)) if has_gender else None,
+        'start_station_counts': value_counts_nonzero(df['Start Station']),
+        'end_station_counts': value_counts_nonzero(df['End Station']),
+        'journey_counts': journey_counts(df),
+        'birth_year_counts': None,
+        'duration_buckets': bucket_counts(duration_buckets(duration))}
+    aggs.update(dict.fromkeys(SKETCH_COUNTS.values(), 0), sketched=False)
+    if 'Birth Year' in df.columns:
+        aggs['birth_year_counts'] = value_counts_nonzero(df['Birth Year'])
+    return sketch_aggregates(aggs)
+
+
+def weekday_codes(df):
+    """
+    Get the weekday of each row as an int, Monday being 0.
+
+    Arguments:
+        df -- dataframe prepared by prepare_df_columns()
+
+    Returns:
+        numpy int array
+    """
+    weekdays = df['Weekday Name']
+    if (isinstance(weekdays.dtype, pd.CategoricalDtype) and
+            list(weekdays.cat.categories) == list(calendar.day_name)):
+        codes = weekdays.cat.codes
+    else:
+        codes = pd.Categorical(weekdays,
+                               categories=list(calendar.day_name)).codes
+    return np.asarray(codes, dtype=np.intp)
+
+
+def value_counts_nonzero(column):
+    """
+    Count the values of a column, leaving out missing values and unused
+    categories of categorical columns.
+
+    Arguments:
+        column -- Series
+
+    Returns:
+        Series of counts indexed by value
+    """
+    counts = column.value_counts()
+    counts = counts[counts > 0]
+    counts.index = counts.index.astype(object)
+    return counts
+
+
+def duration_buckets(duration):
+    """
+    Get the log-sized bucket of each trip duration, see
+    DURATION_RELATIVE_ERROR.
+
+    Arguments:
+        duration -- trip durations in seconds (Series or array)
+
+    Returns:
+        array of bucket numbers, -1 for missing durations
+    """
+    values = np.maximum(np.asarray(duration, dtype='float64'), 1.0)
+    buckets = np.ceil(np.log(values) / np.log(DURATION_BUCKET_BASE))
+    buckets = np.nan_to_num(buckets, nan=-1).clip(-1, DURATION_BUCKETS-1)
+    return buckets.astype(np.int16)
+
+
+def bucket_counts(buckets, weights=None):
+    """
+    Count trips per duration bucket.
+
+    Arguments:
+        buckets -- bucket numbers (array) from duration_buckets()\n
+        weights -- trips per bucket number (array), or None for one each
+
+    Returns:
+        array of DURATION_BUCKETS trip counts
+    """
+    valid = buckets >= 0
+    if weights is not None:
+        weights = np.asarray(weights)[valid]
+    return np.bincount(buckets[valid], weights=weights,
+                       minlength=DURATION_BUCKETS).astype(np.int64)
+
+
+def duration_percentiles(buckets):
+    """
+    Estimate the DURATION_PERCENTILES of trip durations from their
+    bucket counts.
+
+    Each estimate is the middle (relative to its bounds) of the bucket
+    holding the percentile's trip, so it is within DURATION_RELATIVE_ERROR
+    of that trip's duration.
+
+    Arguments:
+        buckets -- array of trip counts per duration bucket
+
+    Returns:
+        dict of percentile name to seconds, plus the 'relative_error', or
+        None if there are no trips
+    """
+    total = int(buckets.sum())
+    if total == 0:
+        return None
+    cumulative = np.cumsum(buckets)
+    percentiles = {}
+    for name, fraction in DURATION_PERCENTILES.items():
+        bucket = int(np.searchsorted(cumulative, fraction*(total-1),
+                                     side='right'))
+        percentiles[name] = (2 * DURATION_BUCKET_BASE**bucket /
+                             (DURATION_BUCKET_BASE+1))
+    percentiles['relative_error'] = DURATION_RELATIVE_ERROR
+    return percentiles
+
+
+def reduce_counts(counts, size):
+    """
+    Shrink counts to a Misra-Gries summary of at most size values.
+
+    The (size+1)th highest count is subtracted from every count and values
+    left without a positive count are dropped. Kept counts are then at
+    most that much below the true counts, and every value with more than
+    1/(size+1) of the trips is kept. Summaries of separate chunks can be
+    added up and shrunk again, their undercounts adding up to at most
+    1/(size+1) of all trips.
+
+    Arguments:
+        counts -- Series of counts indexed by value\n
+        size -- number of values to keep (int)
+
+    Returns:
+        (Series of counts, undercount (int)) tuple
+    """
+    if len(counts) <= size:
+        return counts, 0
+    values = counts.to_numpy()
+    cut = len(values) - size - 1
+    threshold = int(np.partition(values, cut)[cut])
+    counts = counts - threshold
+    return counts[counts > 0], threshold
+
+
+def sketch_aggregates(aggs):
+    """
+    With APPROXIMATE on, shrink the SKETCH_COUNTS of aggregates to
+    SKETCH_SIZE values each with reduce_counts(), adding to their
+    undercounts.
+
+    Arguments:
+        aggs -- aggregates (dict), updated in place
+
+    Returns:
+        aggs
+    """
+    if APPROXIMATE:
+        for key, undercount_key in SKETCH_COUNTS.items():
+            aggs[key], undercount = reduce_counts(aggs[key], SKETCH_SIZE)
+            aggs[undercount_key] += undercount
+        aggs['sketched'] = True
+    return aggs
+
+
+@traced_stage
+def summarize_aggregates(aggs, month, day):
+    """
+    Turn aggregates from aggregate_trips() into the summary statistics.
+
+    Arguments:
+        aggs
+            aggregates (dict)
+        month
+            month filter (str)
+        day
+            day filter (str)
+
+    Returns:
+        summary statistics (dict of plain, JSON serializable values)
+    """
+    def top(counts):
+        top_items = top_counts(counts, 1)
+        return top_items[0][0] if top_items else None
+
+    def count_dict(counts):
+        if counts is None:
+            return None
+        return dict(top_counts(counts, len(counts)))
+
+    journeys = top_counts(aggs['journey_counts'], TOP_JOURNEYS_COUNT)
+    # Fractional durations are summed in a different order from the cube
+    # than from CSV chunks, rounding keeps the last bits from differing.
+    duration_sum = round(aggs['duration_sum'], 6)
+    summary = {
+        'month': month,
+        'day': day,
+        'trip_count': int(aggs['trip_count']),
+        'busiest_month': None,
+        'busiest_weekday': top(aggs['weekday_counts']),
+        'busiest_start_hour': top(aggs['hour_counts']),
+        'top_start_station': top(aggs['start_station_counts']),
+        'top_end_station': top(aggs['end_station_counts']),
+        'top_journeys': [[start, end, trips]
+                         for (start, end), trips in journeys],
+        'total_duration_seconds': duration_sum,
+        'mean_duration_seconds': None,
+        'duration_percentiles': duration_percentiles(
+            aggs['duration_buckets']),
+        'user_type_counts': count_dict(aggs['user_type_counts']),
+        'gender_counts': count_dict(aggs['gender_counts']),
+        'weekday_counts': count_dict(aggs['weekday_counts']),
+        'birth_year': None}
+    if len(aggs['month_counts']) > 0:
+        summary['busiest_month'] = month_num2name(
+            top(aggs['month_counts']))
+    if aggs['duration_count'] > 0:
+        summary['mean_duration_seconds'] = (duration_sum /
+                                            aggs['duration_count'])
+    if aggs['sketched']:
+        # Listed station and journey counts are at most this much low.
+        summary['approximate'] = {
+            'sketch_size': SKETCH_SIZE,
+            'max_undercount': {key.replace('_undercount', ''): int(aggs[key])
+                               for key in SKETCH_COUNTS.values()}}
+    birth_years = aggs['birth_year_counts']
+    if birth_years is not None and len(birth_years) > 0:
+        summary['birth_year'] = {
+            'oldest': floor(birth_years.index.min()),
+            'youngest': floor(birth_years.index.max()),
+            'most_common': floor(top(birth_years))}
+    return summary
+
+
+def top_counts(counts, n):
+    """
+    Get the n highest counts, ties broken by the lowest value.
+
+    Breaking ties by value rather than by position makes the result the
+    same however the counts were computed or merged.
+
+    Arguments:
+        counts -- Series of counts indexed by value\n
+        n -- number of values to return (int)
+
+    Returns:
+        list of (value, count) tuples of Python values, highest count first
+    """
+    if n <= 0 or len(counts) == 0:
+        return []
+    candidates = counts.nlargest(n, keep='all')
+    items = [(to_builtin(k) if not isinstance(k, tuple)
+              else tuple(to_builtin(v) for v in k), int(v))
+             for k, v in candidates.items()]
+    return sorted(items, key=lambda kv: (-kv[1], kv[0]))[:n]
+
+
+def to_builtin(value):
+    """
+    Convert a numpy scalar to the equivalent Python value.
+
+    Arguments:
+        value -- any value
+
+    Returns:
+        value, as a Python int/float/str etc. if it was a numpy scalar
+    """
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def compute_summary_stats(df, month, day):
+    """
+    Compute all summary statistics of a dataframe.
+
+    Arguments:
+        df
+            dataframe prepared by prepare_df_columns(), possibly filtered
+        month
+            month filter (str)
+        day
+            day filter (str)
+
+    Returns:
+        summary statistics (dict), see summarize_aggregates()
+    """
+    return summarize_aggregates(aggregate_trips(df), month, day)
+
+
+@traced_stage
+def merge_aggregates(aggs, other):
+    """
+    Add up two aggregates, e.g. of two chunks of a city's trips.
+
+    Arguments:
+        aggs -- aggregates (dict) from aggregate_trips(), or None\n
+        other -- aggregates (dict) to add
+
+    Returns:
+        the combined aggregates (dict)
+    """
+    if aggs is None:
+        return other
+    merged = {}
+    for key, value in aggs.items():
+        other_value = other[key]
+        if isinstance(value, bool):
+            merged[key] = value or other_value
+        elif not isinstance(value, pd.Series) and value is not None:
+            merged[key] = value + other_value
+        elif value is None or other_value is None:
+            merged[key] = value if other_value is None else other_value
+        else:
+            merged[key] = value.add(other_value, fill_value=0).astype('int64')
+    return sketch_aggregates(merged)
+
+
+@traced_stage
+def stream_city_aggregates(city, queries, chunksize=None):
+    """
+    Compute the aggregates of several month/day queries of a city in one
+    pass over its CSV, without holding the whole file in memory.
+
+    The CSV is read in chunks. For a single filtered query, only Start
+    Time is parsed for every row and only matching rows are prepared. With
+    several queries each chunk is prepared once and shared. Each query's
+    matching rows are aggregated and merged into its running aggregates, so
+    peak memory is set by the chunk size and the number of distinct values,
+    not the file size.
+
+    Arguments:
+        city
+            key of CITY_DATA (str)
+        queries
+            list of (month, day) tuples
+        chunksize
+            rows per chunk, defaults to READ_CHUNK_SIZE (int)
+
+    Returns:
+        list of aggregates (dict), in the order of queries
+    """
+    results = [None] * len(queries)
+    reader = pd.read_csv(CITY_DATA[city], delimiter=',', index_col=0,
+                         chunksize=chunksize or READ_CHUNK_SIZE)
+    for chunk in reader:
+        chunk['Start Time'] = pd.to_datetime(chunk['Start Time'],
+                                             format='%Y-%m-%d %H:%M:%S')
+        if len(queries) > 1 or queries[0] == ('all', 'all'):
+            chunk = prepare_df_columns(chunk)
+            prepared = True
+        else:
+            prepared = False
+        for i, (month, day) in enumerate(queries):
+            if month == 'all' and day == 'all':
+                rows = chunk
+            else:
+                mask = month_day_mask(month, day, chunk['Start Time'])
+                if not mask.any():
+                    continue
+                rows = chunk[mask]
+                if not prepared:
+                    rows = prepare_df_columns(rows.copy())
+            results[i] = merge_aggregates(results[i], aggregate_trips(rows))
+    if any(aggs is None for aggs in results):
+        # No matching rows: aggregate an empty frame for those queries.
+        empty = prepare_df_columns(pd.read_csv(CITY_DATA[city], index_col=0,
+                                               nrows=0))
+        results = [aggregate_trips(empty) if aggs is None else aggs
+                   for aggs in results]
+    return results
+
+
+def cell_ids(df):
+    """
+    Get each row's month × weekday × start hour cube cell.
+
+    Arguments:
+        df -- dataframe prepared by prepare_df_columns()
+
+    Returns:
+        numpy int16 array of month*168 + weekday*24 + hour
+    """
+    return (df['Month Number'].to_numpy(dtype=np.int16)*CUBE_WEEK_CELLS +
+            weekday_codes(df).astype(np.int16)*24 +
+            df['Start Hour'].to_numpy(dtype=np.int16))
+
+
+@traced_stage
+def build_city_cube(df):
+    """
+    Build the month × weekday × start hour aggregate cube of a city.
+
+    The 'cells' table holds trip counts and duration sums per cell. The
+    other tables hold counts per cell and value of user type, gender,
+    start/end station, journey, birth year and duration bucket, so
+    cube_aggregates() can answer any month/day filter exactly (duration
+    percentiles as closely as duration_percentiles() does) without the raw
+    rows. All tables are sorted by cell, so the rows of a month or a
+    weekday are a few contiguous ranges.
+
+    Arguments:
+        df -- prepared, unfiltered city dataframe
+
+    Returns:
+        cube (dict of table name to dataframe)
+    """
+    cell = cell_ids(df)
+    duration = df['Trip Duration'].astype('float64').to_numpy()
+    cube = {'cells': pd.DataFrame({'cell': cell, 'duration': duration}).
+            groupby('cell').agg(trips=('duration', 'size'),
+                                duration_sum=('duration', 'sum'),
+                                duration_count=('duration', 'count')).
+            reset_index()}
+    buckets = duration_buckets(duration)
+    for table_name, cols in CUBE_COUNT_TABLES.items():
+        if table_name == 'duration_bucket':
+            valid = buckets >= 0
+            keys = pd.DataFrame({'Duration Bucket': buckets[valid],
+                                 'cell': cell[valid]})
+        elif all(col in df.columns for col in cols):
+            keys = df[cols].assign(cell=cell)
+        else:
+            continue
+        counts = keys.groupby(['cell']+cols, observed=True, sort=False).size()
+        # int32 counts: a value's trips in one cell never come near 2**31.
+        cube[table_name] = counts.astype('int32').rename(
+            'count').reset_index().sort_values('cell', kind='stable',
+                                               ignore_index=True)
+    return cube
+
+
+@traced_stage
+def cube_aggregates(cube, month, day):
+    """
+    Sum the cube cells matching a month/day filter into aggregates.
+
+    Arguments:
+        cube
+            cube (dict) from build_city_cube()
+        month
+            month (3 char str, e.g. 'Jan') or 'all'
+        day
+            day (3 char str, e.g. 'Mon') or 'all'
+
+    Returns:
+        aggregates (dict), same as aggregate_trips() on the filtered rows
+        but never sketched: the cube's counts are exact even in
+        approximate mode
+    """
+    selected = np.zeros((13, 7, 24), dtype=bool)
+    months = slice(None)
+    if month != 'all':
+        months = MONTH_NUMBERS[month.title()]
+    days = slice(None)
+    if day != 'all':
+        days = WEEKDAY_NUMBERS[day]
+    selected[months, days, :] = True
+    selected = selected.ravel()
+    # Runs of selected cells: one per month, or per month of a weekday.
+    edges = np.flatnonzero(np.diff(selected, prepend=False, append=False))
+    run_starts, run_ends = edges[0::2], edges[1::2]
+
+    def counts(table_name):
+        if table_name not in cube:
+            return None
+        table = cube[table_name]
+        cell = table['cell'].to_numpy()
+        # Bounds of cell's dtype, so searchsorted() doesn't copy the column.
+        lo = np.searchsorted(cell, run_starts.astype(cell.dtype))
+        hi = np.searchsorted(cell, run_ends.astype(cell.dtype))
+        rows = (slice(lo[0], hi[0]) if len(lo) == 1 else
+                np.concatenate([np.arange(*bounds) for bounds in zip(lo, hi)]))
+        return sum_cube_counts(table, CUBE_COUNT_TABLES[table_name], rows)
+
+    cells = cube['cells']
+    cells = cells[selected[cells['cell'].to_numpy()]]
+    cell = cells['cell'].to_numpy()
+    trips = cells['trips'].to_numpy()
+    weekday_trips = np.bincount((cell // 24) % 7, weights=trips, minlength=7)
+    weekday_counts = pd.Series(weekday_trips.astype(np.int64),
+                               index=pd.Index(list(calendar.day_name),
+                                              dtype=object))
+    duration_bucket_counts = counts('duration_bucket')
+    aggs = {
+        'trip_count': int(trips.sum()),
+        'duration_sum': float(cells['duration_sum'].sum()),
+        'duration_count': int(cells['duration_count'].sum()),
+        'month_counts': cells.groupby(cell // CUBE_WEEK_CELLS)['trips'].sum(),
+        'weekday_counts': weekday_counts[weekday_counts > 0],
+        'hour_counts': cells.groupby(cell % 24)['trips'].sum(),
+        'user_type_counts': counts('user_type'),
+        'gender_counts': counts('gender'),
+        'start_station_counts': counts('start_station'),
+        'end_station_counts': counts('end_station'),
+        'journey_counts': counts('journey'),
+        'birth_year_counts': counts('birth_year'),
+        'duration_buckets': bucket_counts(
+            duration_bucket_counts.index.to_numpy(dtype=np.int64),
+            duration_bucket_counts.to_numpy())}
+    aggs.update(dict.fromkeys(SKETCH_COUNTS.values(), 0), sketched=False)
+    return aggs
+
+
+def sum_cube_counts(table, cols, rows):
+    """
+    Add up the counts of some rows of a cube count table per value.
+
+    Like journey_counts(), each key column is turned into integer codes
+    (free for categorical columns) and the counts are summed per combined
+    code with np.bincount(), instead of a much slower groupby.
+
+    Arguments:
+        table -- count table of build_city_cube()\n
+        cols -- its key columns, see CUBE_COUNT_TABLES\n
+        rows -- slice or array of positions of the rows to add up
+
+    Returns:
+        Series of counts indexed by value (or by tuple of values), values
+        with no count are left out
+    """
+    weights = table['count'].to_numpy()[rows]
+    codes = np.zeros(len(weights), dtype=np.int64)
+    values = []
+    for col in cols:
+        if isinstance(table[col].dtype, pd.CategoricalDtype):
+            col_codes = table[col].cat.codes.to_numpy()[rows]
+            categories = table[col].cat.categories
+        else:
+            col_codes, categories = pd.factorize(table[col].to_numpy()[rows])
+        codes = codes*len(categories) + col_codes
+        values.append(pd.Index(np.asarray(categories, dtype=object)))
+    size = prod(len(col_values) for col_values in values)
+    if size <= 4*len(codes) + 2**20:
+        # Dense table of all keys is small enough: sum in O(rows).
+        sums = np.bincount(codes, weights=weights, minlength=size)
+        keys = np.flatnonzero(sums)
+        sums = sums[keys]
+    else:
+        keys, inverse = np.unique(codes, return_inverse=True)
+        sums = np.bincount(inverse, weights=weights)
+        keys, sums = keys[sums > 0], sums[sums > 0]
+    key_codes = []
+    for col_values in reversed(values):
+        key_codes.insert(0, keys % len(col_values))
+        keys = keys // len(col_values)
+    if len(cols) == 1:
+        index = values[0].take(key_codes[0]).rename(cols[0])
+    else:
+        # From the codes, so the values aren't hashed again.
+        index = pd.MultiIndex(levels=values, codes=key_codes, names=cols,
+                              verify_integrity=False)
+    return pd.Series(sums.astype(np.int64), index=index, name='count')
+
+
+@traced_stage
+def load_city_cube(city, build=True):
+    """
+    Get a city's aggregate cube.
+
+    Checks the in-process cube cache, then the on-disk cache, and
+    otherwise builds the cube from load_city_df() and persists it.
+
+    Arguments:
+        city -- key of CITY_DATA (str)\n
+        build -- build the cube if it isn't cached yet (bool)
+
+    Returns:
+        cube (dict), or None if not cached and build is False
+    """
+    with city_load_lock(city):
+        if city in city_cube_cache:
+            return city_cube_cache[city]
+        cube = read_cache_artifact(city, 'cube')
+        if cube is None:
+            if not build:
+                return None
+            cube = build_city_cube(load_city_df(city))
+            write_cache_artifact(city, 'cube', cube)
+        city_cube_cache[city] = cube
+        return cube
+
+
+@traced_stage
+def build_time_index(df):
+    """
+    Build a city's Start Time index.
+
+    'time_order' holds the row positions sorted by start time, with the
+    sorted start times alongside for binary search. 'bucket_order' holds
+    the same positions grouped by weekday × start hour bucket (Monday 0:00
+    first), in start time order within each bucket, and 'bucket_offsets'
+    where each of the 168 buckets begins, so a bucket's rows are the slice
+    bucket_order[offsets[b]:offsets[b+1]].
+
+    Arguments:
+        df -- prepared, unfiltered city dataframe
+
+    Returns:
+        index (dict of table name to dataframe)
+    """
+    dtype = np.int32 if len(df) < 2**31 else np.int64
+    starts = df['Start Time'].to_numpy()
+    order = np.argsort(starts, kind='stable').astype(dtype)
+    buckets = weekday_codes(df)*24 + df['Start Hour'].to_numpy(dtype=np.intp)
+    # A stable sort keeps the time order within each bucket.
+    bucket_order = order[np.argsort(buckets[order], kind='stable')]
+    offsets = np.zeros(CUBE_WEEK_CELLS + 1, dtype=np.int64)
+    np.cumsum(np.bincount(buckets, minlength=CUBE_WEEK_CELLS),
+              out=offsets[1:])
+    return {'time_order': pd.DataFrame({'position': order,
+                                        'start': starts[order]}),
+            'bucket_order': pd.DataFrame({'position': bucket_order,
+                                          'start': starts[bucket_order]}),
+            'bucket_offsets': pd.DataFrame({'offset': offsets})}
+
+
+@traced_stage
+def load_time_index(city, df=None):
+    """
+    Get a city's Start Time index.
+
+    Checks the in-process index cache, then the on-disk cache, and
+    otherwise builds the index from load_city_df() and persists it.
+
+    Arguments:
+        city -- key of CITY_DATA (str)\n
+        df -- the city's dataframe from load_city_df(), if already loaded
+
+    Returns:
+        index (dict), see build_time_index()
+    """
+    with city_load_lock(city):
+        if city in city_time_index_cache:
+            return city_time_index_cache[city]
+        index = read_cache_artifact(city, 'time_index')
+        if index is None:
+            index = build_time_index(load_city_df(city) if df is None else df)
+            write_cache_artifact(city, 'time_index', index)
+        city_time_index_cache[city] = index
+        return index
+
+
+def search_times(starts, lo, hi, start, end):
+    """
+    Narrow a slice of sorted start times to a [start, end) time range.
+
+    Arguments:
+        starts -- sorted numpy datetime64 array\n
+        lo, hi -- the slice to search (ints)\n
+        start, end -- pd.Timestamp bounds, or None for open ended
+
+    Returns:
+        (lo, hi) of the narrowed slice
+    """
+    if start is not None:
+        lo += np.searchsorted(starts[lo:hi],
+                              np.datetime64(start).astype(starts.dtype))
+    if end is not None:
+        hi = lo + np.searchsorted(starts[lo:hi],
+                                  np.datetime64(end).astype(starts.dtype))
+    return lo, hi
+
+
+@traced_stage
+def window_positions(month, day, window, df, index):
+    """
+    Get the row positions of a city dataframe within a time window and
+    matching the month/day filter.
+
+    Date ranges are binary searched in the sorted start times. With hours
+    or weekdays, only the matching weekday × hour buckets are searched, and
+    the day filter just narrows the weekdays. The month filter is applied
+    to the rows found.
+
+    Arguments:
+        month
+            month (3 char str, e.g. 'Jan') or 'all'
+        day
+            day (3 char str, e.g. 'Mon') or 'all'
+        window
+            time window (dict), see time_window()
+        df
+            the city's dataframe from load_city_df()
+        index
+            the city's Start Time index, see build_time_index()
+
+    Returns:
+        sorted numpy array of row positions
+    """
+    order = index['time_order']
+    start, end = window['start'], window['end']
+    if window['last'] is not None and len(order):
+        # Relative to the latest trip, the data being historical.
+        since = order['start'].iloc[-1] - window['last']
+        start = since if start is None else max(start, since)
+    weekdays = window['weekdays'] or range(7)
+    if day != 'all':
+        day_num = WEEKDAY_NUMBERS[day]
+        weekdays = [d for d in weekdays if d == day_num]
+    if window['hours'] is None and window['weekdays'] is None and day == 'all':
+        lo, hi = search_times(order['start'].to_numpy(), 0, len(order),
+                              start, end)
+        positions = np.sort(order['position'].to_numpy()[lo:hi])
+    else:
+        bucket_positions = index['bucket_order']['position'].to_numpy()
+        bucket_starts = index['bucket_order']['start'].to_numpy()
+        offsets = index['bucket_offsets']['offset'].to_numpy()
+        slices = []
+        for weekday in weekdays:
+            for hour in window['hours'] or range(24):
+                bucket = weekday*24 + hour
+                lo, hi = search_times(bucket_starts, offsets[bucket],
+                                      offsets[bucket+1], start, end)
+                slices.append(bucket_positions[lo:hi])
+        positions = np.sort(np.concatenate(
+            slices or [bucket_positions[:0]]))
+    return filter_subset_positions(month, 'all', df, positions)
+
+
+@traced_stage
+def build_station_index(df):
+    """
+    Build a city's station index.
+
+    'stations' lists every start or end station with its number of
+    departures and arrivals. 'departures' holds the row positions of the
+    trips grouped by start station, in the order of 'stations' and in row
+    order within a station, and 'arrivals' the same grouped by end station,
+    so a station's trips are a slice found from the cumulative counts.
+
+    Arguments:
+        df -- prepared, unfiltered city dataframe
+
+    Returns:
+        index (dict of table name to dataframe)
+    """
+    dtype = np.int32 if len(df) < 2**31 else np.int64
+    stations = (pd.concat([df['Start Station'], df['End Station']]).
+                dropna().astype(object).unique())
+    stations = np.sort(stations.astype(str))
+    index = {}
+    counts = {}
+    for table_name, col in [('departures', 'Start Station'),
+                            ('arrivals', 'End Station')]:
+        codes = pd.Categorical(df[col], categories=stations).codes
+        codes = np.asarray(codes, dtype=np.intp)
+        # Trips without a station (code -1) sort first and are left out.
+        order = np.argsort(codes, kind='stable').astype(dtype)
+        counts[table_name] = np.bincount(codes[codes >= 0],
+                                         minlength=len(stations))
+        index[table_name] = pd.DataFrame(
+            {'position': order[len(order) - counts[table_name].sum():]})
+    index['stations'] = pd.DataFrame({'station': stations,
+                                      'departures': counts['departures'],
+                                      'arrivals': counts['arrivals']})
+    return index
+
+
+@traced_stage
+def load_station_index(city, df=None):
+    """
+    Get a city's station index.
+
+    Checks the in-process index cache, then the on-disk cache, and
+    otherwise builds the index from load_city_df() and persists it.
+
+    Arguments:
+        city -- key of CITY_DATA (str)\n
+        df -- the city's dataframe from load_city_df(), if already loaded
+
+    Returns:
+        index (dict), see build_station_index()
+    """
+    with city_load_lock(city):
+        if city in city_station_index_cache:
+            return city_station_index_cache[city]
+        index = read_cache_artifact(city, 'station_index')
+        if index is None:
+            index = build_station_index(load_city_df(city) if df is None
+                                        else df)
+            write_cache_artifact(city, 'station_index', index)
+        city_station_index_cache[city] = index
+        return index
+
+
+def resolve_station(stations, name):
+    """
+    Match a station argument to a station name.
+
+    An exact match wins, otherwise the name may be any unique part of a
+    station name, case insensitive.
+
+    Arguments:
+        stations -- Series of station names\n
+        name -- station argument (str)
+
+    Returns:
+        position of the station in stations (int)
+    """
+    lower = stations.str.lower()
+    matches = np.flatnonzero(lower == name.strip().lower())
+    if len(matches) == 0:
+        matches = np.flatnonzero(lower.str.contains(name.strip().lower(),
+                                                    regex=False))
+    if len(matches) != 1:
+        raise ValueError(
+            'no station matches {name!r}'.format(name=name)
+            if len(matches) == 0 else
+            '{name!r} matches {n} stations, e.g. {some}'.format(
+                name=name, n=len(matches),
+                some=', '.join(stations.iloc[matches[:3]])))
+    return int(matches[0])
+
+
+@traced_stage
+def station_drilldown(city, station, month='all', day='all'):
+    """
+    Get the traffic profile of one station from the city's station index.
+
+    Only the station's own trips are read: departures are profiled by
+    start time, arrivals by end time.
+
+    Arguments:
+        city
+            key of CITY_DATA (str)
+        station
+            station name, or a unique part of it (str)
+        month
+            month (3 char str, e.g. 'Jan') or 'all'
+        day
+            day (3 char str, e.g. 'Mon') or 'all'
+
+    Returns:
+        dict with the 'station' name, its 'departures' and 'arrivals'
+        trip counts, 'hourly' and 'weekday' profiles of each, the
+        'top_destinations' of departures and 'top_origins' of arrivals,
+        and their mean trip durations
+    """
+    city_source_fingerprint(city)
+    df = load_city_df(city)
+    index = load_station_index(city, df)
+    stations = index['stations']
+    i = resolve_station(stations['station'], station)
+    drill = {'city': city, 'station': stations['station'].iloc[i],
+             'month': month, 'day': day, 'hourly': {}, 'weekday': {}}
+    for table_name, time_col, other_col, top_name in [
+            ('departures', 'Start Time', 'End Station', 'top_destinations'),
+            ('arrivals', 'End Time', 'Start Station', 'top_origins')]:
+        begin = int(stations[table_name].iloc[:i].sum())
+        positions = index[table_name]['position'].to_numpy()[
+            begin:begin + int(stations[table_name].iloc[i])]
+        positions = filter_subset_positions(month, day, df, positions)
+        times = pd.DatetimeIndex(df[time_col].to_numpy()[positions])
+        drill[table_name] = len(positions)
+        drill['hourly'][table_name] = np.bincount(
+            times.hour, minlength=24).tolist()
+        drill['weekday'][table_name] = dict(zip(
+            calendar.day_name, np.bincount(times.dayofweek,
+                                           minlength=7).tolist()))
+        others = df[other_col].iloc[positions]
+        drill[top_name] = [list(item) for item in
+                           top_counts(value_counts_nonzero(others),
+                                      TOP_STATIONS_COUNT)]
+        duration = df['Trip Duration'].to_numpy()[positions].astype(float)
+        drill['mean_{name}_duration_seconds'.format(name=table_name)] = (
+            float(np.nanmean(duration)) if len(duration) else None)
+    return drill
+
+
+def print_station_drilldown(drill):
+    """
+    Print a station's traffic profile from station_drilldown().
+
+    Arguments:
+        drill -- station profile (dict)
+    """
+    print('******* Station drill-down: {name}, {cname} *******\n'.
+          format(name=drill['station'], cname=drill['city']))
+    mean_departure = drill['mean_departures_duration_seconds']
+    mean_arrival = drill['mean_arrivals_duration_seconds']
+    dictionary_prettyprint({
+        'Departures (trips starting here)': drill['departures'],
+        'Arrivals (trips ending here)': drill['arrivals'],
+        'Mean duration of departures (minutes)':
+            '-' if mean_departure is None else
+            '{:.1f}'.format(mean_departure / 60),
+        'Mean duration of arrivals (minutes)':
+            '-' if mean_arrival is None else
+            '{:.1f}'.format(mean_arrival / 60)})
+    print('\n* Hourly profile (departures by start hour, arrivals by end '
+          'hour) *')
+    print(pd.DataFrame(drill['hourly']).rename_axis('Hour').to_string())
+    print('\n* Weekday profile *')
+    print(pd.DataFrame(drill['weekday']).rename_axis('Weekday').to_string())
+    for top_name, title in [('top_destinations', 'Top destinations'),
+                            ('top_origins', 'Top origins')]:
+        print('\n* {title} *'.format(title=title))
+        for other, trips in drill[top_name]:
+            print('{trips:>8}  {other}'.format(trips=trips, other=other))
+    print()
+
+
+@traced_stage
+def build_rollups(df):
+    """
+    Build a city's hourly time series.
+
+    Trips are binned by the hour of their Start Time with np.bincount. Every
+    hour from the first trip's to the last trip's gets a row, so the series
+    can be resampled to days and the series of new rows added on, see
+    merge_rollups().
+
+    Arguments:
+        df -- prepared city dataframe
+
+    Returns:
+        dict with the 'hourly' dataframe: 'hour', 'trips', 'duration_sum',
+        'duration_count' and a 'trips: <user type>' column per user type
+    """
+    hours = df['Start Time'].to_numpy().astype('datetime64[h]')
+    if len(hours) > 0:
+        first = hours.min()
+        offsets = (hours - first).astype(np.int64)
+        size = int(offsets.max()) + 1
+    else:
+        first, offsets, size = np.datetime64(0, 'h'), hours.astype(np.int64), 0
+    duration = df['Trip Duration'].to_numpy(dtype='float64')
+    valid = ~np.isnan(duration)
+    hourly = pd.DataFrame({
+        'hour': (first + np.arange(size)).astype('datetime64[ns]'),
+        'trips': np.bincount(offsets, minlength=size),
+        'duration_sum': np.bincount(offsets[valid], weights=duration[valid],
+                                    minlength=size),
+        'duration_count': np.bincount(offsets[valid], minlength=size)})
+    user_codes, user_types = pd.factorize(df['User Type'], sort=True)
+    for code, user_type in enumerate(user_types):
+        hourly['trips: ' + str(user_type)] = np.bincount(
+            offsets[user_codes == code], minlength=size)
+    return {'hourly': hourly}
+
+
+def merge_rollups(rollups, other):
+    """
+    Add up two cities' or chunks' hourly time series.
+
+    Arguments:
+        rollups -- rollups (dict) from build_rollups(), or None\n
+        other -- rollups (dict) to add
+
+    Returns:
+        the combined rollups (dict), same as building them from all the
+        rows
+    """
+    if rollups is None:
+        return other
+    hourly = (pd.concat([rollups['hourly'], other['hourly']]).fillna(0).
+              groupby('hour').sum())
+    if len(hourly) > 0:
+        hourly = hourly.reindex(pd.date_range(hourly.index.min(),
+                                              hourly.index.max(), freq='h'),
+                                fill_value=0)
+    user_type_cols = sorted(col for col in hourly.columns
+                            if col.startswith('trips: '))
+    hourly = hourly[['trips', 'duration_sum', 'duration_count'] +
+                    user_type_cols]
+    hourly = hourly.astype({col: np.int64 for col in hourly.columns
+                            if col != 'duration_sum'})
+    return {'hourly': hourly.rename_axis('hour').reset_index()}
+
+
+def load_rollups(city, df=None, build=True):
+    """
+    Get a city's hourly time series.
+
+    Checks the in-process rollups cache, then the on-disk cache, and
+    otherwise builds them from load_city_df() and persists them. With
+    PUSHDOWN_FILTERS or OUT_OF_CORE on they're built chunk by chunk from
+    the CSV instead, and only kept in memory.
+
+    Arguments:
+        city -- key of CITY_DATA (str)\n
+        df -- the city's dataframe from load_city_df(), if already loaded\n
+        build -- build the rollups if they're not cached (bool)
+
+    Returns:
+        rollups (dict), see build_rollups(), or None if not cached and
+        build is False
+    """
+    with city_load_lock(city):
+        if city in city_rollups_cache:
+            return city_rollups_cache[city]
+        rollups = read_cache_artifact(city, 'rollups')
+        if rollups is None and not build:
+            return None
+        if (rollups is None and df is None and
+                (PUSHDOWN_FILTERS or OUT_OF_CORE)):
+            for chunk in read_city_csv_chunks(city, 'all', 'all'):
+                rollups = merge_rollups(rollups, build_rollups(chunk))
+        elif rollups is None:
+            rollups = build_rollups(load_city_df(city) if df is None else df)
+            write_cache_artifact(city, 'rollups', rollups)
+        city_rollups_cache[city] = rollups
+        return rollups
+
+
+@traced_stage
+def city_rollups(city, month, day, window=None, freq='daily', build=True):
+    """
+    Get the time series of a city query.
+
+    Month/day queries are cut from the city's cached hourly series (days
+    are resampled first, then filtered). Queries with a time window are
+    built from the rows found through the Start Time index.
+
+    Arguments:
+        city
+            key of CITY_DATA (str)
+        month
+            month (3 char str, e.g. 'Jan') or 'all'
+        day
+            day (3 char str, e.g. 'Mon') or 'all'
+        window
+            time window (dict) from time_window(), or None
+        freq
+            'hourly' or 'daily' (str)
+        build
+            build the city's hourly series if it's not cached (bool)
+
+    Returns:
+        dataframe indexed by hour or day, with 'trips', 'duration_sum',
+        'duration_count', 'mean_duration' (NaN without trips) and
+        'trips: <user type>' columns, or None if the series isn't cached
+        and build is False
+    """
+    if window is None:
+        city_source_fingerprint(city)
+        rollups = load_rollups(city, build=build)
+        if rollups is None:
+            return None
+        hourly = rollups['hourly']
+    else:
+        df, positions = query_rows(city, month, day, window)
+        hourly = build_rollups(df.iloc[positions])['hourly']
+    series = hourly.set_index('hour').resample(ROLLUP_FREQS[freq]).sum()
+    if window is None:
+        keep = np.ones(len(series), dtype=bool)
+        if month != 'all':
+            keep &= series.index.month == MONTH_NUMBERS[month.title()]
+        if day != 'all':
+            keep &= series.index.dayofweek == WEEKDAY_NUMBERS[day]
+        series = series[keep]
+    series.insert(3, 'mean_duration',
+                  series['duration_sum'] / series['duration_count'].where(
+                      series['duration_count'] > 0))
+    return series
+
+
+def sparkline(values):
+    """
+    Draw values as a line of block characters, scaled from 0 to the
+    highest value.
+
+    Arguments:
+        values -- array of numbers, NaN for no value
+
+    Returns:
+        str, one character per value, a space for NaN
+    """
+    values = np.asarray(values, dtype='float64')
+    top = np.nanmax(values, initial=0.0) if len(values) else 0.0
+    levels = np.zeros(len(values), dtype=np.intp)
+    if top > 0:
+        levels = np.round(np.nan_to_num(values) / top *
+                          (len(SPARKLINE_CHARS)-1)).astype(np.intp)
+    chars = np.array(list(SPARKLINE_CHARS))[levels]
+    chars[np.isnan(values)] = ' '
+    return ''.join(chars)
+
+
+def print_rollups(hourly, daily):
+    """
+    Print a query's time series as sparklines: trips and mean duration
+    over time (days binned to fit SPARKLINE_WIDTH), trips per user type,
+    and trips per start hour of the day.
+
+    Arguments:
+        hourly -- hourly series from city_rollups()\n
+        daily -- daily series from city_rollups()
+    """
+    print('\n*** Trips Over Time ***\n')
+    if daily['trips'].sum() == 0:
+        print('Sorry, no trips to chart')
+        return
+    # Each mark is the daily mean over a run of consecutive days.
+    bins = (np.arange(len(daily)) * min(len(daily), SPARKLINE_WIDTH) //
+            len(daily))
+    binned = daily.drop(columns='mean_duration').groupby(bins).mean()
+    print('Daily trips, {first:%Y-%m-%d} to {last:%Y-%m-%d} (peak {trips} '
+          'on {peak:%Y-%m-%d}{per_mark})'.
+          format(first=daily.index[0], last=daily.index[-1],
+                 trips=daily['trips'].max(), peak=daily['trips'].idxmax(),
+                 per_mark='' if len(binned) == len(daily) else
+                 ', {days:.3g} days per mark'.format(
+                     days=len(daily) / len(binned))))
+    print('  ' + sparkline(binned['trips']))
+    print('Mean duration')
+    print('  ' + sparkline(binned['duration_sum'] /
+                           binned['duration_count'].where(
+                               binned['duration_count'] > 0)))
+    for col in binned.columns:
+        if col.startswith('trips: '):
+            print(col[len('trips: '):])
+            print('  ' + sparkline(binned[col]))
+    by_hour = hourly.groupby(hourly.index.hour)['trips'].sum().reindex(
+        range(24), fill_value=0)
+    print('Trips per start hour, 0 to 23')
+    print('  ' + sparkline(by_hour))
+
+
+@traced_stage
+def city_summary_stats(city, month, day, window=None):
+    """
+    Get the summary statistics of a city query, from the result cache if
+    it was computed before, otherwise with compute_city_summary_stats().
+
+    Arguments:
+        city
+            key of CITY_DATA (str)
+        month
+            month (3 char str, e.g. 'Jan') or 'all'
+        day
+            day (3 char str, e.g. 'Mon') or 'all'
+        window
+            time window (dict) from time_window(), or None
+
+    Returns:
+        summary statistics (dict), treat as read only
+    """
+    key = result_cache_key(city, month, day, window)
+    summary = result_cache_get(key)
+    if summary is None:
+        summary = compute_city_summary_stats(city, month, day, window)
+        result_cache_put(key, summary)
+    return summary
+
+
+@traced_stage
+def compute_city_summary_stats(city, month, day, window=None):
+    """
+    Compute the summary statistics of a city query from the aggregates of
+    city_aggregates().
+
+    Arguments:
+        city
+            key of CITY_DATA (str)
+        month
+            month (3 char str, e.g. 'Jan') or 'all'
+        day
+            day (3 char str, e.g. 'Mon') or 'all'
+        window
+            time window (dict) from time_window(), or None
+
+    Returns:
+        summary statistics (dict), see summarize_aggregates(), plus the
+        'window' label of windowed queries
+    """
+    summary = summarize_aggregates(city_aggregates(city, month, day, window),
+                                   month, day)
+    if window is not None:
+        summary['window'] = window_label(window)
+    return summary
+
+
+@traced_stage
+def city_aggregates(city, month, day, window=None):
+    """
+    Get the aggregates of a city query from its aggregate cube.
+
+    With OUT_OF_CORE on and no cube cached yet, the aggregates are
+    computed by streaming the CSV with stream_city_aggregates(). With
+    PUSHDOWN_FILTERS on and no cube cached yet, they are computed from the
+    rows read by load_data(). Otherwise the cube is built if needed.
+    Queries with a time window are computed from the rows found through
+    the city's Start Time index instead.
+
+    Arguments:
+        city
+            key of CITY_DATA (str)
+        month
+            month (3 char str, e.g. 'Jan') or 'all'
+        day
+            day (3 char str, e.g. 'Mon') or 'all'
+        window
+            time window (dict) from time_window(), or None
+
+    Returns:
+        aggregates (dict), see aggregate_trips()
+    """
+    if window is not None:
+        df, positions = query_rows(city, month, day, window)
+        return aggregate_trips(df.iloc[positions])
+    cube = load_city_cube(city, build=not (PUSHDOWN_FILTERS or OUT_OF_CORE))
+    if cube is None and OUT_OF_CORE:
+        return stream_city_aggregates(city, [(month, day)])[0]
+    if cube is None:
+        return aggregate_trips(load_data(city, month, day))
+    return cube_aggregates(cube, month, day)
+
+
+def result_cache_key(city, month, day, window=None):
+    """
+    Get the result cache key of a query.
+
+    The key includes the fingerprint of the city's CSV, so results cached
+    before the CSV changed are never returned, and the sketch size in
+    approximate mode.
+
+    Arguments:
+        city -- key of CITY_DATA (str)\n
+        month -- month (3 char str, e.g. 'Jan') or 'all'\n
+        day -- day (3 char str, e.g. 'Mon') or 'all'\n
+        window -- time window (dict) from time_window(), or None
+
+    Returns:
+        key (tuple)
+    """
+    fingerprint = city_source_fingerprint(city)
+    return (city, month, day, window_label(window) if window else None,
+            fingerprint['mtime_ns'], fingerprint['size'],
+            SKETCH_SIZE if APPROXIMATE else None)
+
+
+def result_cache_get(key):
+    """
+    Get cached summary statistics, from memory or, with PERSIST_RESULTS
+    on, from the on-disk result store.
+
+    Arguments:
+        key -- query key (tuple) from result_cache_key()
+
+    Returns:
+        summary statistics (dict), or None if not cached
+    """
+    with result_cache_lock:
+        if key in result_cache:
+            result_cache_counters['hits'] += 1
+            result_cache.move_to_end(key)
+            return result_cache[key]
+    summary = None
+    if PERSIST_RESULTS and RESULT_CACHE_SIZE > 0:
+        path = result_store_path(key)
+        try:
+            with open(path) as f:
+                stored = json.load(f)
+            if stored['key'] == list(key):
+                summary = stored['summary']
+                # Mark as recently used, for result_store_evict().
+                os.utime(path)
+        except (OSError, ValueError, KeyError):
+            pass
+    with result_cache_lock:
+        if summary is None:
+            result_cache_counters['misses'] += 1
+            return None
+        result_cache_counters['disk_hits'] += 1
+    result_cache_put(key, summary, persist=False)
+    return summary
+
+
+def result_cache_put(key, summary, persist=True):
+    """
+    Cache summary statistics, evicting the least recently used beyond
+    RESULT_CACHE_SIZE, and with PERSIST_RESULTS on also store them on
+    disk.
+
+    Arguments:
+        key -- query key (tuple) from result_cache_key()\n
+        summary -- summary statistics (dict)\n
+        persist -- write to the on-disk store too (bool)
+    """
+    if RESULT_CACHE_SIZE <= 0:
+        return
+    with result_cache_lock:
+        result_cache[key] = summary
+        result_cache.move_to_end(key)
+        while len(result_cache) > RESULT_CACHE_SIZE:
+            result_cache.popitem(last=False)
+            result_cache_counters['evictions'] += 1
+    if persist and PERSIST_RESULTS:
+        path = result_store_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_json_atomic(path, {'key': list(key), 'summary': summary})
+            result_store_evict(os.path.dirname(path))
+        except OSError:
+            pass
+
+
+def result_store_path(key):
+    """
+    Get the on-disk result store file of a query, in a 'results'
+    directory of the city's cache directory.
+
+    Arguments:
+        key -- query key (tuple) from result_cache_key()
+
+    Returns:
+        file path (str)
+    """
+    digest = hashlib.sha1(json.dumps(list(key)).encode()).hexdigest()
+    return os.path.join(city_cache_dir(key[0]), 'results',
+                        digest + '.json')
+
+
+def result_store_evict(store_dir):
+    """
+    Delete the least recently used files of an on-disk result store
+    beyond RESULT_CACHE_SIZE.
+
+    Arguments:
+        store_dir -- the city's result store directory (str)
+    """
+    entries = [entry for entry in os.scandir(store_dir)
+               if entry.name.endswith('.json')]
+    if len(entries) <= RESULT_CACHE_SIZE:
+        return
+    entries.sort(key=lambda entry: entry.stat().st_mtime_ns)
+    for entry in entries[:len(entries) - RESULT_CACHE_SIZE]:
+        with contextlib.suppress(OSError):
+            os.remove(entry.path)
+
+
+def result_cache_stats():
+    """
+    Get the result cache counters and size.
+
+    Returns:
+        dict with 'hits', 'disk_hits', 'misses', 'evictions', 'entries'
+        and 'max_entries'
+    """
+    with result_cache_lock:
+        stats = dict(result_cache_counters)
+        stats['entries'] = len(result_cache)
+    stats['max_entries'] = RESULT_CACHE_SIZE
+    return stats
+
+
+def city_source_fingerprint(city):
+    """
+    Get the fingerprint of a city's CSV, dropping the city from the
+    in-process caches if the CSV changed since it was last checked.
+
+    Arguments:
+        city -- key of CITY_DATA (str)
+
+    Returns:
+        dict with the file's 'mtime_ns' and 'size'
+    """
+    fingerprint = source_fingerprint(CITY_DATA[city])
+    with city_cache_lock:
+        if city_fingerprints.get(city, fingerprint) != fingerprint:
+            city_caches_forget(city)
+        city_fingerprints[city] = fingerprint
+    return fingerprint
+
+
+@traced_stage
+def time_stats(summary):
+    """
+    Display statistics on the most frequent times of travel.
+
+    Uses local dictionary var time_stats_dict to collect the stats,
+    then pretty-prints that.
+
+    Arguments:
+        summary -- summary statistics (dict) from compute_summary_stats()
+    """
+    print('*** Most Frequent Times of Travel ***\n')
+
+    time_stats_dict = {}
+
+    # Don't bother with Busiest Month if the user has
+    # filtered the df to a specific month already.
+    if summary['month'] == 'all':
+        time_stats_dict['Busiest month'] = summary['busiest_month']
+
+    # Don't bother with Busiest Weekday if the user has
+    # filtered the df to a specific day already.
+    if summary['day'] == 'all':
+        time_stats_dict['Busiest day of the week'] = (
+            summary['busiest_weekday'])
+
+    # Display the most common start hour.
+    top_start_hr = summary['busiest_start_hour']
+    # Convert this to something more human readable.
+    if top_start_hr < 12:
+        am_pm_str = ' am'
+    else:
+        am_pm_str = ' pm'
+        if top_start_hr > 12:
+            top_start_hr = top_start_hr-12
+    time_stats_dict['Busiest Start Hour'] = str(top_start_hr)+am_pm_str
+
+    dictionary_prettyprint(time_stats_dict)
+
+
+@traced_stage
+def station_stats(summary):
+    """
+    Display statistics on the most popular stations and trip.
+
+    Uses local dictionary var station_stats_dict to collect the stats,
+    then pretty-prints that.
+
+    Arguments:
+        summary -- summary statistics (dict) from compute_summary_stats()
+    """
+    print('\n*** Station Statistics ***\n')
+
+    station_stats_dict = {}
+
+    # Display most commonly used start station.
+    station_stats_dict['Most frequented Start Station'] = (
+        summary['top_start_station'])
+
+    # Display most commonly used end station.
+    station_stats_dict['Most frequented End Station'] = (
+        summary['top_end_station'])
+
+    # Display most frequent combinations of start station and end station.
+    journeys = summary['top_journeys']
+    if len(journeys) > 0:
+        station_stats_dict['Most common journey (Start+End)'] = (
+            '%s to %s' % tuple(journeys[0][0:2]))
+
+    dictionary_prettyprint(station_stats_dict)
+    print('\n* Top {n} journeys (trips) *'.format(n=len(journeys)))
+    for start, end, trips in journeys:
+        print('{trips:>8}  {start} to {end}'.
+              format(trips=trips, start=start, end=end))
+    approximate = summary.get('approximate')
+    if approximate is not None:
+        undercount = approximate['max_undercount']
+        print('\n(approximate: station counts may be up to {stations} and '
+              'journey counts up to {journeys} trips low)'.
+              format(stations=max(undercount['start_station'],
+                                  undercount['end_station']),
+                     journeys=undercount['journey']))
+
+
+@traced_stage
+def journey_counts(df):
+    """
+    Count trips per (Start Station, End Station) pair without building a
+    string per row.
+
+    Each station column is factorized to integer codes (free for
+    categorical columns) and each pair is counted via a single combined
+    code, so the work is vectorized over all rows.
+
+    Arguments:
+        df -- the source dataframe
+
+    Returns:
+        Series of trip counts indexed by (Start Station, End Station),
+        pairs with a missing station are left out
+    """
+    start_codes, start_names = pd.factorize(df['Start Station'])
+    end_codes, end_names = pd.factorize(df['End Station'])
+    valid = (start_codes >= 0) & (end_codes >= 0)
+    n_end = max(len(end_names), 1)
+    pair_codes = start_codes[valid].astype(np.int64)*n_end + end_codes[valid]
+    if len(start_names)*n_end <= 4*len(pair_codes) + 2**20:
+        # Dense table of all pairs is small enough: count in O(rows).
+        counts = np.bincount(pair_codes, minlength=len(start_names)*n_end)
+        pairs = np.flatnonzero(counts)
+        counts = counts[pairs]
+    else:
+        pairs, counts = np.unique(pair_codes, return_counts=True)
+    index = pd.MultiIndex.from_arrays(
+        [np.asarray(start_names).take(pairs // n_end),
+         np.asarray(end_names).take(pairs % n_end)],
+        names=['Start Station', 'End Station'])
+    return pd.Series(counts, index=index, name='Trips')
+
+
+def top_journeys(df, n=1):
+    """
+    Get the n most common (Start Station, End Station) journeys.
+
+    Arguments:
+        df -- the source dataframe\n
+        n -- number of journeys to return (int)
+
+    Returns:
+        Series of trip counts indexed by (Start Station, End Station),
+        most common first
+    """
+    return journey_counts(df).nlargest(n)
+
+
+@traced_stage
+def trip_duration_stats(summary):
+    """
+    Display statistics on the total, average and percentile trip
+    durations.
+
+    Uses local dictionary var trip_duration_dict to collect the stats,
+    then pretty-prints that.
+
+    Arguments:
+        summary -- summary statistics (dict) from compute_summary_stats()
+    """
+    print('\n*** Trip Duration Statistics ***\n')
+    trip_duration_dict = {}
+    # Using datetime.timedelta for more user-friendly output
+    # rather than just XXXXXXX seconds.
+    total_duration_trips = str(datetime.timedelta(
+        seconds=round(summary['total_duration_seconds'])))
+    trip_duration_dict['Total duration of trips'] = total_duration_trips
+    if summary['mean_duration_seconds'] is not None:
+        mean_duration_trips = str(datetime.timedelta(
+            seconds=round(summary['mean_duration_seconds'])))
+        trip_duration_dict['Mean duration of trips'] = mean_duration_trips
+    percentiles = summary['duration_percentiles']
+    if percentiles is not None:
+        for name, label in [('median', 'Median duration of trips'),
+                            ('p90', '90th percentile duration'),
+                            ('p99', '99th percentile duration')]:
+            trip_duration_dict[label] = str(datetime.timedelta(
+                seconds=round(percentiles[name])))
+
+    dictionary_prettyprint(trip_duration_dict)
+    if percentiles is not None:
+        print('(percentiles are within {error:.0%} of the exact durations)'.
+              format(error=percentiles['relative_error']))
+
+
+@traced_stage
+def user_stats(summary):
+    """
+    Display statistics on bikeshare users (riders).
+
+    Uses both counts_dist_print() and dictionary_prettyprint() methods
+    depending on the kind of data being summarized.
+
+    Arguments:
+        summary -- summary statistics (dict) from compute_summary_stats()
+    """
+    print('\n*** Rider Statistics ***\n')
+    user_stats_dict = {}
+    # Display counts of user types
+    counts_dist_print(summary['user_type_counts'], 'User Type')
+    # Display counts of gender
+    counts_dist_print(summary['gender_counts'], 'Gender')
+
+    if summary['day'] == 'all':
+        print('\n* Total ridership over all weekdays (highest to lowest) *')
+        counts_dist_print(summary['weekday_counts'], 'Weekday Name')
+    else:
+        print('\n* Total ridership on selected day *')
+        counts_dist_print(summary['weekday_counts'], 'Weekday Name')
+
+    birth_year = summary['birth_year']
+    if birth_year is not None:
+        user_stats_dict['Birth year of oldest rider'] = birth_year['oldest']
+        user_stats_dict['Birth year of youngest rider'] = (
+                        birth_year['youngest'])
+        user_stats_dict['Most common birth year'] = birth_year['most_common']
+        dictionary_prettyprint(user_stats_dict)
+    else:
+        print('\nSorry, no rider age data available for this city')
+
+
+def print_summary_stats(df, month, day):
+    """
+    Print all Summary Statistics.
+
+    Top level method computing the statistics with compute_summary_stats()
+    and printing them with render_summary_stats().
 
     Arguments:
         df
             the dataframe
         month
-            month filter (str)
+            month filter (str)
+        day
+            day filter (str)
+
+    Returns:
+        summary statistics (dict)
+    """
+    summary = compute_summary_stats(df, month, day)
+    render_summary_stats(summary)
+    return summary
+
+
+def render_summary_stats(summary):
+    """
+    Print the Summary Statistics computed by compute_summary_stats().
+
+    Arguments:
+        summary -- summary statistics (dict)
+    """
+    print('******* Summary Statistics *******\n')
+    time_stats(summary)
+    station_stats(summary)
+    trip_duration_stats(summary)
+    user_stats(summary)
+    print('(end of Summary Statistics)\n')
+
+
+def about_this_app():
+    """
+    Print information about this application.
+
+    This prints the application banner & the URL back to
+    its github repo (https://github.com/coughlin/pdsnd_github).
+    """
+    # print('\033c'...) below should clear the terminal screen
+    # But this may not work on all platforms, so some testing
+    # and validation by others is encouraged!
+    print('\033c'+APP_INIT_BANNER)
+    print('\nTo log Issues or Contribute to this application, go to ' +
+          'https://github.com/coughlin/pdsnd_github')
+
+
+def warm_up_caches(cities):
+    """
+    Import numpy and pandas and load the cities' aggregate cubes from the
+    on-disk cache, so the first query doesn't wait for either.
+
+    Meant to run in a background thread, see main(). Cubes that aren't
+    cached yet are left to be built by the query.
+
+    Arguments:
+        cities -- list of CITY_DATA keys
+    """
+    # Any attribute lookup imports a LazyModule.
+    np.ndarray, pd.DataFrame
+    for city in cities:
+        load_city_cube(city, build=False)
+
+
+def prefetch_cities(cities, rows=True):
+    """
+    Queue cities to be loaded by the background prefetch worker.
+
+    The worker loads each city's aggregate cube and, with rows, its parsed
+    data, so they're cached by the time the query needs them. A prefetch
+    already queued or running for a city is reused, and queued prefetches
+    of other cities are cancelled, e.g. when the user restarts with
+    another city. Does nothing with PREFETCH off, or while profiling since
+    stage profiles are per query.
+
+    Arguments:
+        cities -- list of CITY_DATA keys\n
+        rows -- also load the parsed rows, not just the cubes (bool)
+    """
+    global prefetch_worker_thread
+    if not PREFETCH or PROFILE_STAGES:
+        return
+    with prefetch_lock:
+        for city, future in list(city_prefetches.items()):
+            if city not in cities and future.cancel():
+                del city_prefetches[city]
+        for city in cities:
+            if city not in city_prefetches:
+                city_prefetches[city] = Future()
+                prefetch_queue.put((city, rows, city_prefetches[city]))
+        if prefetch_worker_thread is None:
+            prefetch_worker_thread = threading.Thread(target=prefetch_worker,
+                                                      daemon=True)
+            prefetch_worker_thread.start()
+
+
+def prefetch_worker():
+    """
+    Load the cities queued by prefetch_cities(), one at a time.
+
+    Cities too large for memory (OUT_OF_CORE) or meant to be read filtered
+    (PUSHDOWN_FILTERS) only get their cube loaded if it's cached. Each
+    future's result is the (start, end) perf_counter() times of the load.
+    """
+    while True:
+        city, rows, future = prefetch_queue.get()
+        if not future.set_running_or_notify_cancel():
+            continue
+        start = time.perf_counter()
+        streamed = PUSHDOWN_FILTERS or OUT_OF_CORE
+        try:
+            if rows and not streamed:
+                load_city_df(city)
+            load_city_cube(city, build=not streamed)
+        except Exception as err:
+            # Left for the query's own load to report.
+            future.set_exception(err)
+        else:
+            future.set_result((start, time.perf_counter()))
+
+
+def join_prefetch(city):
+    """
+    Wait for a city's prefetch to finish, if there is one.
+
+    Arguments:
+        city -- key of CITY_DATA (str)
+
+    Returns:
+        (load seconds, seconds of it hidden before the wait) tuple, or
+        None if the city wasn't prefetched or the prefetch failed
+    """
+    with prefetch_lock:
+        future = city_prefetches.pop(city, None)
+    if future is None:
+        return None
+    waited = time.perf_counter()
+    if future.cancelled() or future.exception() is not None:
+        return None
+    start, end = future.result()
+    return end - start, max(0.0, min(end, waited) - start)
+
+
+def main():
+    """
+    Run main block of code for this Bikeshare python file.
+
+    This greets the user and invokes main event loop (Apple HQ address street
+    named "1 Infinite Loop" for good reason!).
+    The only way the event loop ends normally is if the user elects to quit,
+    which breaks out of this main event loop.
+    """
+    # Stage profiles are per query, so leave the profiled stages cold.
+    if WARM_UP and not PROFILE_STAGES:
+        threading.Thread(target=warm_up_caches, args=(list(CITY_DATA),),
+                         daemon=True).start()
+    about_this_app()
+    while True:
+        # Get filters from user for data query.
+        print('\nPlease select which parts of the bikeshare data & ' +
+              'associated statistics you want to view below.')
+        city, month, day, window = get_filters()
+        label = ' '.join([city, month, day] +
+                         ([window_label(window)] if window else []))
+        with query_trace(label):
+            run_query(city, month, day, window)
+
+        restart_prompt = input('\nWould you like to make a new query? ' +
+                               'Enter [y] to start again, otherwise ' +
+                               'enter anything else to quit completely.\n')
+        match restart_prompt[0:1].lower():
+            case 'y':
+                print('\nRestarting ...\n \033c')
+            case _:
+                print('Bye! See you again soon, thanks :-) !')
+                break
+
+
+def run_query(city, month, day, window=None):
+    """
+    Print the summary stats of an interactive query and let the user page
+    through its rows, after waiting for the city's prefetch to finish.
+
+    Arguments:
+        city
+            key of CITY_DATA (str), or ALL_CITIES to compare them all
+        month
+            month (3 char str, e.g. 'Jan') or 'all'
+        day
+            day (3 char str, e.g. 'Mon') or 'all'
+        window
+            time window (dict) from time_window(), or None
+    """
+    prefetches = [join_prefetch(prefetch) for prefetch in
+                  (CITY_DATA if city == ALL_CITIES else [city])]
+    if all(prefetches):
+        # Prefetches run one after another, so their times add up.
+        print('[Loaded in the background in {load:.2f}s, {hidden:.2f}s of '
+              'it while you chose the filters]\n'.
+              format(load=sum(prefetch[0] for prefetch in prefetches),
+                     hidden=sum(prefetch[1] for prefetch in prefetches)))
+    if city == ALL_CITIES:
+        print_city_comparison(compare_cities(list(CITY_DATA), month, day,
+                                             window))
+        return
+    # Summary stats come from the city's aggregate cube, rows are only
+    # loaded if the user wants to view them.
+    summary = city_summary_stats(city, month, day, window)
+    # Make sure we actually have some data!
+    # CSVs don't have any records for July-Dec ;-).
+    if summary['trip_count'] > 0:
+        render_summary_stats(summary)
+        # Like the prefetch, cities read in streamed mode don't get their
+        # time series built just for the sparklines.
+        streamed = PUSHDOWN_FILTERS or OUT_OF_CORE
+        hourly = city_rollups(city, month, day, window, 'hourly',
+                              build=not streamed)
+        if hourly is not None:
+            print_rollups(hourly, city_rollups(city, month, day, window,
+                                               'daily'))
+        if confirm_df_view():
+            print('\n** Dataset rows **\n')
+            # Page through the rows per user's query city/month/day filters.
+            df, positions = query_rows(city, month, day, window)
+            print_bikeshare_df_page(df, 0, positions)
+        else:
+            print('[OK, skipping dataframe view ...]')
+    else:
+        print('\nSorry, no matching data found with the selected ' +
+              'filters! Please try changing your filter options.')
+
+
+def compare_cities(cities, month, day, window=None):
+    """
+    Compute the summary statistics of the same query for several cities,
+    and for all of them combined.
+
+    The cities are loaded and aggregated concurrently in threads, each
+    from its compact cached data or cube as usual. The combined statistics
+    come from merging the cities' aggregates with merge_aggregates(), not
+    from concatenating their rows.
+
+    Arguments:
+        cities
+            list of CITY_DATA keys
+        month
+            month (3 char str, e.g. 'Jan') or 'all'
+        day
+            day (3 char str, e.g. 'Mon') or 'all'
+        window
+            time window (dict) from time_window(), or None
+
+    Returns:
+        dict of city name, then ALL_CITIES, to summary statistics (dict)
+    """
+    trace = current_trace()
+    with ThreadPoolExecutor(max_workers=len(cities)) as pool:
+        city_aggs = list(pool.map(
+            lambda city: traced_call(trace, city_aggregates, city, month,
+                                     day, window), cities))
+    summaries = {city: summarize_aggregates(aggs, month, day)
+                 for city, aggs in zip(cities, city_aggs)}
+    summaries[ALL_CITIES] = summarize_aggregates(
+        functools.reduce(merge_aggregates, city_aggs, None), month, day)
+    if window is not None:
+        for summary in summaries.values():
+            summary['window'] = window_label(window)
+    return summaries
+
+
+def comparison_table(summaries):
+    """
+    Lay out the summary statistics of several cities side by side.
+
+    Arguments:
+        summaries -- dict of city name to summary statistics (dict), as
+                     from compare_cities()
+
+    Returns:
+        dataframe with one row per statistic and one column per city,
+        '-' where a city has no data for it
+    """
+    user_types = sorted({value for summary in summaries.values()
+                         for value in summary['user_type_counts'] or {}})
+    genders = sorted({value for summary in summaries.values()
+                      for value in summary['gender_counts'] or {}})
+    columns = {}
+    for city, summary in summaries.items():
+        trips = int(summary['trip_count'])
+        column = {'Trips': trips}
+        if summary['month'] == 'all':
+            column['Busiest month'] = summary['busiest_month']
+        if summary['day'] == 'all':
+            column['Busiest day of the week'] = summary['busiest_weekday']
+        column['Busiest start hour'] = summary['busiest_start_hour']
+        column['Most frequented Start Station'] = (
+            summary['top_start_station'])
+        column['Most frequented End Station'] = summary['top_end_station']
+        journeys = summary['top_journeys']
+        column['Most common journey'] = (
+            '%s to %s' % tuple(journeys[0][0:2]) if journeys else None)
+        # No trips means no duration, not a duration of 0.
+        column['Total duration (hours)'] = (
+            round(summary['total_duration_seconds'] / 3600, 1) if trips
+            else None)
+        mean = summary['mean_duration_seconds']
+        column['Mean duration (minutes)'] = (
+            None if mean is None else round(mean / 60, 1))
+        percentiles = summary['duration_percentiles'] or {}
+        column['Median duration (minutes)'] = (
+            round(percentiles['median'] / 60, 1) if percentiles else None)
+        for value in user_types:
+            column['User Type: ' + value] = (
+                (summary['user_type_counts'] or {}).get(value))
+        for value in genders:
+            column['Gender: ' + value] = (
+                (summary['gender_counts'] or {}).get(value))
+        birth_year = summary['birth_year'] or {}
+        column['Birth year of oldest rider'] = birth_year.get('oldest')
+        column['Birth year of youngest rider'] = birth_year.get('youngest')
+        column['Most common birth year'] = birth_year.get('most_common')
+        # An object Series, so a column of counts and Nones stays ints.
+        columns[city] = pd.Series(column, dtype=object)
+    table = pd.DataFrame(columns, dtype=object).rename_axis('Statistic')
+    return table.where(table.notna(), '-')
+
+
+def print_city_comparison(summaries):
+    """
+    Print the side by side comparison of compare_cities().
+
+    Arguments:
+        summaries -- dict of city name to summary statistics (dict)
+    """
+    print('******* City Comparison *******\n')
+    print(comparison_table(summaries).to_string())
+    print('\n(end of City Comparison)\n')
+
+
+def compare_command(args):
+    """
+    Run the compare subcommand: compare cities side by side.
+
+    Arguments:
+        args -- parsed command line arguments
+    """
+    month, day = month_day_args(args)
+    window = window_args(args)
+    cities = args.cities or list(CITY_DATA)
+    start = time.perf_counter()
+    with query_trace('compare {n} cities'.format(n=len(cities))):
+        summaries = compare_cities(cities, month, day, window)
+    elapsed = time.perf_counter() - start
+    match args.format:
+        case 'text':
+            print_city_comparison(summaries)
+        case 'json':
+            print(json.dumps(summaries))
+        case 'csv':
+            comparison_table(summaries).to_csv(sys.stdout)
+    print('Compared {n} cities in {secs:.2f}s'.
+          format(n=len(cities), secs=elapsed), file=sys.stderr)
+
+
+def parse_query(text):
+    """
+    Parse a 'city,month,day' batch query.
+
+    Month and day are 'all' or their first 3 letters, like the interactive
+    prompts, and may be left out to mean 'all'.
+
+    Arguments:
+        text -- query string, e.g. 'chicago,jun,all' or 'n,,mon' (str)
+
+    Returns:
+        (city, month, day) tuple, e.g. ('Chicago', 'Jun', 'all')
+    """
+    parts = [part.strip() for part in text.split(',')]
+    if not 1 <= len(parts) <= 3:
+        raise argparse.ArgumentTypeError(
+            'expected city,month,day but got {q!r}'.format(q=text))
+    parts += [''] * (3 - len(parts))
+    city = resolve_city(parts[0])
+    month = parts[1][0:3].title() or 'All'
+    if month != 'All' and month not in MONTH_NUMBERS:
+        raise argparse.ArgumentTypeError(
+            'unknown month {m!r} in query {q!r}'.format(m=parts[1], q=text))
+    day = parts[2][0:3].title() or 'All'
+    if day != 'All' and day not in WEEKDAY_NUMBERS:
+        raise argparse.ArgumentTypeError(
+            'unknown day {d!r} in query {q!r}'.format(d=parts[2], q=text))
+    return (city,
+            'all' if month == 'All' else month,
+            'all' if day == 'All' else day)
+
+
+def parse_window_date(text):
+    """
+    Parse a time window bound, e.g. '2017-03-01' or '2017-03-01 07:30'.
+
+    Arguments:
+        text -- date or date and time (str)
+
+    Returns:
+        pd.Timestamp
+    """
+    try:
+        timestamp = pd.Timestamp(text.strip())
+    except ValueError:
+        timestamp = None
+    # '' and 'nat' parse as NaT, which isn't a date either.
+    if timestamp is None or pd.isna(timestamp):
+        raise argparse.ArgumentTypeError(
+            'expected a date like 2017-03-01 but got {t!r}'.format(t=text))
+    return timestamp
+
+
+def parse_window_span(text):
+    """
+    Parse the length of a 'last ...' time window.
+
+    Arguments:
+        text -- a number of hours, days or weeks, e.g. '36h', '14d',
+                '2w' or '2 weeks' (str)
+
+    Returns:
+        pd.Timedelta
+    """
+    match = re.fullmatch(r'\s*(\d+)\s*([hdw])[a-z]*\s*', text.lower())
+    if match is None:
+        raise argparse.ArgumentTypeError(
+            'expected a span like 14d or 2w but got {t!r}'.format(t=text))
+    return pd.Timedelta(**{WINDOW_SPAN_UNITS[match[2]]: int(match[1])})
+
+
+def parse_hours(text):
+    """
+    Parse a start hour range, e.g. '7-9' for trips starting 7:00 to 8:59.
+
+    The range may wrap past midnight, e.g. '22-2', and a single hour
+    like '17' means 17:00 to 17:59.
+
+    Arguments:
+        text -- 'H-H' or 'H', hours 0 to 24 (str)
+
+    Returns:
+        tuple of start hours (ints)
+    """
+    match = re.fullmatch(r'\s*(\d{1,2})\s*(?:-\s*(\d{1,2}))?\s*', text)
+    first = int(match[1]) if match else 24
+    last = int(match[2] or first+1) if match else 0
+    if first > 23 or not 0 < last <= 24 or first == last:
+        raise argparse.ArgumentTypeError(
+            'expected start hours like 7-9 but got {t!r}'.format(t=text))
+    return tuple(hour % 24 for hour in range(first, last + 24*(last < first)))
+
+
+def parse_weekdays(text):
+    """
+    Parse a set of weekdays.
+
+    Arguments:
+        text -- 'weekdays', 'weekends', or day abbreviations and ranges
+                separated by commas, e.g. 'mon-fri' or 'sat,sun' (str)
+
+    Returns:
+        sorted tuple of weekday numbers (ints), Monday being 0
+    """
+    text = text.strip().lower()
+    if text in WEEKDAY_SETS:
+        return tuple(WEEKDAY_SETS[text])
+    days = set()
+    for part in text.split(','):
+        ends = [end.strip()[0:3].title() for end in part.split('-')]
+        if len(ends) > 2 or not all(end in WEEKDAY_NUMBERS for end in ends):
+            raise argparse.ArgumentTypeError(
+                'expected weekdays like mon-fri or sat,sun but got {t!r}'.
+                format(t=text))
+        first, last = WEEKDAY_NUMBERS[ends[0]], WEEKDAY_NUMBERS[ends[-1]]
+        days.update(day % 7 for day in
+                    range(first, last + 1 + 7*(last < first)))
+    return tuple(sorted(days))
+
+
+def time_window(start=None, end=None, last=None, hours=None, weekdays=None):
+    """
+    Combine parsed time window filters into a window for the Start Time
+    index, see window_positions().
+
+    Arguments:
+        start -- first date or time (pd.Timestamp), or None\n
+        end -- last date (inclusive) or time (exclusive) (pd.Timestamp),
+               or None\n
+        last -- only the span before the latest trip (pd.Timedelta), or
+                None\n
+        hours -- start hours from parse_hours(), or None\n
+        weekdays -- weekday numbers from parse_weekdays(), or None
+
+    Returns:
+        window (dict), or None if no filter was given
+    """
+    if all(value is None for value in (start, end, last, hours, weekdays)):
+        return None
+    if end is not None and end == end.normalize():
+        # A date includes the whole day.
+        end += pd.Timedelta(days=1)
+    return {'start': start, 'end': end, 'last': last,
+            'hours': hours, 'weekdays': weekdays}
+
+
+def window_label(window):
+    """
+    Describe a time window, e.g. 'last 14 days, 07:00-08:59, Mon-Fri'.
+
+    Arguments:
+        window -- time window (dict), see time_window()
+
+    Returns:
+        description (str)
+    """
+    def time_str(ts):
+        return str(ts.date()) if ts == ts.normalize() else str(ts)
+
+    parts = []
+    start, end = window['start'], window['end']
+    if start is not None or end is not None:
+        if end is not None and end == end.normalize():
+            # Dates are shown inclusive.
+            end -= pd.Timedelta(days=1)
+        parts.append('{start} to {end}'.format(
+            start='first trip' if start is None else time_str(start),
+            end='last trip' if end is None else time_str(end)))
+    if window['last'] is not None:
+        hours = int(window['last'] / pd.Timedelta(hours=1))
+        parts.append('last {n} {unit}'.format(
+            n=hours // 24 if hours % 24 == 0 else hours,
+            unit='days' if hours % 24 == 0 else 'hours'))
+    if window['hours'] is not None:
+        parts.append('{first:02d}:00-{last:02d}:59'.format(
+            first=window['hours'][0], last=window['hours'][-1]))
+    if window['weekdays'] is not None:
+        parts.append(','.join(calendar.day_abbr[day]
+                              for day in window['weekdays']))
+    return ', '.join(parts)
+
+
+def read_queries_file(path):
+    """
+    Read batch queries from a file, one 'city,month,day' per line.
+
+    Blank lines and lines starting with '#' are skipped.
+
+    Arguments:
+        path -- queries file path (str)
+
+    Returns:
+        list of (city, month, day) tuples
+    """
+    with open(path) as f:
+        return [parse_query(line) for line in f
+                if line.strip() and not line.lstrip().startswith('#')]
+
+
+def report_matrix_queries(cities=None):
+    """
+    Get every city × month × day filter combination.
+
+    Arguments:
+        cities -- list of CITY_DATA keys, defaults to all cities
+
+    Returns:
+        list of (city, month, day) tuples, 13 months × 8 days per city
+    """
+    months = ['all'] + list(MONTH_NUMBERS)
+    days = ['all'] + list(WEEKDAY_NUMBERS)
+    return [(city, month, day)
+            for city in cities or CITY_DATA
+            for month in months
+            for day in days]
+
+
+def run_batch_queries(queries, window=None):
+    """
+    Compute the summary statistics of many queries in this process.
+
+    Queries are run grouped by city with run_city_queries(), so each city
+    is loaded (and its cube built) only once, but results come back in the
+    order of queries.
+
+    Arguments:
+        queries -- list of (city, month, day) tuples\n
+        window -- time window (dict) applied to every query, or None
+
+    Returns:
+        list of result dicts: the query's 'city' plus its summary stats
+    """
+    by_city = {}
+    for i, (city, month, day) in enumerate(queries):
+        by_city.setdefault(city, []).append((i, (month, day)))
+    results = [None] * len(queries)
+    for city, items in by_city.items():
+        city_results = run_city_queries(city, [query for _, query in items],
+                                        window)
+        for (i, _), result in zip(items, city_results):
+            results[i] = result
+    return results
+
+
+def run_city_queries(city, queries, window=None):
+    """
+    Compute the summary statistics of queries all about one city.
+
+    This is the unit of work of run_batch_queries() and, run in a worker
+    process, of run_batch_queries_parallel(). With OUT_OF_CORE on and no
+    cube cached, all the queries not in the result cache are answered in
+    one streaming pass over the city's CSV.
+
+    Arguments:
+        city -- key of CITY_DATA (str)\n
+        queries -- list of (month, day) tuples\n
+        window -- time window (dict) applied to every query, or None
+
+    Returns:
+        list of result dicts, in the order of queries
+    """
+    streamed = {}
+    if (window is None and OUT_OF_CORE and
+            load_city_cube(city, build=False) is None):
+        missing = list(dict.fromkeys(
+            (month, day) for month, day in queries
+            if result_cache_get(result_cache_key(city, month, day)) is None))
+        for aggs, (month, day) in zip(
+                stream_city_aggregates(city, missing) if missing else [],
+                missing):
+            streamed[month, day] = summarize_aggregates(aggs, month, day)
+            result_cache_put(result_cache_key(city, month, day),
+                             streamed[month, day])
+    # Streamed summaries are used as they are, the result cache may be
+    # off or too small to hold them all.
+    summaries = [streamed.get((month, day)) or
+                 city_summary_stats(city, month, day, window)
+                 for month, day in queries]
+    return [dict(city=city, **summary) for summary in summaries]
+
+
+def run_batch_queries_parallel(queries, workers, window=None):
+    """
+    Compute the summary statistics of many queries over a process pool.
+
+    Queries are grouped by city so each worker task loads its city once.
+    When there are more workers than cities and a city's cube is already
+    cached on disk (so loading it is cheap), its queries are split into
+    several tasks to keep all workers busy. Results come back in the order
+    of queries.
+
+    Arguments:
+        queries -- list of (city, month, day) tuples\n
+        workers -- number of worker processes (int)\n
+        window -- time window (dict) applied to every query, or None
+
+    Returns:
+        list of result dicts, same as run_batch_queries()
+    """
+    # Imported here, multiprocessing adds to every start up otherwise.
+    from concurrent.futures import ProcessPoolExecutor
+    by_city = {}
+    for i, (city, month, day) in enumerate(queries):
+        by_city.setdefault(city, []).append((i, (month, day)))
+    splits = max(1, workers // len(by_city))
+    tasks = []
+    for city, items in by_city.items():
+        manifest = read_cache_manifest(city) or {}
+        if 'cube' in manifest.get('artifacts', {}):
+            size = -(-len(items) // splits)
+        else:
+            size = len(items)
+        tasks += [(city, items[start:start+size])
+                  for start in range(0, len(items), size)]
+    results = [None] * len(queries)
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=apply_runtime_settings,
+                             initargs=(runtime_settings(),)) as pool:
+        futures = [(items, pool.submit(run_city_queries, city,
+                                       [query for _, query in items], window))
+                   for city, items in tasks]
+        for items, future in futures:
+            for (i, _), result in zip(items, future.result()):
+                results[i] = result
+    return results
+
+
+def run_batch_rollups(queries, freq, window=None):
+    """
+    Get the time series of many queries, see city_rollups().
+
+    Arguments:
+        queries -- list of (city, month, day) tuples\n
+        freq -- 'hourly' or 'daily' (str)\n
+        window -- time window (dict) applied to every query, or None
+
+    Returns:
+        list of result dicts, one per hour or day of each query: the
+        query's 'city', 'month' and 'day', the 'time' (ISO format) and
+        its series values
+    """
+    results = []
+    for city, month, day in queries:
+        series = city_rollups(city, month, day, window, freq)
+        rows = json.loads(series.rename_axis('time').reset_index().to_json(
+            orient='records', date_format='iso'))
+        results += [dict(city=city, month=month, day=day, **row)
+                    for row in rows]
+    return results
+
+
+def runtime_settings():
+    """
+    Get the settings that command line options can change.
+
+    Returns:
+        dict of module setting name to value
+    """
+    return {'CITY_CACHE_BUDGET_MB': CITY_CACHE_BUDGET_MB,
+            'PUSHDOWN_FILTERS': PUSHDOWN_FILTERS,
+            'READ_CHUNK_SIZE': READ_CHUNK_SIZE,
+            'DF_OUTPUT_PAGE_SIZE': DF_OUTPUT_PAGE_SIZE,
+            'OUT_OF_CORE': OUT_OF_CORE,
+            'PROFILE_STAGES': PROFILE_STAGES,
+            'PROFILE_DIR': PROFILE_DIR,
+            'RESULT_CACHE_SIZE': RESULT_CACHE_SIZE,
+            'PERSIST_RESULTS': PERSIST_RESULTS,
+            'APPROXIMATE': APPROXIMATE,
+            'SKETCH_SIZE': SKETCH_SIZE,
+            'WARM_UP': WARM_UP,
+            'PREFETCH': PREFETCH}
+
+
+def apply_runtime_settings(settings):
+    """
+    Set module settings, e.g. from runtime_settings() in a worker process.
+
+    Arguments:
+        settings -- dict of module setting name to value
+    """
+    globals().update(settings)
+
+
+def write_batch_results(results, fmt, output):
+    """
+    Write batch results as JSON lines or CSV.
+
+    For CSV, nested values are flattened into 'parent.child' columns and
+    lists (e.g. top_journeys) are written as JSON.
+
+    Arguments:
+        results -- list of result dicts from run_batch_queries()\n
+        fmt -- 'jsonl' or 'csv' (str)\n
+        output -- writable text file
+    """
+    match fmt:
+        case 'jsonl':
+            for result in results:
+                output.write(json.dumps(result) + '\n')
+        case 'csv':
+            # convert_dtypes() keeps whole numbers as ints despite gaps.
+            flat = pd.json_normalize(results).convert_dtypes()
+            for col in flat.columns:
+                if flat[col].map(lambda v: isinstance(v, list)).any():
+                    flat[col] = flat[col].map(json.dumps)
+            flat.to_csv(output, index=False)
+
+
+@traced_stage
+def export_query(city, month, day, path, fmt=None, window=None,
+                 chunksize=None):
+    """
+    Export the rows of a query to a file, chunk by chunk.
+
+    Rows are sliced from the cached city data READ_CHUNK_SIZE at a time,
+    or with PUSHDOWN_FILTERS or OUT_OF_CORE on and the city not cached yet
+    streamed from its CSV, so the export never holds more than a chunk of
+    new rows. Streamed chunks are aggregated on the way for the summary
+    stats, otherwise they come from city_summary_stats().
+
+    Arguments:
+        city
+            key of CITY_DATA (str)
+        month
+            month (3 char str, e.g. 'Jan') or 'all'
         day
-            day filter (str)
+            day (3 char str, e.g. 'Mon') or 'all'
+        path
+            file to write (str)
+        fmt
+            one of EXPORT_FORMATS' values, defaults to the one of path's
+            extension (str)
+        window
+            time window (dict) from time_window(), or None
+        chunksize
+            rows per chunk, defaults to READ_CHUNK_SIZE (int)
+
+    Returns:
+        (rows written (int), summary statistics (dict)) tuple
     """
-    print('******* Summary Statistics *******\n')
-    time_stats(df, month, day)
-    station_stats(df)
-    trip_duration_stats(df)
-    user_stats(df, day)
-    print('(end of Summary Statistics)\n')
+    fmt = fmt or export_format(path)
+    chunksize = chunksize or READ_CHUNK_SIZE
+    city_source_fingerprint(city)
+    if ((PUSHDOWN_FILTERS or OUT_OF_CORE) and window is None and
+            city not in city_df_cache and read_cache_manifest(city) is None):
+        aggs = [None]
 
-def about_this_app():
+        def chunks():
+            for chunk in read_city_csv_chunks(city, month, day, chunksize):
+                aggs[0] = merge_aggregates(aggs[0], aggregate_trips(chunk))
+                yield chunk
+
+        rows = write_export_chunks(chunks(), path, fmt)
+        if aggs[0] is None:
+            # No matching rows: aggregate an empty frame.
+            aggs[0] = aggregate_trips(prepare_df_columns(pd.read_csv(
+                CITY_DATA[city], index_col=0, nrows=0)))
+        summary = summarize_aggregates(aggs[0], month, day)
+        result_cache_put(result_cache_key(city, month, day), summary)
+        return rows, summary
+    df, positions = query_rows(city, month, day, window)
+    if positions is None:
+        positions = np.arange(len(df))
+    # Always at least one (maybe empty) chunk, for the header or schema.
+    chunks = (df.iloc[positions[start:start+chunksize]]
+              for start in range(0, max(len(positions), 1), chunksize))
+    rows = write_export_chunks(chunks, path, fmt)
+    return rows, city_summary_stats(city, month, day, window)
+
+
+def export_format(path):
     """
-    Print information about this application.
+    Get the export format of a file name from its extension.
 
-    This prints the application banner & the URL back to
-    its github repo (https://github.com/coughlin/pdsnd_github).
+    Arguments:
+        path -- file path (str)
+
+    Returns:
+        one of EXPORT_FORMATS' values (str)
     """
-    # print('\033c'...) below should clear the terminal screen
-    # But this may not work on all platforms, so some testing
-    # and validation by others is encouraged!
-    print('\033c'+APP_INIT_BANNER)
-    print('\nTo log Issues or Contribute to this application, go to ' +
-          'https://github.com/coughlin/pdsnd_github')
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in EXPORT_FORMATS:
+        raise ValueError('unknown export file extension {ext!r}, expected '
+                         'one of {exts}'.format(
+                             ext=extension, exts=', '.join(EXPORT_FORMATS)))
+    return EXPORT_FORMATS[extension]
 
 
-def main():
+def write_export_chunks(chunks, path, fmt):
     """
-    Run main block of code for this Bikeshare python file.
+    Write dataframe chunks to one CSV, JSON lines, Parquet or Arrow IPC
+    file, with the index as an 'id' column.
 
-    This greets the user and invokes main event loop (Apple HQ address street
-    named "1 Infinite Loop" for good reason!).
-    The only way the event loop ends normally is if the user elects to quit,
-    which breaks out of this main event loop.
+    Each chunk is written as soon as it comes. The file is written under a
+    temporary name and renamed when complete, so a failed export leaves no
+    partial file behind.
+
+    Arguments:
+        chunks -- iterator of dataframes with the same columns\n
+        path -- file to write (str)\n
+        fmt -- 'csv', 'jsonl', 'parquet' or 'arrow' (str)
+
+    Returns:
+        number of rows written (int)
     """
-    about_this_app()
-    while True:
-        # Get filters from user for data query.
-        print('\nPlease select which parts of the bikeshare data & ' +
-              'associated statistics you want to view below.')
-        city, month, day = get_filters()
-        # Load city data per user's query city/month/day filter options.
-        df = load_data(city, month, day)
-        # Make sure we actually have some data!
-        # CSVs don't have any records for July-Dec ;-).
-        if len(df) > 0:
-            print_summary_stats(df, month, day)
-            if confirm_df_view():
-                print('\n** Dataset rows **\n')
-                print_bikeshare_df_page(df, 0)
-            else:
-                print('[OK, skipping dataframe view ...]')
+    rows = 0
+    tmp_path = temp_path(path)
+    try:
+        match fmt:
+            case 'csv' | 'jsonl':
+                header = True
+                with open(tmp_path, 'w', newline='') as f:
+                    for chunk in chunks:
+                        chunk = chunk.reset_index(names='id')
+                        if fmt == 'csv':
+                            # Only the first chunk, even if it's empty.
+                            chunk.to_csv(f, index=False, header=header)
+                            header = False
+                        elif len(chunk) > 0:
+                            chunk.to_json(f, orient='records', lines=True,
+                                          date_format='iso')
+                        rows += len(chunk)
+            case 'parquet' | 'arrow':
+                import pyarrow as pa
+                import pyarrow.parquet as parquet
+                writer = None
+                for chunk in chunks:
+                    chunk = chunk.reset_index(names='id')
+                    if writer is None:
+                        schema = export_arrow_schema(chunk)
+                        writer = (parquet.ParquetWriter(tmp_path, schema)
+                                  if fmt == 'parquet' else
+                                  pa.ipc.new_file(tmp_path, schema))
+                    writer.write_table(pa.Table.from_pandas(
+                        chunk, schema=schema, preserve_index=False))
+                    rows += len(chunk)
+                if writer is not None:
+                    writer.close()
+        os.replace(tmp_path, path)
+    finally:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+    return rows
+
+
+def export_arrow_schema(df):
+    """
+    Get the Arrow schema of exported rows.
+
+    Types are fixed per column rather than inferred, so chunks streamed
+    from a CSV (where e.g. a chunk may have no Gender values) all match:
+    categoricals become strings, Trip Duration and Birth Year float64.
+
+    Arguments:
+        df -- first chunk of rows to export, index reset to an 'id' column
+
+    Returns:
+        pyarrow Schema
+    """
+    import pyarrow as pa
+    types = {'id': pa.int64(),
+             'Start Time': pa.timestamp('ns'),
+             'End Time': pa.timestamp('ns'),
+             'Trip Duration': pa.float64(),
+             'Birth Year': pa.float64(),
+             'Month Number': pa.int8(),
+             'Start Hour': pa.int8()}
+    return pa.schema([(col, types.get(col, pa.string()))
+                      for col in df.columns])
+
+
+def batch_command(args):
+    """
+    Run the batch subcommand: compute and write many queries' statistics.
+
+    Arguments:
+        args -- parsed command line arguments
+    """
+    queries = list(args.query)
+    if args.queries_file:
+        queries += read_queries_file(args.queries_file)
+    if args.matrix:
+        queries += report_matrix_queries(args.matrix_cities)
+    if not queries:
+        raise SystemExit('batch: no queries given, use --query, '
+                         '--queries-file or --matrix')
+    window = window_args(args)
+    start = time.perf_counter()
+    with query_trace('batch of {n} queries'.format(n=len(queries))):
+        if args.rollups:
+            results = run_batch_rollups(queries, args.rollups, window)
+        elif args.workers > 1:
+            results = run_batch_queries_parallel(queries, args.workers,
+                                                 window)
         else:
-            print('\nSorry, no matching data found with the selected ' +
-                  'filters! Please try changing your filter options.')
+            results = run_batch_queries(queries, window)
+    elapsed = time.perf_counter() - start
+    if args.output == '-':
+        write_batch_results(results, args.format, sys.stdout)
+    else:
+        with open(args.output, 'w', newline='') as output:
+            write_batch_results(results, args.format, output)
+    print('Ran {n} queries in {secs:.2f}s ({rate:.1f} queries/s)'.
+          format(n=len(queries), secs=elapsed,
+                 rate=len(queries) / max(elapsed, 1e-9)),
+          file=sys.stderr)
+
+
+def station_command(args):
+    """
+    Run the station subcommand: print or dump one station's drill-down.
+
+    Arguments:
+        args -- parsed command line arguments
+    """
+    try:
+        drill = station_drilldown(args.city, args.station,
+                                  *month_day_args(args))
+    except ValueError as err:
+        raise SystemExit('station: {err}'.format(err=err))
+    if args.format == 'json':
+        print(json.dumps(drill))
+    else:
+        print_station_drilldown(drill)
+
+
+def export_command(args):
+    """
+    Run the export subcommand: write a query's rows and summary stats to
+    files, and report the write throughput.
+
+    Arguments:
+        args -- parsed command line arguments
+    """
+    month, day = month_day_args(args)
+    try:
+        fmt = args.format or export_format(args.output)
+    except ValueError as err:
+        raise SystemExit('export: {err}'.format(err=err))
+    start = time.perf_counter()
+    try:
+        with query_trace('export {path}'.format(path=args.output)):
+            rows, summary = export_query(args.city, month, day, args.output,
+                                         fmt, window_args(args))
+    except ImportError:
+        raise SystemExit('export: the {fmt} format needs the pyarrow package'.
+                         format(fmt=fmt))
+    except (OSError, ValueError) as err:
+        raise SystemExit('export: {err}'.format(err=err))
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    size_mb = os.path.getsize(args.output) / 2**20
+    print('{cname}: exported {rows} rows to {path} in {secs:.2f}s '
+          '({rate:,.0f} rows/s, {mb_rate:.1f} MB/s)'.
+          format(cname=args.city, rows=rows, path=args.output, secs=elapsed,
+                 rate=rows / elapsed, mb_rate=size_mb / elapsed))
+    stats_path = args.stats or (os.path.splitext(args.output)[0] +
+                                '.stats.json')
+    with open(stats_path, 'w') as f:
+        json.dump(dict(city=args.city, **summary), f, indent=1)
+    print('{cname}: wrote summary stats to {path}'.
+          format(cname=args.city, path=stats_path))
+
+
+def ingest_command(args):
+    """
+    Run the ingest subcommand: append new trip CSVs to a city's data.
+
+    Arguments:
+        args -- parsed command line arguments
+    """
+    for path in args.files:
+        start = time.perf_counter()
+        try:
+            with query_trace('ingest {path}'.format(path=path)):
+                rows = ingest_city_csv(args.city, path)
+        except (OSError, ValueError) as err:
+            raise SystemExit('ingest: {err}'.format(err=err))
+        elapsed = time.perf_counter() - start
+        print('{cname}: ingested {rows} rows from {path} in {secs:.2f}s '
+              '({rate:,.0f} rows/s)'.
+              format(cname=args.city, rows=rows, path=path, secs=elapsed,
+                     rate=rows / max(elapsed, 1e-9)))
+
+
+def serve_command(args):
+    """
+    Run the serve subcommand: preload cities and answer the JSON API until
+    interrupted.
+
+    Arguments:
+        args -- parsed command line arguments
+    """
+    apply_runtime_settings({'RESPONSE_CACHE_SIZE': args.response_cache})
+    for city in args.cities or list(CITY_DATA):
+        start = time.perf_counter()
+        load_city_df(city)
+        load_city_cube(city)
+        print('{cname}: loaded in {secs:.2f}s'.
+              format(cname=city, secs=time.perf_counter() - start))
+    server = ThreadingHTTPServer((args.host, args.port),
+                                 BikeshareRequestHandler)
+    print('Serving on http://{host}:{port}/ (Ctrl+C to stop)'.
+          format(host=args.host, port=server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class BikeshareRequestHandler(BaseHTTPRequestHandler):
+    """Answer GET requests of the serve subcommand, see serve_request()."""
+
+    def do_GET(self):
+        """Send the JSON response of a GET request."""
+        url = urllib.parse.urlsplit(self.path)
+        try:
+            status = 200
+            # Each handler thread traces its own requests with --profile.
+            with query_trace('GET {path}'.format(path=self.path)):
+                body = serve_request(url.path,
+                                     dict(urllib.parse.parse_qsl(url.query)))
+        except LookupError:
+            status = 404
+            body = json.dumps({'error': 'unknown path {path!r}, try '
+                               '/cities, /stats or /rows'.
+                               format(path=url.path)}).encode()
+        except (argparse.ArgumentTypeError, ValueError) as err:
+            status = 400
+            body = json.dumps({'error': str(err)}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve_request(path, params):
+    """
+    Answer a request of the serve subcommand's JSON API.
+
+    /cities lists the cities and the city cache state. /stats returns the
+    summary statistics of a query and /rows a page of its rows. Both take
+    the city (required), month and day of parse_query() as parameters,
+    plus the optional from, to, last, hours and weekdays time window of the
+    batch subcommand, and /rows takes page (from 1) and page_size. Responses
+    of /stats and /rows are cached by their parsed parameters and the
+    city CSV's fingerprint.
+
+    All requests read the same cached city data: stats come from the
+    cube, and a page of rows is the only part of a city's data copied.
+
+    Arguments:
+        path -- URL path (str)\n
+        params -- dict of URL query parameters
+
+    Returns:
+        JSON response body (bytes)
+    """
+    if path == '/cities':
+        return json.dumps({'cities': list(CITY_DATA),
+                           'cache': city_cache_stats(),
+                           'results': result_cache_stats()}).encode()
+    if path not in ['/stats', '/rows']:
+        raise LookupError(path)
+    if not params.get('city', '').strip():
+        raise ValueError('missing city parameter')
+    city, month, day = parse_query(','.join(
+        params.get(name, '') for name in ['city', 'month', 'day']))
+    window_parsers = {'from': parse_window_date, 'to': parse_window_date,
+                      'last': parse_window_span, 'hours': parse_hours,
+                      'weekdays': parse_weekdays}
+    window_args = tuple(parse(params[name]) if params.get(name) else None
+                        for name, parse in window_parsers.items())
+    page = page_size = None
+    if path == '/rows':
+        page = max(int(params.get('page', 1)), 1)
+        page_size = min(max(int(params.get('page_size',
+                                           DF_OUTPUT_PAGE_SIZE)), 1),
+                        SERVE_MAX_PAGE_SIZE)
+    key = (path, city, month, day, window_args, page, page_size,
+           tuple(city_source_fingerprint(city).values()))
+    body = response_cache_get(key)
+    if body is not None:
+        return body
+    window = time_window(*window_args)
+    if path == '/stats':
+        result = dict(city=city, **city_summary_stats(city, month, day,
+                                                      window))
+    else:
+        df, positions = query_rows(city, month, day, window)
+        if positions is None:
+            positions = np.arange(len(df))
+        rows = df.iloc[positions[(page-1)*page_size:page*page_size]]
+        result = {'city': city, 'month': month, 'day': day,
+                  'page': page, 'page_size': page_size,
+                  'pages': -(-len(positions) // page_size),
+                  'row_count': len(positions),
+                  'rows': json.loads(rows.reset_index(names='id').to_json(
+                      orient='records', date_format='iso'))}
+        if window is not None:
+            result['window'] = window_label(window)
+    body = json.dumps(result).encode()
+    response_cache_put(key, body)
+    return body
+
+
+def response_cache_get(key):
+    """
+    Get a cached serve_request() response.
+
+    Arguments:
+        key -- the request's parsed parameters (tuple)
+
+    Returns:
+        response body (bytes), or None if not cached
+    """
+    with response_cache_lock:
+        if key not in response_cache:
+            return None
+        response_cache.move_to_end(key)
+        return response_cache[key]
+
+
+def response_cache_put(key, body):
+    """
+    Cache a serve_request() response, evicting the least recently used
+    ones beyond RESPONSE_CACHE_SIZE.
+
+    Arguments:
+        key -- the request's parsed parameters (tuple)\n
+        body -- response body (bytes)
+    """
+    with response_cache_lock:
+        response_cache[key] = body
+        response_cache.move_to_end(key)
+        while len(response_cache) > RESPONSE_CACHE_SIZE:
+            response_cache.popitem(last=False)
+
+
+def resolve_city(name):
+    """
+    Match a command line city argument to a key of CITY_DATA.
+
+    Accepts the same first letters as input_city() ('c', 'n', 'w') or the
+    start of a CITY_DATA key, case insensitive.
+
+    Arguments:
+        name -- city argument (str)
+
+    Returns:
+        the matching CITY_DATA key (str)
+    """
+    if name.strip():
+        for city in CITY_DATA:
+            if city.lower().startswith(name.strip().lower()):
+                return city
+    raise argparse.ArgumentTypeError(
+        'unknown city {cname!r}, choose from: {opts}'.
+        format(cname=name, opts=', '.join(CITY_DATA)))
+
+
+def positive_int(text):
+    """
+    Parse a whole number of at least 1, e.g. a page size.
+
+    Arguments:
+        text -- number (str)
+
+    Returns:
+        the number (int)
+    """
+    try:
+        number = int(text)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            'expected a positive whole number but got {t!r}'.format(t=text))
+    return number
+
+
+def env_default(name, value):
+    """
+    Get the default of a number option set by an environment variable.
+
+    The default is returned as a str, so argparse parses and checks it
+    with the option's type like a value given on the command line.
+
+    Arguments:
+        name -- environment variable (str)\n
+        value -- the setting's current value (int)
+
+    Returns:
+        the variable's raw value if it's set, else value (str)
+    """
+    return os.environ.get(name, str(value))
+
+
+def parse_args(argv=None):
+    """
+    Parse the command line arguments.
+
+    Arguments:
+        argv -- argument list, defaults to sys.argv[1:]
+
+    Returns:
+        argparse.Namespace; its command is None for the interactive app
+    """
+    parser = argparse.ArgumentParser(
+        description='US Bikeshare data explorer. Run without a command for '
+                    'the interactive app.')
+    parser.add_argument('--cache-mb', type=int,
+                        default=env_default('BIKESHARE_CACHE_MB',
+                                            CITY_CACHE_BUDGET_MB),
+                        help='memory budget (MB) for keeping parsed city '
+                             'data between queries (default: %(default)s, '
+                             'or $BIKESHARE_CACHE_MB)')
+    parser.add_argument('--pushdown', action='store_true',
+                        default=PUSHDOWN_FILTERS,
+                        help='filter month/day while streaming uncached CSVs '
+                             'in chunks (or set $BIKESHARE_PUSHDOWN=1)')
+    parser.add_argument('--chunksize', type=int, default=READ_CHUNK_SIZE,
+                        help='rows per chunk when streaming CSVs '
+                             '(default: %(default)s)')
+    parser.add_argument('--page-size', type=positive_int,
+                        default=env_default('BIKESHARE_PAGE_SIZE',
+                                            DF_OUTPUT_PAGE_SIZE),
+                        help='rows per page when viewing query rows '
+                             '(default: %(default)s, or $BIKESHARE_PAGE_SIZE)')
+    parser.add_argument('--out-of-core', action='store_true',
+                        default=OUT_OF_CORE,
+                        help='compute summary stats of uncached cities by '
+                             'streaming their CSV in --chunksize row chunks '
+                             '(or set $BIKESHARE_OUT_OF_CORE=1)')
+    parser.add_argument('--profile', action='store_true',
+                        default=PROFILE_STAGES,
+                        help='print a time/memory breakdown per pipeline '
+                             'stage after each query (or set '
+                             '$BIKESHARE_PROFILE=1)')
+    parser.add_argument('--profile-dir', default=PROFILE_DIR,
+                        help='also write a JSON trace and a cProfile dump '
+                             'per query to this directory (or set '
+                             '$BIKESHARE_PROFILE_DIR)')
+    parser.add_argument('--result-cache', type=int,
+                        default=env_default('BIKESHARE_RESULT_CACHE',
+                                            RESULT_CACHE_SIZE),
+                        help='number of query results (summary stats) to '
+                             'keep, 0 to disable (default: %(default)s, or '
+                             '$BIKESHARE_RESULT_CACHE)')
+    parser.add_argument('--persist-results', action='store_true',
+                        default=PERSIST_RESULTS,
+                        help='also keep query results on disk across runs '
+                             '(or set $BIKESHARE_PERSIST_RESULTS=1)')
+    parser.add_argument('--approximate', action='store_true',
+                        default=APPROXIMATE,
+                        help='keep only the top --sketch-size station and '
+                             'journey counts when computing stats from rows, '
+                             'with stated error bounds (or set '
+                             '$BIKESHARE_APPROXIMATE=1)')
+    parser.add_argument('--sketch-size', type=positive_int,
+                        default=env_default('BIKESHARE_SKETCH_SIZE',
+                                            SKETCH_SIZE),
+                        help='station/journey counts kept in approximate '
+                             'mode (default: %(default)s, or '
+                             '$BIKESHARE_SKETCH_SIZE)')
+    parser.add_argument('--no-warm-up', dest='warm_up', action='store_false',
+                        default=WARM_UP,
+                        help="don't load numpy/pandas and the cached city "
+                             'cubes in the background while the interactive '
+                             'app prompts (or set $BIKESHARE_WARM_UP=0)')
+    parser.add_argument('--no-prefetch', dest='prefetch',
+                        action='store_false', default=PREFETCH,
+                        help="don't start loading the chosen city while the "
+                             'interactive app asks for the filters (or set '
+                             '$BIKESHARE_PREFETCH=0)')
+    subparsers = parser.add_subparsers(dest='command')
+    build_parser = subparsers.add_parser(
+        'build-cache',
+        help='pre-build the on-disk columnar cache of city data')
+    build_parser.add_argument('cities', nargs='*', type=resolve_city,
+                              help='cities to cache (default: all)')
+    batch_parser = subparsers.add_parser(
+        'batch',
+        help='compute the summary stats of many city/month/day queries '
+             'without prompts')
+    batch_parser.add_argument('-q', '--query', action='append', default=[],
+                              type=parse_query, metavar='CITY,MONTH,DAY',
+                              help="a query, e.g. 'chicago,jun,all' "
+                                   '(repeatable)')
+    batch_parser.add_argument('-f', '--queries-file',
+                              help='file with one CITY,MONTH,DAY per line')
+    batch_parser.add_argument('--matrix', action='store_true',
+                              help='run every month (13) × day (8) filter '
+                                   'for each city')
+    batch_parser.add_argument('--matrix-cities', nargs='+',
+                              type=resolve_city, metavar='CITY',
+                              help='cities for --matrix (default: all)')
+    add_window_arguments(batch_parser)
+    batch_parser.add_argument('-j', '--workers', type=int, default=1,
+                              help='worker processes to run queries in, '
+                                   'grouped by city (default: %(default)s)')
+    batch_parser.add_argument('--format', choices=['jsonl', 'csv'],
+                              default='jsonl',
+                              help='output format (default: %(default)s)')
+    batch_parser.add_argument('-o', '--output', default='-',
+                              help='output file (default: stdout)')
+    batch_parser.add_argument('--rollups', choices=list(ROLLUP_FREQS),
+                              help='write each query\'s hourly or daily '
+                                   'time series instead of its summary stats')
+    serve_parser = subparsers.add_parser(
+        'serve',
+        help='preload cities and serve their stats and rows as a local '
+             'JSON HTTP API')
+    serve_parser.add_argument('cities', nargs='*', type=resolve_city,
+                              help='cities to preload (default: all)')
+    serve_parser.add_argument('--host', default='127.0.0.1',
+                              help='address to listen on '
+                                   '(default: %(default)s)')
+    serve_parser.add_argument('--port', type=int, default=8000,
+                              help='port to listen on (default: %(default)s)')
+    serve_parser.add_argument('--response-cache', type=int,
+                              default=RESPONSE_CACHE_SIZE,
+                              help='number of responses to cache '
+                                   '(default: %(default)s)')
+    ingest_parser = subparsers.add_parser(
+        'ingest',
+        help="append new trip CSVs to a city's data, updating its caches "
+             'with just the new rows')
+    ingest_parser.add_argument('city', type=resolve_city)
+    ingest_parser.add_argument('files', nargs='+', metavar='CSV',
+                               help="CSV files with the city CSV's columns")
+    station_parser = subparsers.add_parser(
+        'station',
+        help="drill into one station's traffic: hourly and weekday "
+             'profiles, top destinations and origins')
+    station_parser.add_argument('city', type=resolve_city)
+    station_parser.add_argument('station',
+                                help='station name, or a unique part of it')
+    add_month_day_arguments(station_parser)
+    station_parser.add_argument('--format', choices=['text', 'json'],
+                                default='text',
+                                help='output format (default: %(default)s)')
+    compare_parser = subparsers.add_parser(
+        'compare',
+        help='compare the summary stats of several cities side by side, '
+             'with their combined total')
+    compare_parser.add_argument('cities', nargs='*', type=resolve_city,
+                                help='cities to compare (default: all)')
+    add_month_day_arguments(compare_parser)
+    add_window_arguments(compare_parser)
+    compare_parser.add_argument('--format', choices=['text', 'json', 'csv'],
+                                default='text',
+                                help='output format (default: %(default)s)')
+    export_parser = subparsers.add_parser(
+        'export',
+        help="write a query's rows to CSV, JSON lines, Parquet or Arrow, "
+             'chunk by chunk, plus its summary stats as JSON')
+    export_parser.add_argument('city', type=resolve_city)
+    add_month_day_arguments(export_parser)
+    add_window_arguments(export_parser)
+    export_parser.add_argument('-o', '--output', required=True,
+                               help='file to write, its extension ({exts}) '
+                                    'sets the format'.format(
+                                        exts=', '.join(EXPORT_FORMATS)))
+    export_parser.add_argument('--format',
+                               choices=sorted(set(EXPORT_FORMATS.values())),
+                               help='output format, overriding the extension')
+    export_parser.add_argument('--stats',
+                               help='file to write the summary stats to '
+                                    '(default: OUTPUT with a .stats.json '
+                                    'extension)')
+    return parser.parse_args(argv)
+
+
+def add_month_day_arguments(parser):
+    """
+    Add the --month and --day filter options to a subcommand parser.
+
+    Arguments:
+        parser -- argparse.ArgumentParser
+    """
+    parser.add_argument('--month', type=lambda m: m[0:3].title(),
+                        choices=['All'] + list(MONTH_NUMBERS),
+                        default='All')
+    parser.add_argument('--day', type=lambda d: d[0:3].title(),
+                        choices=['All'] + list(WEEKDAY_NUMBERS),
+                        default='All')
+
+
+def month_day_args(args):
+    """
+    Get the month/day filter of add_month_day_arguments() options.
+
+    Arguments:
+        args -- parsed command line arguments
+
+    Returns:
+        (month, day) tuple, e.g. ('Jun', 'all')
+    """
+    return (args.month.lower() if args.month == 'All' else args.month,
+            args.day.lower() if args.day == 'All' else args.day)
+
+
+def add_window_arguments(parser):
+    """
+    Add the time window filter options to a subcommand parser.
+
+    Arguments:
+        parser -- argparse.ArgumentParser
+    """
+    parser.add_argument('--from', dest='date_from', type=parse_window_date,
+                        metavar='DATE',
+                        help='only trips starting from this date (or time), '
+                             'e.g. 2017-03-01')
+    parser.add_argument('--to', dest='date_to', type=parse_window_date,
+                        metavar='DATE',
+                        help='only trips starting up to this date '
+                             '(inclusive), e.g. 2017-03-31')
+    parser.add_argument('--last', type=parse_window_span, metavar='SPAN',
+                        help='only trips in the span before the latest '
+                             'trip, e.g. 14d or 2w')
+    parser.add_argument('--hours', type=parse_hours, metavar='H-H',
+                        help='only trips starting in these hours, e.g. 7-9 '
+                             'for 7:00 to 8:59')
+    parser.add_argument('--weekdays', type=parse_weekdays, metavar='DAYS',
+                        help='only trips on these days, e.g. weekdays, '
+                             'weekends or mon,wed,fri')
+
+
+def window_args(args):
+    """
+    Get the time window of add_window_arguments() options.
+
+    Arguments:
+        args -- parsed command line arguments
+
+    Returns:
+        time window (dict) from time_window(), or None
+    """
+    return time_window(args.date_from, args.date_to, args.last, args.hours,
+                       args.weekdays)
+
+
+def cli(argv=None):
+    """
+    Run the command selected on the command line.
+
+    Arguments:
+        argv -- argument list, defaults to sys.argv[1:]
+    """
+    args = parse_args(argv)
+    apply_runtime_settings({'CITY_CACHE_BUDGET_MB': args.cache_mb,
+                            'PUSHDOWN_FILTERS': args.pushdown,
+                            'READ_CHUNK_SIZE': args.chunksize,
+                            'DF_OUTPUT_PAGE_SIZE': args.page_size,
+                            'OUT_OF_CORE': args.out_of_core,
+                            'PROFILE_STAGES': (args.profile or
+                                               bool(args.profile_dir)),
+                            'PROFILE_DIR': args.profile_dir,
+                            'RESULT_CACHE_SIZE': args.result_cache,
+                            'PERSIST_RESULTS': args.persist_results,
+                            'APPROXIMATE': args.approximate,
+                            'SKETCH_SIZE': args.sketch_size,
+                            'WARM_UP': args.warm_up,
+                            'PREFETCH': args.prefetch})
+    match args.command:
+        case 'build-cache':
+            build_city_caches(args.cities or list(CITY_DATA))
+        case 'batch':
+            batch_command(args)
+        case 'serve':
+            serve_command(args)
+        case 'ingest':
+            ingest_command(args)
+        case 'station':
+            station_command(args)
+        case 'compare':
+            compare_command(args)
+        case 'export':
+            export_command(args)
+        case _:
+            main()
 
-        restart_prompt = input('\nWould you like to make a new query? ' +
-                               'Enter [y] to start again, otherwise ' +
-                               'enter anything else to quit completely.\n')
-        match restart_prompt[0:1].lower():
-            case 'y':
-                print('\nRestarting ...\n \033c')
-            case _:
-                print('Bye! See you again soon, thanks :-) !')
-                break
 
 if __name__ == "__main__":
     """
     main Execute when the module is not initialized from an import statement.\n
     """
-    main()
+    cli()